@@ -1,12 +1,29 @@
+import argparse
 import asyncio
 import logging
+import signal
+
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
 import config
-from database import init_db, seed_trainings
-from utils.scheduler import setup_scheduler
+from database import engine, init_db, get_engine_settings, load_training_cache
+from migrations import run_migrations
+from middlewares import InFlightMiddleware, DbSessionMiddleware
+from utils.scheduler import (
+    setup_scheduler,
+    get_scheduler,
+    run_notification_catchup,
+    rebuild_booking_reminders,
+    release_stale_notifications,
+    load_durable_jobs,
+)
+from utils.broadcast import resume_unfinished_broadcasts
+from utils.schedule import convert_skipped_days, sync_schedule
+from utils.fsm_storage import SQLAlchemyStorage, SQLAlchemyEventIsolation
 
 # Импорт обработчиков
 from handlers import start, online, studio, profile, payment, admin, booking
@@ -21,16 +38,48 @@ logger = logging.getLogger(__name__)
 
 # Инициализация бота
 bot = Bot(token=config.BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+if config.FSM_STORAGE == 'memory':
+    storage = MemoryStorage()
+    dp = Dispatcher(storage=storage)
+else:
+    storage = SQLAlchemyStorage(ttl=config.FSM_STATE_TTL)
+    dp = Dispatcher(storage=storage, events_isolation=SQLAlchemyEventIsolation(storage))
+inflight = InFlightMiddleware()
+
+# Фоновые задачи запуска: ссылка нужна, иначе задачу может собрать сборщик мусора
+_background_tasks = set()
+
+
+def _start_background(coro, name: str):
+    """Запустить задачу в фоне, ошибки — в лог"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+
+    def _on_done(t: asyncio.Task):
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception():
+            logger.error(f"Фоновая задача {name} упала: {t.exception()!r}")
+
+    task.add_done_callback(_on_done)
+    return task
 
 
 async def on_startup():
     """Действия при запуске"""
     logger.info("Инициализация базы данных...")
     await init_db()
-    logger.info("Заполнение расписания тренировок...")
-    await seed_trainings()
+    settings = await get_engine_settings()
+    logger.info("БД: " + ", ".join(f"{key}={value}" for key, value in settings.items()))
+    logger.info("Применение миграций схемы...")
+    await run_migrations()
+    convert_skipped_days()
+    logger.info("Синхронизация расписания тренировок...")
+    synced = await sync_schedule()
+    logger.info(
+        f"Расписание: добавлено {synced['added']}, включено {synced['enabled']}, "
+        f"отключено {synced['disabled']}"
+    )
+    await load_training_cache()
 
     await bot.set_my_commands([
         BotCommand(command="start", description="Главное меню"),
@@ -40,7 +89,15 @@ async def on_startup():
     ])
 
     logger.info("Запуск планировщика задач...")
+    # Уведомления, брошенные упавшим процессом, уйдут повторно
+    await release_stale_notifications()
     setup_scheduler(bot)
+    await load_durable_jobs()
+    await rebuild_booking_reminders()
+    _start_background(run_notification_catchup(bot), 'run_notification_catchup')
+
+    logger.info("Возобновление незавершённых рассылок...")
+    await resume_unfinished_broadcasts(bot)
 
     logger.info("Бот запущен и готов к работе!")
     logger.info(f"Название студии: {config.STUDIO_NAME}")
@@ -49,11 +106,25 @@ async def on_startup():
 async def on_shutdown():
     """Действия при остановке"""
     logger.info("Остановка бота...")
+    # Сначала даём закончить уже начатые обработчики, потом закрываем ресурсы
+    await inflight.wait_idle(config.SHUTDOWN_TIMEOUT)
+
+    scheduler = get_scheduler()
+    if scheduler and scheduler.running:
+        scheduler.shutdown(wait=True)
+
+    # Диспетчер закрывает хранилище до ожидания обработчиков — дожидаемся фоновой чистки ещё раз
+    await storage.close()
+    await engine.dispose()
     await bot.session.close()
+    logger.info("Бот остановлен")
 
 
-async def main():
-    """Главная функция"""
+def setup_dispatcher():
+    """Регистрация роутеров, middleware и событий запуска/остановки"""
+    dp.update.outer_middleware(inflight)
+    dp.update.outer_middleware(DbSessionMiddleware())
+
     # Регистрация роутеров (start последним — содержит fallback-обработчик)
     dp.include_router(online.router)
     dp.include_router(studio.router)
@@ -63,18 +134,80 @@ async def main():
     dp.include_router(admin.router)
     dp.include_router(start.router)
 
-    # Запуск бота
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
+
+async def run_polling():
+    """Запуск в режиме long polling"""
     try:
         await dp.start_polling(bot)
     finally:
         await bot.session.close()
 
 
+async def run_webhook():
+    """Запуск в режиме webhook (aiohttp)"""
+    if not config.WEBHOOK_URL or not config.WEBHOOK_SECRET:
+        raise RuntimeError("Для режима webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+
+    app = web.Application()
+    # Обновления обрабатываются в фоне: Telegram сразу получает 200 OK
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=config.WEBHOOK_SECRET
+    ).register(app, path=config.WEBHOOK_PATH)
+
+    await dp.emit_startup(bot=bot)
+    await bot.set_webhook(
+        config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+        secret_token=config.WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBAPP_HOST, config.WEBAPP_PORT)
+    await site.start()
+    logger.info(f"Webhook слушает {config.WEBAPP_HOST}:{config.WEBAPP_PORT}{config.WEBHOOK_PATH}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    try:
+        await stop_event.wait()
+    finally:
+        # Перестаём принимать новые запросы, дожидаемся начатых и закрываем ресурсы.
+        # Webhook не удаляем: обновления подождут на стороне Telegram до следующего запуска.
+        await site.stop()
+        await dp.emit_shutdown(bot=bot)
+        await runner.cleanup()
+
+
+async def main(mode: str):
+    """Главная функция"""
+    setup_dispatcher()
+
+    if mode == 'webhook':
+        await run_webhook()
+    else:
+        await run_polling()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Telegram-бот фитнес-студии")
+    parser.add_argument(
+        '--mode',
+        choices=['polling', 'webhook'],
+        default=config.BOT_MODE,
+        help="Режим получения обновлений (по умолчанию из BOT_MODE)"
+    )
+    args = parser.parse_args()
+
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.mode))
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
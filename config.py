@@ -53,6 +53,15 @@ PRICES = {
     'renewal_all': 4000,
 }
 
+# Каталог абонементов: тип платежа → абонемент, который он даёт.
+# Продление (renewal) начинается со следующего месяца, если текущий абонемент ещё действует
+SUBSCRIPTION_PRODUCTS = {
+    'one_group': {'subscription_type': 'one_group', 'renewal': False},
+    'all_groups': {'subscription_type': 'all_groups', 'renewal': False},
+    'renewal_one': {'subscription_type': 'one_group', 'renewal': True},
+    'renewal_all': {'subscription_type': 'all_groups', 'renewal': True},
+}
+
 DATA_DIR = os.environ.get('DATA_DIR', os.path.dirname(os.path.abspath(__file__)))
 PRICES_FILE = os.path.join(DATA_DIR, 'prices.json')
 
@@ -96,7 +105,7 @@ SCHEDULE = {
     ],
     "friday": [
         {"type": "Силовая", "trainer": "Анна", "times": ["8:30", "17:10"]},
-        {"type": "Силовая", "trainer": "Алена", "times": ["18:10"]},
+        {"type": "Силовая", "trainer": "Алена", "times": ["19:10"]},
         {"type": "Пилатес", "trainer": "Анна", "times": ["9:30"]},
     ],
     "saturday": [
@@ -121,50 +130,45 @@ TRAINING_EMOJIS = {
     "Барре": "🏃‍♀️",
 }
 
+# Полное название тренировки в таблице trainings (по нему ищет запись на тренировку)
+TRAINING_NAMES = {
+    "Силовая": "Силовая тренировка",
+    "Пилатес": "Пилатес с роллом и досками Садху",
+    "Барре": "Барре",
+}
 
-def format_day_schedule(day):
-    """Генерирует текстовое представление дня из структуры"""
-    title = DAY_TITLES.get(day, day.upper())
-    trainings = SCHEDULE.get(day, [])
-
-    if not trainings:
-        return f"🔘 *{title}*\n\n🌴 Выходной день\nВосстанавливаемся и набираемся сил! 💪"
-
-    lines = [f"🔘 *{title}*\n"]
-
-    # Группируем по типу тренировки
-    grouped = {}
-    for t in trainings:
-        grouped.setdefault(t["type"], []).append(t)
-
-    for training_type, entries in grouped.items():
-        emoji = TRAINING_EMOJIS.get(training_type, "🏃‍♀️")
-        lines.append(f"{emoji} *{training_type}*")
-
-        if len(entries) == 1 and len(entries[0]["times"]) == 1:
-            lines.append(f"✅ {entries[0]['times'][0]} - {entries[0]['trainer']}")
-        else:
-            for entry in entries:
-                lines.append(f"👩‍🏫 Тренер {entry['trainer']}:")
-                for time in entry["times"]:
-                    lines.append(f"✅ {time}")
 
-        lines.append("")
+# Растёт при каждом изменении SCHEDULE — по нему сбрасывается кэш отрисованного текста
+SCHEDULE_VERSION = 0
 
-    return "\n".join(lines).rstrip()
 
+def validate_day_schedule(entries):
+    """Проверить структуру расписания дня, ValueError при ошибке"""
+    if not isinstance(entries, list):
+        raise ValueError("Расписание дня должно быть списком")
+    for entry in entries:
+        if not isinstance(entry, dict) or set(entry) != {"type", "trainer", "times"}:
+            raise ValueError("Каждая запись: тип, тренер и список времени")
+        if entry["type"] not in TRAINING_EMOJIS:
+            raise ValueError(f"Неизвестный тип тренировки: {entry['type']}")
+        if not isinstance(entry["trainer"], str) or not entry["trainer"].strip():
+            raise ValueError("Не указан тренер")
+        times = entry["times"]
+        if not isinstance(times, list) or not times:
+            raise ValueError("Не указано время тренировки")
+        for time in times:
+            hour, _, minute = str(time).partition(':')
+            if not (hour.isdigit() and minute.isdigit() and len(minute) == 2
+                    and int(hour) < 24 and int(minute) < 60):
+                raise ValueError(f"Неверное время: {time}")
 
-def format_full_schedule():
-    """Генерирует полное расписание для показа"""
-    days_order = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
-    parts = ["📅 *РАСПИСАНИЕ ТРЕНИРОВОК*\n\n📍 г. Новотроицк, пр. Комсомольский 3 (2 этаж)\n"]
-    for day in days_order:
-        parts.append(format_day_schedule(day))
-    parts.append("\n📞 Анна: @\\_an\\_sport\\_\n📞 Алена: +7 961 908 0598")
-    return "\n━━━━━━━━━━━━━━━━━━━\n".join(parts)
 
 SCHEDULE_FILE = os.path.join(DATA_DIR, 'schedule.json')
 
+# Дни из файла, не прошедшие проверку: {день: сохранённое значение}.
+# Старый текстовый формат переводит (или называет в логе) utils.schedule.convert_skipped_days
+SCHEDULE_SKIPPED = {}
+
 
 def load_schedule():
     """Загрузить расписание из JSON-файла поверх дефолтов"""
@@ -172,18 +176,26 @@ def load_schedule():
         try:
             with open(SCHEDULE_FILE, 'r', encoding='utf-8') as f:
                 saved = json.load(f)
-            # Проверяем формат: если значение — строка, это старый формат, пропускаем
+            # Старый текстовый формат и повреждённые дни пока остаются дефолтными
             for key, val in saved.items():
-                if isinstance(val, list):
-                    SCHEDULE[key] = val
+                if key not in SCHEDULE:
+                    continue
+                try:
+                    validate_day_schedule(val)
+                except ValueError:
+                    SCHEDULE_SKIPPED[key] = val
+                    continue
+                SCHEDULE[key] = val
         except (json.JSONDecodeError, IOError):
             pass
 
 
 def save_schedule():
     """Сохранить текущее расписание в JSON-файл"""
+    global SCHEDULE_VERSION
     with open(SCHEDULE_FILE, 'w', encoding='utf-8') as f:
         json.dump(SCHEDULE, f, ensure_ascii=False, indent=2)
+    SCHEDULE_VERSION += 1
 
 
 load_schedule()
@@ -192,8 +204,63 @@ load_schedule()
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_URL = os.getenv('DATABASE_URL', f'sqlite+aiosqlite:///{os.path.join(BASE_DIR, "bot.db")}')
 
+# Настройки SQLite (применяются к каждому соединению)
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')  # WAL: чтения не ждут записи
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # в WAL безопасно и быстрее FULL
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))  # мс ожидания блокировки вместо "database is locked"
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '-20000'))  # отрицательное — в КиБ (~20 МБ)
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024)))  # байт
+
+# Пул соединений (PostgreSQL)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))  # сек. ожидания свободного соединения
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # сек., пересоздавать старые соединения
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+
+# Больше запросов к БД за одно обновление — предупреждение в логе (ищем N+1)
+DB_QUERIES_WARN = int(os.getenv('DB_QUERIES_WARN', '15'))
+
+# Хранилище состояний диалогов: sqlalchemy (в БД, переживает перезапуск) или memory
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlalchemy')
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', str(7 * 24 * 3600)))  # незаконченные диалоги старше — сбрасываются
+
+# Время жизни кэша расписания тренировок (сек.), сбрасывается и явно при изменениях
+TRAINING_CACHE_TTL = int(os.getenv('TRAINING_CACHE_TTL', '3600'))
+
 # Канал
 CHANNEL_USERNAME = os.getenv('CHANNEL_USERNAME', '@OFFICIAL_AN_SPORT')
 
 # Лимиты
 MAX_PEOPLE_PER_CLASS = 28
+
+# Лимиты Telegram Bot API (глобально ~30 сообщений/сек)
+TELEGRAM_RATE_LIMIT = float(os.getenv('TELEGRAM_RATE_LIMIT', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+NOTIFICATION_CONCURRENCY = int(os.getenv('NOTIFICATION_CONCURRENCY', '10'))
+
+# Сколько секунд после плановой даты ещё можно выполнить отложенную задачу
+# (воронки, повторы), пропущенную из-за перезапуска
+SCHEDULER_MISFIRE_GRACE = int(os.getenv('SCHEDULER_MISFIRE_GRACE', str(3 * 24 * 3600)))
+
+# За сколько часов при запуске догонять пропущенные уведомления
+NOTIFICATION_CATCHUP_HOURS = int(os.getenv('NOTIFICATION_CATCHUP_HOURS', '24'))
+
+# Через сколько минут неотправленное уведомление считается брошенным (процесс упал
+# посреди отправки) и отбирается заново. Больше самой долгой отправки пачки.
+NOTIFICATION_CLAIM_LEASE_MINUTES = int(os.getenv('NOTIFICATION_CLAIM_LEASE_MINUTES', '60'))
+
+# Ночная сверка платежей и абонементов: по умолчанию только отчёт админам,
+# true — исправлять найденное автоматически (вручную: /reconcile fix)
+SUBSCRIPTION_RECONCILE_REPAIR = os.getenv('SUBSCRIPTION_RECONCILE_REPAIR', 'false').lower() in ('1', 'true', 'yes')
+
+# Режим работы: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8081'))
+
+# Сколько секунд при остановке ждать завершения начатых обработчиков
+SHUTDOWN_TIMEOUT = int(os.getenv('SHUTDOWN_TIMEOUT', '25'))
@@ -1,43 +1,130 @@
 """
 Модуль для работы с базой данных
 """
+import asyncio
+import calendar
+import json
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import Enum
+
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Float, select, func, and_, Date, cast
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.orm import sessionmaker, declarative_base, aliased
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Float, Index, select, func, and_, Date, cast, insert, update, literal, event, text, exists, delete, case, union_all, extract, or_
 from datetime import datetime, timedelta, date
 
 import config
 
 Base = declarative_base()
 
-engine = create_async_engine(config.DATABASE_URL, echo=False)
+def create_engine_from_config(url: str = None):
+    """Создать движок с настройками из config для текущей СУБД.
+
+    SQLite: на каждое соединение — PRAGMA journal_mode, synchronous, busy_timeout,
+    cache_size, mmap_size; транзакции начинаем сами (BEGIN / BEGIN IMMEDIATE).
+    Остальные СУБД: размер пула, pre-ping и пересоздание старых соединений.
+    """
+    url = url or config.DATABASE_URL
+    if url.startswith('sqlite'):
+        # Соединения переиспользуются пулом — PRAGMA выполняются один раз на соединение
+        new_engine = create_async_engine(
+            url,
+            echo=False,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+        )
+
+        @event.listens_for(new_engine.sync_engine, "connect")
+        def _sqlite_connect(dbapi_connection, connection_record):
+            # Отключаем неявные транзакции драйвера — BEGIN выдаём сами (см. ниже)
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT}")
+            cursor.execute(f"PRAGMA cache_size={config.SQLITE_CACHE_SIZE}")
+            cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}")
+            cursor.close()
+
+        @event.listens_for(new_engine.sync_engine, "begin")
+        def _sqlite_begin(conn):
+            # execution_options(sqlite_begin='BEGIN IMMEDIATE') сразу берёт блокировку записи
+            conn.exec_driver_sql(conn.get_execution_options().get('sqlite_begin', 'BEGIN'))
+
+        return new_engine
+
+    return create_async_engine(
+        url,
+        echo=False,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=config.DB_POOL_PRE_PING,
+    )
+
+
+engine = create_engine_from_config()
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
+async def get_engine_settings() -> dict:
+    """Фактические настройки соединения с БД (для лога при запуске)"""
+    settings = {'dialect': engine.dialect.name, 'pool': type(engine.pool).__name__}
+    if engine.dialect.name == 'sqlite':
+        async with engine.connect() as conn:
+            for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size'):
+                settings[pragma] = (await conn.exec_driver_sql(f"PRAGMA {pragma}")).scalar()
+    else:
+        settings.update(
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+            pool_pre_ping=config.DB_POOL_PRE_PING,
+        )
+    return settings
+
+
 class User(Base):
     """Модель пользователя"""
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_active_last_visit', 'is_active', 'last_visit_at'),
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, unique=True, nullable=False)
+    user_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(100))
     name = Column(String(200))
     phone = Column(String(20))
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
+    last_visit_at = Column(DateTime)  # дата последнего посещения, обновляет mark_visit
 
 
 class Subscription(Base):
     """Модель абонемента"""
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        Index('ix_subscriptions_user_active_end', 'user_id', 'is_active', 'end_date'),
+        Index('ix_subscriptions_active_end', 'is_active', 'end_date'),
+        Index('ix_subscriptions_payment', 'payment_id', 'start_date'),
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(BigInteger, ForeignKey('users.user_id'))
     subscription_type = Column(String(50))  # one_group, all_groups
     start_date = Column(DateTime)
     end_date = Column(DateTime)
     is_active = Column(Boolean, default=True)
     trainings_left = Column(Integer, default=8)
+    payment_id = Column(Integer, ForeignKey('payments.id'))  # оплата, по которой выдан (NULL — выдан до сверки)
 
 
 class Training(Base):
@@ -53,14 +140,27 @@ class Training(Base):
     duration = Column(Integer, default=60)  # в минутах
     max_participants = Column(Integer, default=10)
     training_type = Column(String(50))  # online, studio
+    is_active = Column(Boolean, default=True)  # False — слот убран из расписания
 
 
 class Booking(Base):
     """Модель записи на тренировку"""
     __tablename__ = 'bookings'
+    __table_args__ = (
+        Index('ix_bookings_training_status_date', 'training_id', 'status', 'booking_date'),
+        Index('ix_bookings_user_status_date', 'user_id', 'status', 'booking_date'),
+        Index('ix_bookings_status_date', 'status', 'booking_date'),
+        # Одна активная запись пользователя на конкретный слот
+        Index(
+            'ux_bookings_active_slot', 'user_id', 'training_id', 'booking_date',
+            unique=True,
+            sqlite_where=text("status = 'active'"),
+            postgresql_where=text("status = 'active'")
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(BigInteger, ForeignKey('users.user_id'))
     training_id = Column(Integer, ForeignKey('trainings.id'))
     booking_date = Column(DateTime)
     status = Column(String(20), default='active')  # active, cancelled, completed
@@ -70,9 +170,13 @@ class Booking(Base):
 class Payment(Base):
     """Модель платежа"""
     __tablename__ = 'payments'
+    __table_args__ = (
+        Index('ix_payments_status_created', 'status', 'created_at'),
+        Index('ix_payments_status_confirmed', 'status', 'confirmed_at'),
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(BigInteger, ForeignKey('users.user_id'))
     amount = Column(Float)
     payment_type = Column(String(50))
     status = Column(String(20), default='pending')  # pending, confirmed, cancelled
@@ -83,28 +187,174 @@ class Payment(Base):
 class Visit(Base):
     """Модель посещения"""
     __tablename__ = 'visits'
+    __table_args__ = (
+        Index('ix_visits_user_date', 'user_id', 'visit_date'),
+    )
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    user_id = Column(BigInteger, ForeignKey('users.user_id'))
     training_id = Column(Integer, ForeignKey('trainings.id'))
     visit_date = Column(DateTime, default=datetime.utcnow)
 
 
+class Broadcast(Base):
+    """Модель рассылки"""
+    __tablename__ = 'broadcasts'
+
+    id = Column(Integer, primary_key=True)
+    segment = Column(String(20))  # all, with_sub, without_sub
+    text = Column(String(4096))
+    status = Column(String(20), default='running')  # running, paused, cancelled, done
+    admin_chat_id = Column(BigInteger)
+    admin_message_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+
+class BroadcastRecipient(Base):
+    """Получатель рассылки и статус доставки"""
+    __tablename__ = 'broadcast_recipients'
+    __table_args__ = (
+        Index('ix_broadcast_recipients_broadcast_status', 'broadcast_id', 'status'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    broadcast_id = Column(Integer, ForeignKey('broadcasts.id'), nullable=False)
+    user_id = Column(BigInteger, nullable=False)
+    status = Column(String(20), default='pending')  # pending, sent, failed
+    error = Column(String(200))
+    sent_at = Column(DateTime)
+
+
+class FSMState(Base):
+    """Состояние FSM (диалога) пользователя"""
+    __tablename__ = 'fsm_state'
+    __table_args__ = (
+        Index('ix_fsm_state_updated', 'updated_at'),
+    )
+
+    bot_id = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    thread_id = Column(Integer, primary_key=True, default=0)
+    destiny = Column(String(50), primary_key=True, default='default')
+    state = Column(String(200))
+    data = Column(String)  # JSON
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class NotificationLog(Base):
+    """Журнал автоматических уведомлений: каждое отправляется ровно один раз"""
+    __tablename__ = 'notification_log'
+    __table_args__ = (
+        Index('ux_notification_log_key', 'user_id', 'kind', 'subject_id', 'scheduled_for', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    kind = Column(String(30), nullable=False)  # training_reminder, expiring, comeback, inactive
+    subject_id = Column(Integer, nullable=False, default=0)  # id записи/абонемента, 0 — нет
+    scheduled_for = Column(DateTime, nullable=False)
+    status = Column(String(20), default='pending')  # pending, sent, blocked, failed
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+
+class MediaFile(Base):
+    """Загруженный в Telegram файл: file_id для повторной отправки без загрузки"""
+    __tablename__ = 'media_files'
+
+    path = Column(String(500), primary_key=True)  # путь относительно папки проекта
+    mtime = Column(Float, nullable=False)
+    size = Column(Integer, nullable=False)
+    file_id = Column(String(200), nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ScheduledJob(Base):
+    """Разовая отложенная задача (шаг воронки, повтор отправки): переживает перезапуск"""
+    __tablename__ = 'scheduled_jobs'
+
+    id = Column(String(200), primary_key=True)  # id задачи в планировщике
+    func = Column(String(100), nullable=False)  # имя из utils.scheduler.DURABLE_JOBS
+    args = Column(String, nullable=False, default='[]')  # JSON
+    run_at = Column(DateTime, nullable=False)  # UTC
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class SalesDaily(Base):
+    """Сводка продаж по дням и типам: обновляется при подтверждении оплаты"""
+    __tablename__ = 'sales_daily'
+
+    day = Column(Date, primary_key=True)  # дата создания платежа
+    payment_type = Column(String(50), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    amount = Column(Float, nullable=False, default=0)
+
+
 async def init_db():
     """Инициализация базы данных"""
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
 
+def _dialect_insert(model):
+    """INSERT с поддержкой ON CONFLICT для текущей СУБД"""
+    if engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(model)
+
+
+@asynccontextmanager
+async def session_scope(session: AsyncSession = None):
+    """Сессия обновления (см. middlewares.DbSessionMiddleware) или своя на время вызова"""
+    if session is not None:
+        yield session
+        return
+    async with async_session() as own_session:
+        yield own_session
+
+
+async def _commit_if_own(session: AsyncSession, own: bool):
+    """Свою сессию коммитим сразу; сессию обновления коммитит middleware после обработчика"""
+    if own:
+        await session.commit()
+    else:
+        await session.flush()
+
+
+# Счётчик SQL-запросов текущего обновления (задаётся DbSessionMiddleware)
+_query_counter: ContextVar = ContextVar('db_query_counter', default=None)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def start_query_count():
+    """Начать подсчёт запросов в текущем контексте. Возвращает (счётчик, токен для stop_query_count)"""
+    counter = [0]
+    return counter, _query_counter.set(counter)
+
+
+def stop_query_count(token):
+    _query_counter.reset(token)
+
+
 async def get_session() -> AsyncSession:
     """Получение сессии базы данных"""
     async with async_session() as session:
         return session
 
 
-async def get_user(user_id: int):
+async def get_user(user_id: int, session: AsyncSession = None):
     """Получение данных пользователя по user_id"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         result = await session.execute(
             select(User).where(User.user_id == user_id)
         )
@@ -119,9 +369,23 @@ async def get_user(user_id: int):
         return None
 
 
-async def get_active_subscription(user_id: int):
+async def set_users_active(user_ids: list, is_active: bool, session: AsyncSession = None):
+    """Включить/отключить уведомления пользователям (бот заблокирован или разблокирован)"""
+    own = session is None
+    if not user_ids:
+        return
+    async with session_scope(session) as session:
+        await session.execute(
+            update(User)
+            .where(User.user_id.in_(user_ids), User.is_active != is_active)
+            .values(is_active=is_active)
+        )
+        await _commit_if_own(session, own)
+
+
+async def get_active_subscription(user_id: int, session: AsyncSession = None):
     """Получение активного абонемента пользователя"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         result = await session.execute(
             select(Subscription).where(
                 Subscription.user_id == user_id,
@@ -139,61 +403,376 @@ async def get_active_subscription(user_id: int):
         return None
 
 
-async def get_all_clients():
-    """Получение списка всех клиентов с абонементами"""
+async def get_clients_page(after_id: int = None, before_id: int = None, limit: int = 10, session: AsyncSession = None):
+    """Страница клиентов (новые сверху) с активным абонементом — один запрос.
+
+    Keyset-пагинация по User.id: after_id — следующая страница после клиента,
+    before_id — предыдущая страница перед клиентом.
+    """
+    async with session_scope(session) as session:
+        # Сама страница — по индексу первичного ключа, limit + 1 для флага has_more
+        page = select(User.id, User.name, User.username, User.user_id)
+        if before_id is not None:
+            page = page.where(User.id > before_id).order_by(User.id.asc())
+        else:
+            if after_id is not None:
+                page = page.where(User.id < after_id)
+            page = page.order_by(User.id.desc())
+        page = page.limit(limit + 1).subquery()
+
+        # Последний активный абонемент — только для клиентов страницы
+        latest_sub = select(
+            Subscription.user_id,
+            Subscription.subscription_type,
+            Subscription.end_date,
+            func.row_number().over(
+                partition_by=Subscription.user_id,
+                order_by=Subscription.end_date.desc()
+            ).label('rn')
+        ).where(
+            Subscription.is_active == True,
+            Subscription.user_id.in_(select(page.c.user_id))
+        ).subquery()
+
+        total = select(func.count(User.id)).scalar_subquery()
+
+        query = select(
+            page.c.id,
+            page.c.name,
+            page.c.username,
+            page.c.user_id,
+            latest_sub.c.subscription_type,
+            latest_sub.c.end_date,
+            total.label('total')
+        ).outerjoin(
+            latest_sub, and_(latest_sub.c.user_id == page.c.user_id, latest_sub.c.rn == 1)
+        ).order_by(page.c.id.asc() if before_id is not None else page.c.id.desc())
+
+        rows = (await session.execute(query)).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        if before_id is not None:
+            rows.reverse()
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = after_id is not None, has_more
+
+        if rows:
+            total_count = rows[0].total
+        else:
+            total_count = (await session.execute(select(func.count(User.id)))).scalar() or 0
+
+        return {
+            'clients': [
+                {
+                    'id': row.id,
+                    'name': row.name,
+                    'username': row.username,
+                    'user_id': row.user_id,
+                    'sub_type': row.subscription_type,
+                    'end_date': row.end_date.strftime('%d.%m.%Y') if row.end_date else None
+                }
+                for row in rows
+            ],
+            'total': total_count,
+            'has_prev': has_prev,
+            'has_next': has_next,
+        }
+
+
+def _shift_month(day: date, months: int) -> date:
+    """Та же дата на months месяцев раньше/позже (31-е → последний день месяца)"""
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def _day_expr(column):
+    """Дата без времени (в SQLite CAST AS DATE превращает строку в число)"""
+    if engine.dialect.name == 'sqlite':
+        return func.date(column, type_=Date)
+    return cast(column, Date)
+
+
+def _sales_daily_backfill():
+    """INSERT ... SELECT сводки из всех подтверждённых платежей"""
+    day = _day_expr(func.coalesce(Payment.created_at, Payment.confirmed_at))
+    payment_type = func.coalesce(Payment.payment_type, 'other')
+    return insert(SalesDaily).from_select(
+        ['day', 'payment_type', 'count', 'amount'],
+        select(day, payment_type, func.count(Payment.id), func.coalesce(func.sum(Payment.amount), 0))
+        .where(Payment.status == 'confirmed', day != None)
+        .group_by(day, payment_type)
+    )
+
+
+async def rebuild_sales_daily() -> int:
+    """Пересобрать sales_daily по истории платежей. Возвращает число строк сводки"""
     async with async_session() as session:
+        if engine.dialect.name == 'sqlite':
+            await session.connection(execution_options={'sqlite_begin': 'BEGIN IMMEDIATE'})
+        await session.execute(delete(SalesDaily))
+        await session.execute(_sales_daily_backfill())
+        rows = (await session.execute(select(func.count()).select_from(SalesDaily))).scalar() or 0
+        await session.commit()
+        return rows
+
+
+async def confirm_payment(payment_id: int, session: AsyncSession = None):
+    """Подтвердить платёж и учесть его в sales_daily в одной транзакции.
+
+    Статус меняется условным UPDATE, поэтому повторное подтверждение (двойное
+    нажатие, два админа) ничего не делает. Возвращает Payment или None, если
+    платёж не найден или уже подтверждён.
+    """
+    own = session is None
+    async with session_scope(session) as session:
+        now = datetime.utcnow()
         result = await session.execute(
-            select(User).order_by(User.created_at.desc())
+            update(Payment)
+            .where(Payment.id == payment_id, Payment.status != 'confirmed')
+            .values(status='confirmed', confirmed_at=now)
+            .execution_options(synchronize_session=False)
         )
-        users = result.scalars().all()
+        if result.rowcount != 1:
+            return None
 
-        clients = []
-        for user in users:
-            sub_result = await session.execute(
-                select(Subscription).where(
-                    Subscription.user_id == user.user_id,
-                    Subscription.is_active == True
-                )
-            )
-            sub = sub_result.scalar_one_or_none()
+        payment = (await session.execute(
+            select(Payment).where(Payment.id == payment_id).execution_options(populate_existing=True)
+        )).scalar_one()
+        amount = payment.amount or 0
+        upsert = _dialect_insert(SalesDaily).values(
+            day=(payment.created_at or now).date(),
+            payment_type=payment.payment_type or 'other',
+            count=1,
+            amount=amount,
+        )
+        await session.execute(upsert.on_conflict_do_update(
+            index_elements=['day', 'payment_type'],
+            set_={'count': SalesDaily.count + 1, 'amount': SalesDaily.amount + amount},
+        ))
+        await _commit_if_own(session, own)
+        return payment
 
-            clients.append({
-                'name': user.name,
-                'username': user.username,
-                'user_id': user.user_id,
-                'sub_type': sub.subscription_type if sub else None,
-                'end_date': sub.end_date.strftime('%d.%m.%Y') if sub and sub.end_date else None
-            })
 
-        return clients
+async def get_sales_stats(session: AsyncSession = None):
+    """Статистика продаж за текущий месяц"""
+    stats = await get_detailed_sales_stats(session=session)
+    return {'total_income': stats['total_income'], 'total_sales': stats['total_sales']}
 
 
-async def get_sales_stats():
-    """Статистика продаж за текущий месяц"""
-    async with async_session() as session:
-        now = datetime.utcnow()
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+async def get_detailed_sales_stats(date_from: date = None, date_to: date = None, session: AsyncSession = None):
+    """Статистика продаж по типам за период (по умолчанию — текущий месяц).
 
+    Читается из sales_daily одним запросом вместе с тем же периодом месяцем
+    раньше (сравнение месяц к месяцу). Границы включительно, даты — UTC.
+    """
+    today = datetime.utcnow().date()
+    date_to = date_to or today
+    date_from = date_from or date_to.replace(day=1)
+    prev_from, prev_to = _shift_month(date_from, -1), _shift_month(date_to, -1)
+
+    current = SalesDaily.day.between(date_from, date_to)
+    previous = SalesDaily.day.between(prev_from, prev_to)
+
+    async with session_scope(session) as session:
         result = await session.execute(
             select(
-                func.sum(Payment.amount),
-                func.count(Payment.id)
-            ).where(
-                Payment.status == 'confirmed',
-                Payment.created_at >= month_start
+                SalesDaily.payment_type,
+                func.sum(case((current, SalesDaily.count), else_=0)),
+                func.sum(case((current, SalesDaily.amount), else_=0)),
+                func.sum(case((previous, SalesDaily.count), else_=0)),
+                func.sum(case((previous, SalesDaily.amount), else_=0)),
             )
+            .where(current | previous)
+            .group_by(SalesDaily.payment_type)
         )
-        row = result.one()
+        by_type = {}
+        totals = {'total_income': 0, 'total_sales': 0, 'prev_income': 0, 'prev_sales': 0}
+        for payment_type, count, amount, prev_count, prev_amount in result.all():
+            if count:
+                by_type[payment_type] = {'count': count, 'amount': amount}
+            totals['total_income'] += amount or 0
+            totals['total_sales'] += count or 0
+            totals['prev_income'] += prev_amount or 0
+            totals['prev_sales'] += prev_count or 0
+
+        counts = (await session.execute(
+            select(
+                select(func.count(User.id)).scalar_subquery(),
+                select(func.count(Subscription.id)).where(Subscription.is_active == True).scalar_subquery(),
+            )
+        )).one()
+
+    return {
+        **totals,
+        'by_type': dict(sorted(by_type.items(), key=lambda item: -item[1]['amount'])),
+        'date_from': date_from,
+        'date_to': date_to,
+        'prev_from': prev_from,
+        'prev_to': prev_to,
+        'total_users': counts[0] or 0,
+        'active_subscriptions': counts[1] or 0,
+    }
+
+
+# ============== ПОИСК КЛИЕНТОВ ==============
+
+# FTS5-индекс (trigram) по users.name/username/phone — создаёт миграция, только SQLite
+USERS_SEARCH_TABLE = 'users_search'
+SEARCH_MIN_WORD = 3  # trigram находит подстроки от трёх символов
+
+_search_index = {'available': None}
+
+
+async def _has_search_index(session: AsyncSession) -> bool:
+    if _search_index['available'] is None:
+        _search_index['available'] = engine.dialect.name == 'sqlite' and bool((await session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': USERS_SEARCH_TABLE}
+        )).first())
+    return _search_index['available']
+
+
+def _like_filter(word: str):
+    return or_(
+        User.name.icontains(word, autoescape=True),
+        User.username.icontains(word, autoescape=True),
+        User.phone.icontains(word, autoescape=True),
+    )
+
+
+def _short_word_filter(word: str):
+    """Подстрока без учёта регистра для коротких слов: lower() в SQLite не понимает
+    кириллицу, поэтому перебираем все варианты регистра (не больше 4 для 2 символов)"""
+    variants = {""}
+    for char in word:
+        variants = {prefix + case for prefix in variants for case in {char.lower(), char.upper()}}
+    return or_(*(
+        column.contains(variant, autoescape=True)
+        for variant in sorted(variants)
+        for column in (User.name, User.username, User.phone)
+    ))
+
+
+def _client_row(user) -> dict:
+    return {
+        'user_id': user.user_id,
+        'name': user.name,
+        'username': user.username,
+        'phone': user.phone,
+    }
+
+
+async def search_clients(query: str, limit: int = 10, session: AsyncSession = None) -> list:
+    """Поиск клиентов по имени, username и телефону (все слова запроса — подстроки), новые сверху.
+
+    В SQLite слова от трёх символов ищутся по FTS5-индексу, короткие — LIKE среди
+    найденных; в остальных СУБД — ILIKE (с индексами pg_trgm, если они есть).
+    """
+    words = [word.lstrip('@') for word in query.split()]
+    words = [word for word in words if word]
+    if not words:
+        return []
+
+    async with session_scope(session) as session:
+        long_words = [word for word in words if len(word) >= SEARCH_MIN_WORD]
+
+        if long_words and await _has_search_index(session):
+            # FTS5 отдаёт rowid по убыванию без сортировки всех совпадений,
+            # поэтому просмотр обрывается, как только набрано limit клиентов
+            match = " ".join('"' + word.replace('"', '""') + '"' for word in long_words)
+            found = text(
+                f"SELECT rowid AS id FROM {USERS_SEARCH_TABLE} "
+                f"WHERE {USERS_SEARCH_TABLE} MATCH :match"
+            ).bindparams(match=match).columns(id=Integer).subquery()
+            stmt = select(User).join(found, found.c.id == User.id).order_by(found.c.id.desc())
+            for word in words:
+                if len(word) < SEARCH_MIN_WORD:
+                    stmt = stmt.where(_short_word_filter(word))
+        else:
+            stmt = select(User).order_by(User.id.desc())
+            for word in words:
+                stmt = stmt.where(_like_filter(word))
+
+        users = (await session.execute(stmt.limit(limit))).scalars().all()
+        return [_client_row(user) for user in users]
+
+
+async def get_client_card(user_id: int, session: AsyncSession = None):
+    """Карточка клиента для админа одним запросом: профиль, активный абонемент,
+    последнее посещение и предстоящие записи. None, если клиента нет"""
+    async with session_scope(session) as session:
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        latest_sub = select(
+            Subscription.user_id,
+            Subscription.subscription_type,
+            Subscription.end_date,
+            func.row_number().over(order_by=Subscription.end_date.desc()).label('rn')
+        ).where(Subscription.user_id == user_id, Subscription.is_active == True).subquery()
+
+        open_bookings = select(
+            Booking.user_id,
+            Booking.booking_date,
+            Training.name.label('training_name'),
+            Training.trainer,
+            Training.time,
+        ).join(Training, Booking.training_id == Training.id).where(
+            Booking.user_id == user_id,
+            Booking.status == 'active',
+            Booking.booking_date >= today
+        ).subquery()
+
+        rows = (await session.execute(
+            select(
+                User,
+                latest_sub.c.subscription_type,
+                latest_sub.c.end_date,
+                open_bookings.c.booking_date,
+                open_bookings.c.training_name,
+                open_bookings.c.trainer,
+                open_bookings.c.time,
+            )
+            .outerjoin(latest_sub, and_(latest_sub.c.user_id == User.user_id, latest_sub.c.rn == 1))
+            .outerjoin(open_bookings, open_bookings.c.user_id == User.user_id)
+            .where(User.user_id == user_id)
+            .order_by(open_bookings.c.booking_date, open_bookings.c.time)
+        )).all()
+
+        if not rows:
+            return None
 
+        user, first = rows[0].User, rows[0]
         return {
-            'total_income': row[0] or 0,
-            'total_sales': row[1] or 0
+            'user_id': user.user_id,
+            'name': user.name,
+            'username': user.username,
+            'phone': user.phone,
+            'reg_date': user.created_at,
+            'is_active': user.is_active,
+            'last_visit': user.last_visit_at,
+            'subscription': {
+                'type': first.subscription_type,
+                'end_date': first.end_date,
+            } if first.subscription_type else None,
+            'bookings': [
+                {
+                    'booking_date': row.booking_date,
+                    'training_name': row.training_name,
+                    'trainer': row.trainer,
+                    'training_time': row.time,
+                }
+                for row in rows if row.booking_date is not None
+            ],
         }
 
 
-async def get_user_payments(user_id: int):
+async def get_user_payments(user_id: int, session: AsyncSession = None):
     """Получение истории платежей пользователя"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         result = await session.execute(
             select(Payment).where(
                 Payment.user_id == user_id
@@ -214,9 +793,9 @@ async def get_user_payments(user_id: int):
         ]
 
 
-async def get_user_visits(user_id: int):
+async def get_user_visits(user_id: int, session: AsyncSession = None):
     """Получение истории посещений пользователя"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         result = await session.execute(
             select(Visit, Training).join(
                 Training, Visit.training_id == Training.id
@@ -236,181 +815,421 @@ async def get_user_visits(user_id: int):
         ]
 
 
-async def get_users_for_broadcast(segment: str = 'all'):
+def _table_export_query(kind: str):
+    """Запрос полной выгрузки для админа: clients, payments или bookings"""
+    if kind == 'clients':
+        latest_sub = (
+            select(Subscription.user_id, func.max(Subscription.end_date).label('end_date'))
+            .where(Subscription.is_active == True)
+            .group_by(Subscription.user_id)
+            .subquery()
+        )
+        return (
+            select(User.user_id, User.name, User.username, User.phone, User.created_at,
+                   User.is_active, User.last_visit_at, latest_sub.c.end_date)
+            .outerjoin(latest_sub, latest_sub.c.user_id == User.user_id)
+            .order_by(User.id)
+        )
+    if kind == 'payments':
+        return (
+            select(Payment.id, Payment.user_id, User.name, User.username, Payment.payment_type,
+                   Payment.amount, Payment.status, Payment.created_at, Payment.confirmed_at)
+            .outerjoin(User, User.user_id == Payment.user_id)
+            .order_by(Payment.id)
+        )
+    if kind == 'bookings':
+        return (
+            select(Booking.id, Booking.user_id, User.name, User.username,
+                   Training.name.label('training_name'), Training.trainer,
+                   Booking.booking_date, Booking.status, Booking.created_at)
+            .outerjoin(User, User.user_id == Booking.user_id)
+            .outerjoin(Training, Training.id == Booking.training_id)
+            .order_by(Booking.id)
+        )
+    raise ValueError(f"Неизвестная выгрузка: {kind}")
+
+
+async def iter_table_export(kind: str, batch_size: int = 1000):
+    """Полная выгрузка таблицы пачками по batch_size строк (серверный курсор, yield_per)"""
+    query = _table_export_query(kind).execution_options(yield_per=batch_size)
+    async with async_session() as session:
+        result = await session.stream(query)
+        async for batch in result.partitions():
+            yield [tuple(row) for row in batch]
+
+
+# Порядок разделов в экспорте данных пользователя
+USER_HISTORY_KINDS = ('subscription', 'payment', 'booking', 'visit')
+
+
+async def iter_user_history(user_id: int, batch_size: int = 500):
+    """История пользователя для экспорта — один запрос UNION ALL, читается пачками.
+
+    Отдаёт словари {kind, date, title, status, amount} по разделам
+    USER_HISTORY_KINDS, внутри раздела — по дате.
+    """
+    order = {kind: number for number, kind in enumerate(USER_HISTORY_KINDS)}
+    history = union_all(
+        select(
+            literal(order['subscription']).label('kind_order'),
+            literal('subscription').label('kind'),
+            Subscription.end_date.label('date'),
+            Subscription.subscription_type.label('title'),
+            case((Subscription.is_active == True, 'active'), else_='expired').label('status'),
+            literal(None, Float).label('amount'),
+        ).where(Subscription.user_id == user_id),
+        select(
+            literal(order['payment']), literal('payment'), Payment.created_at,
+            Payment.payment_type, Payment.status, Payment.amount,
+        ).where(Payment.user_id == user_id),
+        select(
+            literal(order['booking']), literal('booking'), Booking.booking_date,
+            Training.name, Booking.status, literal(None, Float),
+        ).outerjoin(Training, Booking.training_id == Training.id).where(Booking.user_id == user_id),
+        select(
+            literal(order['visit']), literal('visit'), Visit.visit_date,
+            Training.name, literal(None, String), literal(None, Float),
+        ).outerjoin(Training, Visit.training_id == Training.id).where(Visit.user_id == user_id),
+    ).subquery()
+
+    query = (
+        select(history.c.kind, history.c.date, history.c.title, history.c.status, history.c.amount)
+        .order_by(history.c.kind_order, history.c.date)
+        .execution_options(yield_per=batch_size)
+    )
+    async with async_session() as session:
+        result = await session.stream(query)
+        async for row in result:
+            yield dict(row._mapping)
+
+
+def _broadcast_segment_query(segment: str = 'all'):
+    """Запрос user_id получателей рассылки по сегменту"""
+    if segment == 'with_sub':
+        # Только с активным абонементом
+        return select(User.user_id).join(
+            Subscription, User.user_id == Subscription.user_id
+        ).where(
+            User.is_active == True,
+            Subscription.is_active == True
+        ).distinct()
+    if segment == 'without_sub':
+        # Без абонемента
+        subquery = select(Subscription.user_id).where(Subscription.is_active == True)
+        return select(User.user_id).where(
+            User.is_active == True,
+            ~User.user_id.in_(subquery)
+        )
+    # Все пользователи
+    return select(User.user_id).where(User.is_active == True)
+
+
+async def get_users_for_broadcast(segment: str = 'all', session: AsyncSession = None):
     """Получение списка пользователей для рассылки по сегменту"""
+    async with session_scope(session) as session:
+        result = await session.execute(_broadcast_segment_query(segment))
+        return [row[0] for row in result.all()]
+
+
+async def create_broadcast(segment: str, text: str, admin_chat_id: int, admin_message_id: int):
+    """Создать рассылку и зафиксировать список получателей. Возвращает (id, кол-во получателей)."""
     async with async_session() as session:
-        if segment == 'all':
-            # Все пользователи
-            result = await session.execute(
-                select(User.user_id).where(User.is_active == True)
-            )
-        elif segment == 'with_sub':
-            # Только с активным абонементом
-            result = await session.execute(
-                select(User.user_id).join(
-                    Subscription, User.user_id == Subscription.user_id
-                ).where(
-                    User.is_active == True,
-                    Subscription.is_active == True
-                )
-            )
-        elif segment == 'without_sub':
-            # Без абонемента
-            subquery = select(Subscription.user_id).where(Subscription.is_active == True)
-            result = await session.execute(
-                select(User.user_id).where(
-                    User.is_active == True,
-                    ~User.user_id.in_(subquery)
-                )
-            )
-        else:
-            result = await session.execute(
-                select(User.user_id).where(User.is_active == True)
+        broadcast = Broadcast(
+            segment=segment,
+            text=text,
+            status='running',
+            admin_chat_id=admin_chat_id,
+            admin_message_id=admin_message_id
+        )
+        session.add(broadcast)
+        await session.flush()
+
+        recipients = _broadcast_segment_query(segment).subquery()
+        await session.execute(
+            insert(BroadcastRecipient).from_select(
+                ['broadcast_id', 'user_id', 'status'],
+                select(literal(broadcast.id), recipients.c.user_id, literal('pending'))
             )
+        )
+        total = (await session.execute(
+            select(func.count(BroadcastRecipient.id)).where(BroadcastRecipient.broadcast_id == broadcast.id)
+        )).scalar() or 0
 
-        return [row[0] for row in result.all()]
+        if not total:
+            broadcast.status = 'done'
+            broadcast.finished_at = datetime.utcnow()
+
+        await session.commit()
+        return broadcast.id, total
 
 
-async def get_detailed_sales_stats():
-    """Детальная статистика продаж по типам продуктов"""
+async def get_broadcast(broadcast_id: int):
+    """Данные рассылки по id"""
     async with async_session() as session:
-        now = datetime.utcnow()
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        broadcast = await session.get(Broadcast, broadcast_id)
+        if not broadcast:
+            return None
+        return {
+            'id': broadcast.id,
+            'segment': broadcast.segment,
+            'text': broadcast.text,
+            'status': broadcast.status,
+            'admin_chat_id': broadcast.admin_chat_id,
+            'admin_message_id': broadcast.admin_message_id,
+        }
+
 
-        # Получаем все подтверждённые платежи за месяц
+# Новый статус рассылки → из каких статусов в него можно перейти.
+# Завершённую или отменённую рассылку уже не возобновить (устаревшие кнопки)
+BROADCAST_TRANSITIONS = {
+    'running': ('paused',),
+    'paused': ('running',),
+    'cancelled': ('running', 'paused'),
+    'done': ('running',),
+}
+
+
+async def set_broadcast_status(broadcast_id: int, status: str) -> bool:
+    """Сменить статус рассылки (running, paused, cancelled, done).
+
+    Условный UPDATE по BROADCAST_TRANSITIONS: False, если из текущего статуса
+    переход недопустим (рассылка уже завершена, уже на паузе и т.п.)
+    """
+    async with async_session() as session:
+        values = {'status': status}
+        if status in ('cancelled', 'done'):
+            values['finished_at'] = datetime.utcnow()
         result = await session.execute(
-            select(Payment).where(
-                Payment.status == 'confirmed',
-                Payment.created_at >= month_start
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status.in_(BROADCAST_TRANSITIONS[status]))
+            .values(**values)
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def get_pending_recipients(broadcast_id: int, limit: int = 100):
+    """Очередная пачка неотправленных получателей: [(recipient_id, user_id), ...]"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(BroadcastRecipient.id, BroadcastRecipient.user_id).where(
+                BroadcastRecipient.broadcast_id == broadcast_id,
+                BroadcastRecipient.status == 'pending'
+            ).order_by(BroadcastRecipient.id).limit(limit)
+        )
+        return [(row[0], row[1]) for row in result.all()]
+
+
+async def mark_broadcast_recipient(recipient_id: int, status: str, error: str = None):
+    """Записать результат доставки одному получателю"""
+    async with async_session() as session:
+        await session.execute(
+            update(BroadcastRecipient).where(BroadcastRecipient.id == recipient_id).values(
+                status=status,
+                error=error,
+                sent_at=datetime.utcnow() if status == 'sent' else None
             )
         )
-        payments = result.scalars().all()
+        await session.commit()
 
-        # Группируем по типу продукта
-        stats_by_type = {}
-        total_income = 0
-        total_count = 0
 
-        for p in payments:
-            p_type = p.payment_type or 'other'
-            if p_type not in stats_by_type:
-                stats_by_type[p_type] = {'count': 0, 'amount': 0}
-            stats_by_type[p_type]['count'] += 1
-            stats_by_type[p_type]['amount'] += p.amount or 0
-            total_income += p.amount or 0
-            total_count += 1
+async def get_broadcast_progress(broadcast_id: int):
+    """Прогресс рассылки: количество получателей по статусам"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(BroadcastRecipient.status, func.count(BroadcastRecipient.id)).where(
+                BroadcastRecipient.broadcast_id == broadcast_id
+            ).group_by(BroadcastRecipient.status)
+        )
+        progress = {'pending': 0, 'sent': 0, 'failed': 0}
+        for status, count in result.all():
+            progress[status] = count
+        progress['total'] = sum(progress.values())
+        return progress
 
-        # Общее количество клиентов
-        users_result = await session.execute(select(func.count(User.id)))
-        total_users = users_result.scalar() or 0
 
-        # Клиенты с активным абонементом
-        active_subs_result = await session.execute(
-            select(func.count(Subscription.id)).where(Subscription.is_active == True)
+async def get_unfinished_broadcasts():
+    """id рассылок, прерванных перезапуском (status='running')"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(Broadcast.id).where(Broadcast.status == 'running').order_by(Broadcast.id)
         )
-        active_subscriptions = active_subs_result.scalar() or 0
+        return [row[0] for row in result.all()]
 
-        return {
-            'total_income': total_income,
-            'total_sales': total_count,
-            'by_type': stats_by_type,
-            'total_users': total_users,
-            'active_subscriptions': active_subscriptions
-        }
 
+async def sync_trainings(slots: list) -> dict:
+    """Привести таблицу trainings к расписанию студии.
 
-async def seed_trainings():
-    """Заполнить таблицу Training 19 записями расписания (идемпотентно)"""
-    schedule = [
-        # Силовая тренировка — тренер Анна
-        {"name": "Силовая тренировка", "trainer": "Анна", "day_of_week": 0, "time": "08:30", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Анна", "day_of_week": 0, "time": "17:10", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Анна", "day_of_week": 0, "time": "18:10", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Анна", "day_of_week": 2, "time": "08:30", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Анна", "day_of_week": 2, "time": "17:10", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Анна", "day_of_week": 2, "time": "18:10", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Анна", "day_of_week": 4, "time": "08:30", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Анна", "day_of_week": 4, "time": "17:10", "max_participants": 28},
-        # Силовая тренировка — тренер Алена
-        {"name": "Силовая тренировка", "trainer": "Алена", "day_of_week": 0, "time": "19:10", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Алена", "day_of_week": 0, "time": "20:10", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Алена", "day_of_week": 2, "time": "19:10", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Алена", "day_of_week": 2, "time": "20:10", "max_participants": 28},
-        {"name": "Силовая тренировка", "trainer": "Алена", "day_of_week": 4, "time": "19:10", "max_participants": 28},
-        # Пилатес с роллом и досками Садху — тренер Анна
-        {"name": "Пилатес с роллом и досками Садху", "trainer": "Анна", "day_of_week": 0, "time": "09:30", "max_participants": 28},
-        {"name": "Пилатес с роллом и досками Садху", "trainer": "Анна", "day_of_week": 2, "time": "09:30", "max_participants": 28},
-        {"name": "Пилатес с роллом и досками Садху", "trainer": "Анна", "day_of_week": 4, "time": "09:30", "max_participants": 28},
-        # Барре — тренер Анна
-        {"name": "Барре", "trainer": "Анна", "day_of_week": 1, "time": "08:30", "max_participants": 28},
-        {"name": "Барре", "trainer": "Анна", "day_of_week": 3, "time": "08:30", "max_participants": 28},
-        {"name": "Барре", "trainer": "Анна", "day_of_week": 5, "time": "10:00", "max_participants": 28},
-    ]
+    slots — [{name, trainer, day_of_week, time}] (см. utils.schedule.schedule_slots).
+    Один SELECT и пакетные INSERT/UPDATE: новые слоты добавляются, пропавшие
+    помечаются is_active=False (записи на них остаются), вернувшиеся — включаются.
+    Возвращает {'added', 'enabled', 'disabled'}.
+    """
+    wanted = {(s["name"], s["trainer"], s["day_of_week"], s["time"]) for s in slots}
+    stats = {'added': 0, 'enabled': 0, 'disabled': 0}
 
     async with async_session() as session:
-        # Проверяем, есть ли уже тренировки
         result = await session.execute(
-            select(func.count(Training.id)).where(Training.training_type == 'studio')
-        )
-        count = result.scalar()
-        if count and count >= 19:
-            return  # Уже заполнено
-
-        for item in schedule:
-            # Проверяем существование конкретной записи
-            exists = await session.execute(
-                select(Training).where(
-                    Training.name == item["name"],
-                    Training.trainer == item["trainer"],
-                    Training.day_of_week == item["day_of_week"],
-                    Training.time == item["time"],
-                    Training.training_type == 'studio'
-                )
-            )
-            if exists.scalar_one_or_none() is None:
-                training = Training(
-                    name=item["name"],
-                    description=f'{item["name"]} — тренер {item["trainer"]}',
-                    trainer=item["trainer"],
-                    day_of_week=item["day_of_week"],
-                    time=item["time"],
-                    duration=60,
-                    max_participants=item["max_participants"],
-                    training_type='studio'
-                )
-                session.add(training)
+            select(Training.id, Training.name, Training.trainer, Training.day_of_week,
+                   Training.time, Training.is_active, Training.max_participants)
+            .where(Training.training_type == 'studio')
+        )
+        existing = {}
+        changes = []
+        for row in result:
+            key = (row.name, row.trainer, row.day_of_week, row.time)
+            if key in existing:
+                continue  # дубль слота — оставляем первую запись
+            existing[key] = row.id
+            is_active = key in wanted
+            if row.is_active != is_active or (is_active and row.max_participants != config.MAX_PEOPLE_PER_CLASS):
+                changes.append({
+                    "id": row.id,
+                    "is_active": is_active,
+                    "max_participants": config.MAX_PEOPLE_PER_CLASS if is_active else row.max_participants,
+                })
+                if is_active and not row.is_active:
+                    stats['enabled'] += 1
+                elif not is_active and row.is_active is not False:
+                    stats['disabled'] += 1
+
+        new_rows = [
+            {
+                "name": name,
+                "description": f"{name} — тренер {trainer}",
+                "trainer": trainer,
+                "day_of_week": day_of_week,
+                "time": time,
+                "duration": 60,
+                "max_participants": config.MAX_PEOPLE_PER_CLASS,
+                "training_type": 'studio',
+                "is_active": True,
+            }
+            for name, trainer, day_of_week, time in sorted(wanted - existing.keys())
+        ]
+        stats['added'] = len(new_rows)
+
+        if not new_rows and not changes:
+            return stats
 
+        if new_rows:
+            await session.execute(insert(Training), new_rows)
+        if changes:
+            await session.execute(update(Training), changes)
         await session.commit()
 
+    invalidate_training_cache()
+    return stats
 
-async def get_trainings_by_filter(name: str, trainer: str = None, day_of_week: int = None):
-    """Поиск тренировок по фильтру"""
+
+class TrainingCache:
+    """Кэш расписания студии в памяти.
+
+    Таблица trainings меняется только при синхронизации расписания, поэтому
+    кэш сбрасывается явно (invalidate_training_cache) и, на всякий случай, по TTL.
+    Объекты Training в кэше общие — их нельзя изменять.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._by_id = {}
+        self._by_key = {}  # (name, trainer|None, day_of_week|None) -> [Training]
+        self._names = []
+        self._loaded_at = None
+
+    def is_fresh(self) -> bool:
+        return self._loaded_at is not None and (datetime.utcnow() - self._loaded_at).total_seconds() < self.ttl
+
+    def fill(self, trainings: list):
+        by_id = {}
+        by_key = {}
+        for t in trainings:
+            by_id[t.id] = t
+            for trainer in (t.trainer, None):
+                for day_of_week in (t.day_of_week, None):
+                    by_key.setdefault((t.name, trainer, day_of_week), []).append(t)
+        self._by_id = by_id
+        self._by_key = by_key
+        self._names = sorted({t.name for t in trainings})
+        self._loaded_at = datetime.utcnow()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def get(self, training_id: int):
+        return self._by_id.get(training_id)
+
+    def find(self, name_prefix: str, trainer: str = None, day_of_week: int = None) -> list:
+        found = []
+        for name in self._names:
+            if name.startswith(name_prefix):
+                found.extend(self._by_key.get((name, trainer or None, day_of_week), []))
+        return sorted(found, key=lambda t: t.time)
+
+
+_training_cache = TrainingCache(config.TRAINING_CACHE_TTL)
+
+
+async def load_training_cache():
+    """Загрузить все тренировки студии в кэш (один запрос)"""
     async with async_session() as session:
-        query = select(Training).where(
-            Training.name.startswith(name),
-            Training.training_type == 'studio'
+        result = await session.execute(
+            select(Training)
+            .where(Training.training_type == 'studio', Training.is_active == True)
+            .order_by(Training.time)
         )
-        if trainer:
-            query = query.where(Training.trainer == trainer)
-        if day_of_week is not None:
-            query = query.where(Training.day_of_week == day_of_week)
-        query = query.order_by(Training.time)
-        result = await session.execute(query)
-        return result.scalars().all()
+        _training_cache.fill(result.scalars().all())
 
 
-async def get_training_by_id(training_id: int):
-    """Получить тренировку по ID"""
-    async with async_session() as session:
+def invalidate_training_cache():
+    """Сбросить кэш расписания — вызывать после любого изменения trainings"""
+    _training_cache.invalidate()
+
+
+def get_training_cache_stats():
+    """Счётчики попаданий/промахов кэша расписания"""
+    return {'hits': _training_cache.hits, 'misses': _training_cache.misses}
+
+
+async def _ensure_training_cache():
+    if not _training_cache.is_fresh():
+        _training_cache.misses += 1
+        await load_training_cache()
+        return False
+    return True
+
+
+async def get_trainings_by_filter(name: str, trainer: str = None, day_of_week: int = None):
+    """Поиск тренировок студии по фильтру (из кэша расписания)"""
+    if await _ensure_training_cache():
+        _training_cache.hits += 1
+    return _training_cache.find(name, trainer, day_of_week)
+
+
+async def get_training_by_id(training_id: int, session: AsyncSession = None):
+    """Получить тренировку по ID (тренировки студии — из кэша)"""
+    fresh = await _ensure_training_cache()
+    training = _training_cache.get(training_id)
+    if training is not None:
+        if fresh:
+            _training_cache.hits += 1
+        return training
+    if fresh:
+        _training_cache.misses += 1
+
+    # Не студийная тренировка — читаем из БД
+    async with session_scope(session) as session:
         result = await session.execute(
             select(Training).where(Training.id == training_id)
         )
         return result.scalar_one_or_none()
 
 
-async def get_bookings_count(training_id: int, booking_date: datetime):
+async def get_bookings_count(training_id: int, booking_date: datetime, session: AsyncSession = None):
     """Сколько записей на конкретную дату"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         # Сравниваем по дате (без учёта времени)
         date_start = booking_date.replace(hour=0, minute=0, second=0, microsecond=0)
         date_end = date_start + timedelta(days=1)
@@ -425,9 +1244,32 @@ async def get_bookings_count(training_id: int, booking_date: datetime):
         return result.scalar() or 0
 
 
-async def check_user_booking(user_id: int, training_id: int, booking_date: datetime):
+async def get_slot_occupancy(training_ids: list, booking_date: datetime, days: int = 1, session: AsyncSession = None):
+    """Занятые места по тренировкам за days дней начиная с даты — один GROUP BY.
+
+    Каждая тренировка проходит раз в неделю, поэтому при days <= 7 у каждой
+    training_id в окне ровно одна дата и группировки по training_id достаточно.
+    Возвращает {training_id: количество активных записей}.
+    """
+    if not training_ids:
+        return {}
+    async with session_scope(session) as session:
+        date_start = booking_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        date_end = date_start + timedelta(days=days)
+        result = await session.execute(
+            select(Booking.training_id, func.count(Booking.id)).where(
+                Booking.training_id.in_(training_ids),
+                Booking.status == 'active',
+                Booking.booking_date >= date_start,
+                Booking.booking_date < date_end
+            ).group_by(Booking.training_id)
+        )
+        return {training_id: count for training_id, count in result.all()}
+
+
+async def check_user_booking(user_id: int, training_id: int, booking_date: datetime, session: AsyncSession = None):
     """Проверка двойной записи"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         date_start = booking_date.replace(hour=0, minute=0, second=0, microsecond=0)
         date_end = date_start + timedelta(days=1)
         result = await session.execute(
@@ -442,9 +1284,10 @@ async def check_user_booking(user_id: int, training_id: int, booking_date: datet
         return result.scalar_one_or_none()
 
 
-async def create_booking(user_id: int, training_id: int, booking_date: datetime):
+async def create_booking(user_id: int, training_id: int, booking_date: datetime, session: AsyncSession = None):
     """Создать запись на тренировку"""
-    async with async_session() as session:
+    own = session is None
+    async with session_scope(session) as session:
         booking = Booking(
             user_id=user_id,
             training_id=training_id,
@@ -452,13 +1295,100 @@ async def create_booking(user_id: int, training_id: int, booking_date: datetime)
             status='active'
         )
         session.add(booking)
-        await session.commit()
+        await _commit_if_own(session, own)
         return booking
 
 
-async def get_user_active_bookings(user_id: int):
-    """Все активные записи пользователя (дата >= сегодня)"""
+class ReserveStatus(Enum):
+    """Результат попытки записи на тренировку"""
+    RESERVED = 'reserved'
+    ALREADY_BOOKED = 'already_booked'
+    FULL = 'full'
+    UNAVAILABLE = 'unavailable'  # тренировка удалена или снята с расписания
+
+
+_sqlite_reserve_lock = asyncio.Lock()
+
+
+@dataclass
+class ReserveResult:
+    status: ReserveStatus
+    booked: int = 0  # занято мест на слоте (с учётом новой записи)
+    booking_id: int = None
+
+
+async def reserve_seat(user_id: int, training_id: int, booking_datetime: datetime) -> ReserveResult:
+    """Атомарная запись на тренировку: проверка дубля, мест и вставка в одной транзакции.
+
+    SQLite: транзакция открывается BEGIN IMMEDIATE, конкурентные записи ждут
+    друг друга. Другие СУБД: строка тренировки блокируется SELECT ... FOR UPDATE.
+    Повторная активная запись дополнительно запрещена уникальным индексом.
+    """
+    if engine.dialect.name == 'sqlite':
+        # Внутри процесса выстраиваем записи в очередь, чтобы не крутиться
+        # в busy-ожидании SQLite; BEGIN IMMEDIATE защищает от других процессов
+        async with _sqlite_reserve_lock:
+            return await _reserve_seat(user_id, training_id, booking_datetime)
+    return await _reserve_seat(user_id, training_id, booking_datetime)
+
+
+async def _reserve_seat(user_id: int, training_id: int, booking_datetime: datetime) -> ReserveResult:
+    date_start = booking_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
+    date_end = date_start + timedelta(days=1)
+
     async with async_session() as session:
+        try:
+            if engine.dialect.name == 'sqlite':
+                await session.connection(execution_options={'sqlite_begin': 'BEGIN IMMEDIATE'})
+                training = await session.get(Training, training_id)
+            else:
+                training = (await session.execute(
+                    select(Training).where(Training.id == training_id).with_for_update()
+                )).scalar_one_or_none()
+
+            if not training or not training.is_active:
+                return ReserveResult(ReserveStatus.UNAVAILABLE)
+
+            existing = (await session.execute(
+                select(Booking.id).where(
+                    Booking.user_id == user_id,
+                    Booking.training_id == training_id,
+                    Booking.status == 'active',
+                    Booking.booking_date >= date_start,
+                    Booking.booking_date < date_end
+                ).limit(1)
+            )).scalar()
+            booked = (await session.execute(
+                select(func.count(Booking.id)).where(
+                    Booking.training_id == training_id,
+                    Booking.status == 'active',
+                    Booking.booking_date >= date_start,
+                    Booking.booking_date < date_end
+                )
+            )).scalar() or 0
+
+            if existing:
+                return ReserveResult(ReserveStatus.ALREADY_BOOKED, booked)
+            if booked >= training.max_participants:
+                return ReserveResult(ReserveStatus.FULL, booked)
+
+            booking = Booking(
+                user_id=user_id,
+                training_id=training_id,
+                booking_date=booking_datetime,
+                status='active'
+            )
+            session.add(booking)
+            await session.commit()
+            return ReserveResult(ReserveStatus.RESERVED, booked + 1, booking.id)
+        except IntegrityError:
+            await session.rollback()
+            return ReserveResult(ReserveStatus.ALREADY_BOOKED)
+
+
+async def get_user_active_bookings(user_id: int, session: AsyncSession = None):
+    """Все активные записи пользователя (дата >= сегодня)"""
+    async with session_scope(session) as session:
         now = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         result = await session.execute(
             select(Booking, Training)
@@ -483,9 +1413,10 @@ async def get_user_active_bookings(user_id: int):
         ]
 
 
-async def cancel_booking(booking_id: int, user_id: int):
+async def cancel_booking(booking_id: int, user_id: int, session: AsyncSession = None):
     """Отменить запись (status='cancelled'). Возвращает данные записи или None."""
-    async with async_session() as session:
+    own = session is None
+    async with session_scope(session) as session:
         result = await session.execute(
             select(Booking, Training)
             .join(Training, Booking.training_id == Training.id)
@@ -501,7 +1432,7 @@ async def cancel_booking(booking_id: int, user_id: int):
 
         booking = await session.get(Booking, row.Booking.id)
         booking.status = 'cancelled'
-        await session.commit()
+        await _commit_if_own(session, own)
 
         return {
             'booking_id': row.Booking.id,
@@ -512,9 +1443,9 @@ async def cancel_booking(booking_id: int, user_id: int):
         }
 
 
-async def get_today_bookings():
+async def get_today_bookings(session: AsyncSession = None):
     """Все записи на сегодня, сгруппированные по тренировке"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         now = datetime.now()
         date_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
         date_end = date_start + timedelta(days=1)
@@ -553,9 +1484,9 @@ async def get_today_bookings():
         return list(grouped.values())
 
 
-async def get_recent_payments(limit: int = 15):
+async def get_recent_payments(limit: int = 15, session: AsyncSession = None):
     """Последние подтверждённые платежи с именами пользователей"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         result = await session.execute(
             select(Payment, User)
             .join(User, Payment.user_id == User.user_id)
@@ -576,9 +1507,9 @@ async def get_recent_payments(limit: int = 15):
         ]
 
 
-async def get_recent_bookings(limit: int = 15):
+async def get_recent_bookings(limit: int = 15, session: AsyncSession = None):
     """Последние записи на тренировки с именами пользователей"""
-    async with async_session() as session:
+    async with session_scope(session) as session:
         result = await session.execute(
             select(Booking, User, Training)
             .join(User, Booking.user_id == User.user_id)
@@ -598,20 +1529,640 @@ async def get_recent_bookings(limit: int = 15):
         ]
 
 
-async def mark_visit(booking_id: int, user_id: int, training_id: int):
+async def mark_visit(booking_id: int, user_id: int, training_id: int, session: AsyncSession = None):
     """Отметить посещение: создаёт Visit, ставит booking.status='completed'"""
-    async with async_session() as session:
+    own = session is None
+    async with session_scope(session) as session:
         booking = await session.get(Booking, booking_id)
         if not booking or booking.status != 'active':
             return False
 
         booking.status = 'completed'
 
+        visit_date = datetime.now()
         visit = Visit(
             user_id=user_id,
             training_id=training_id,
-            visit_date=datetime.now()
+            visit_date=visit_date
         )
         session.add(visit)
+        await session.execute(
+            update(User)
+            .where(
+                User.user_id == user_id,
+                (User.last_visit_at == None) | (User.last_visit_at < visit_date)
+            )
+            .values(last_visit_at=visit_date)
+        )
+        await _commit_if_own(session, own)
+        return True
+
+# ============== FSM-ХРАНИЛИЩЕ ==============
+
+async def load_fsm_state(key: tuple, ttl: int):
+    """Загрузить состояние FSM по ключу (bot, chat, user, thread, destiny).
+    Возвращает (state, data_json) или None, если записи нет или она устарела.
+
+    Читается на каждое обновление — поэтому соединение без ORM-сессии."""
+    bot_id, chat_id, user_id, thread_id, destiny = key
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            select(FSMState.state, FSMState.data).where(
+                FSMState.bot_id == bot_id,
+                FSMState.chat_id == chat_id,
+                FSMState.user_id == user_id,
+                FSMState.thread_id == thread_id,
+                FSMState.destiny == destiny,
+                FSMState.updated_at >= datetime.utcnow() - timedelta(seconds=ttl)
+            )
+        )
+        row = result.first()
+        return (row.state, row.data) if row else None
+
+
+async def save_fsm_states(records: list):
+    """Сохранить пачку состояний FSM одной транзакцией.
+    records: [(key, state, data_json)]; пустые состояния удаляются."""
+    now = datetime.utcnow()
+    upserts = []
+    deletes = []
+    for (bot_id, chat_id, user_id, thread_id, destiny), state, data in records:
+        key = dict(bot_id=bot_id, chat_id=chat_id, user_id=user_id, thread_id=thread_id, destiny=destiny)
+        if state is None and data is None:
+            deletes.append(key)
+        else:
+            upserts.append(dict(key, state=state, data=data, updated_at=now))
+
+    async with engine.begin() as conn:
+        if upserts:
+            stmt = _dialect_insert(FSMState)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['bot_id', 'chat_id', 'user_id', 'thread_id', 'destiny'],
+                set_={'state': stmt.excluded.state, 'data': stmt.excluded.data, 'updated_at': stmt.excluded.updated_at}
+            )
+            await conn.execute(stmt, upserts)
+        for key in deletes:
+            await conn.execute(
+                FSMState.__table__.delete().where(*(
+                    FSMState.__table__.c[name] == value for name, value in key.items()
+                ))
+            )
+
+
+async def delete_expired_fsm_states(ttl: int):
+    """Удалить состояния FSM, не обновлявшиеся дольше ttl секунд"""
+    async with async_session() as session:
+        result = await session.execute(
+            FSMState.__table__.delete().where(
+                FSMState.updated_at < datetime.utcnow() - timedelta(seconds=ttl)
+            )
+        )
         await session.commit()
-        return True
\ No newline at end of file
+        return result.rowcount
+
+
+# ============== FILE_ID ЗАГРУЖЕННЫХ ФАЙЛОВ ==============
+
+async def get_media_file_ids():
+    """Все сохранённые file_id: {path: (mtime, size, file_id)}"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(MediaFile.path, MediaFile.mtime, MediaFile.size, MediaFile.file_id)
+        )
+        return {row.path: (row.mtime, row.size, row.file_id) for row in result}
+
+
+async def save_media_file_ids(records: list):
+    """Сохранить file_id: records = [(path, mtime, size, file_id)]"""
+    if not records:
+        return
+    stmt = _dialect_insert(MediaFile)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['path'],
+        set_={
+            'mtime': stmt.excluded.mtime,
+            'size': stmt.excluded.size,
+            'file_id': stmt.excluded.file_id,
+            'updated_at': stmt.excluded.updated_at,
+        }
+    )
+    now = datetime.utcnow()
+    async with async_session() as session:
+        await session.execute(stmt, [
+            dict(path=path, mtime=mtime, size=size, file_id=file_id, updated_at=now)
+            for path, mtime, size, file_id in records
+        ])
+        await session.commit()
+
+
+async def delete_media_file_ids(paths: list):
+    """Забыть file_id (Telegram отклонил устаревший идентификатор)"""
+    async with async_session() as session:
+        await session.execute(MediaFile.__table__.delete().where(MediaFile.path.in_(paths)))
+        await session.commit()
+
+
+# ============== ОТЛОЖЕННЫЕ ЗАДАЧИ ==============
+
+async def save_scheduled_job(job_id: str, func: str, args: list, run_at: datetime):
+    """Сохранить (или перезаписать) разовую задачу; run_at — UTC без часового пояса"""
+    stmt = _dialect_insert(ScheduledJob)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['id'],
+        set_={'func': stmt.excluded.func, 'args': stmt.excluded.args, 'run_at': stmt.excluded.run_at}
+    )
+    async with async_session() as session:
+        await session.execute(stmt, [dict(id=job_id, func=func, args=json.dumps(args, ensure_ascii=False), run_at=run_at)])
+        await session.commit()
+
+
+async def delete_scheduled_job(job_id: str):
+    """Удалить задачу (выполнена или отменена)"""
+    async with async_session() as session:
+        await session.execute(ScheduledJob.__table__.delete().where(ScheduledJob.id == job_id))
+        await session.commit()
+
+
+async def iter_scheduled_jobs(batch_size: int = 500):
+    """Все сохранённые задачи пачками: [(id, func, args, run_at)]"""
+    query = select(
+        ScheduledJob.id, ScheduledJob.func, ScheduledJob.args, ScheduledJob.run_at
+    ).execution_options(yield_per=batch_size)
+    async with async_session() as session:
+        result = await session.stream(query)
+        async for batch in result.partitions():
+            yield [(row.id, row.func, json.loads(row.args), row.run_at) for row in batch]
+
+
+async def delete_scheduled_jobs_before(moment: datetime) -> int:
+    """Удалить задачи, срок которых прошёл раньше moment (уже не выполнить)"""
+    async with async_session() as session:
+        result = await session.execute(
+            ScheduledJob.__table__.delete().where(ScheduledJob.run_at < moment)
+        )
+        await session.commit()
+        return result.rowcount
+
+
+# ============== ЖУРНАЛ УВЕДОМЛЕНИЙ ==============
+
+async def claim_notifications(kind: str, candidates, limit: int = None) -> list:
+    """
+    Отобрать ещё не отправленные уведомления и записать их в журнал.
+
+    candidates — select с колонками user_id, subject_id, scheduled_for
+    (и любыми другими для текста). Проверка и запись идут в одной
+    транзакции, поэтому одно уведомление не достанется двум запускам.
+    С limit отбирается не больше limit строк — повторные вызовы берут следующие.
+    Возвращает строки-словари с добавленным log_id.
+    """
+    sq = candidates.subquery()
+    query = select(sq).where(~exists().where(
+        NotificationLog.user_id == sq.c.user_id,
+        NotificationLog.kind == kind,
+        NotificationLog.subject_id == sq.c.subject_id,
+        NotificationLog.scheduled_for == sq.c.scheduled_for
+    ))
+    if limit:
+        query = query.order_by(sq.c.user_id).limit(limit)
+
+    async with async_session() as session:
+        if engine.dialect.name == 'sqlite':
+            await session.connection(execution_options={'sqlite_begin': 'BEGIN IMMEDIATE'})
+        rows = (await session.execute(query)).mappings().all()
+        if not rows:
+            return []
+
+        stmt = _dialect_insert(NotificationLog).on_conflict_do_nothing(
+            index_elements=['user_id', 'kind', 'subject_id', 'scheduled_for']
+        ).returning(
+            NotificationLog.id, NotificationLog.user_id,
+            NotificationLog.subject_id, NotificationLog.scheduled_for
+        )
+        result = await session.execute(stmt, [
+            dict(
+                user_id=row['user_id'],
+                kind=kind,
+                subject_id=row['subject_id'],
+                scheduled_for=row['scheduled_for'],
+                status='pending'
+            )
+            for row in rows
+        ])
+        claimed = {(r.user_id, r.subject_id, r.scheduled_for): r.id for r in result}
+        await session.commit()
+
+    return [
+        dict(row, log_id=claimed[(row['user_id'], row['subject_id'], row['scheduled_for'])])
+        for row in rows
+        if (row['user_id'], row['subject_id'], row['scheduled_for']) in claimed
+    ]
+
+
+async def mark_notification(log_id: int, status: str):
+    """Записать результат отправки уведомления"""
+    async with async_session() as session:
+        await session.execute(
+            update(NotificationLog)
+            .where(NotificationLog.id == log_id)
+            .values(status=status, sent_at=datetime.utcnow())
+        )
+        await session.commit()
+
+
+async def release_pending_notifications(older_than: timedelta):
+    """Снять отметки с уведомлений, отобранных раньше older_than и так и не отправленных
+    (процесс остановился посреди отправки). Их отправит следующий или догоняющий запуск.
+
+    Свежие отметки не трогаем: их может прямо сейчас отправлять другой процесс.
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            delete(NotificationLog).where(
+                NotificationLog.status == 'pending',
+                NotificationLog.created_at < datetime.utcnow() - older_than
+            )
+        )
+        await session.commit()
+        return result.rowcount
+
+
+async def get_bookings_without_reminder(now: datetime):
+    """Будущие активные записи, по которым ещё не отправлено напоминание: [(id, booking_date)]"""
+    async with async_session() as session:
+        result = await session.execute(
+            select(Booking.id, Booking.booking_date).where(
+                Booking.status == 'active',
+                Booking.booking_date > now,
+                ~exists().where(
+                    NotificationLog.kind == 'training_reminder',
+                    NotificationLog.subject_id == Booking.id
+                )
+            )
+        )
+        return [(row.id, row.booking_date) for row in result]
+
+
+# ============== АНАЛИТИКА ==============
+
+def _month_index(column):
+    """Сквозной номер месяца (год * 12 + месяц - 1) — для когорт и сдвигов по месяцам"""
+    return cast(extract('year', column) * 12 + extract('month', column) - 1, Integer)
+
+
+def _subscription_months():
+    """Месяцы, в которые у пользователя был абонемент: (user_id, month)"""
+    month = _month_index(Subscription.start_date)
+    return (
+        select(Subscription.user_id.label('user_id'), month.label('month'))
+        .where(Subscription.start_date != None)
+        .group_by(Subscription.user_id, month)
+        .subquery()
+    )
+
+
+async def get_subscription_cohorts(first_month: int):
+    """Когорты по месяцу первого абонемента — один GROUP BY.
+
+    first_month — сквозной номер месяца (см. _month_index), с которого брать когорты.
+    Возвращает [(cohort_month, offset, users)]: сколько пользователей когорты
+    брали абонемент через offset месяцев после первого.
+    """
+    months = _subscription_months()
+    first = (
+        select(months.c.user_id, func.min(months.c.month).label('cohort'))
+        .group_by(months.c.user_id)
+        .subquery()
+    )
+    offset = (months.c.month - first.c.cohort).label('offset')
+    async with async_session() as session:
+        result = await session.execute(
+            select(first.c.cohort, offset, func.count())
+            .join(months, months.c.user_id == first.c.user_id)
+            .where(first.c.cohort >= first_month)
+            .group_by(first.c.cohort, offset)
+        )
+        return [tuple(row) for row in result]
+
+
+async def get_renewal_stats(first_month: int, last_month: int):
+    """Продления по месяцам: [(month, subscribers, renewed)] — renewed взяли абонемент и в следующем месяце"""
+    current = _subscription_months()
+    following = _subscription_months()
+    async with async_session() as session:
+        result = await session.execute(
+            select(current.c.month, func.count(), func.count(following.c.user_id))
+            .outerjoin(
+                following,
+                (following.c.user_id == current.c.user_id) & (following.c.month == current.c.month + 1)
+            )
+            .where(current.c.month >= first_month, current.c.month <= last_month)
+            .group_by(current.c.month)
+            .order_by(current.c.month)
+        )
+        return [tuple(row) for row in result]
+
+
+# Границы корзин гистограммы посещений за месяц абонемента: [0], [1-3], [4-7], [8-11], [12+]
+VISIT_BUCKETS = (0, 1, 4, 8, 12)
+
+
+async def get_visit_histogram(since: datetime):
+    """Посещения за период каждого абонемента, начатого с since, по корзинам VISIT_BUCKETS.
+
+    Возвращает ({нижняя граница корзины: абонементов}, всего абонементов, всего посещений).
+    """
+    per_subscription = (
+        select(Subscription.id, func.count(Visit.id).label('visits'))
+        .outerjoin(Visit, and_(
+            Visit.user_id == Subscription.user_id,
+            Visit.visit_date >= Subscription.start_date,
+            Visit.visit_date <= Subscription.end_date,
+        ))
+        .where(Subscription.start_date >= since)
+        .group_by(Subscription.id)
+        .subquery()
+    )
+    bucket = case(
+        *[(per_subscription.c.visits >= low, low) for low in reversed(VISIT_BUCKETS[1:])],
+        else_=0,
+    ).label('bucket')
+    async with async_session() as session:
+        result = await session.execute(
+            select(bucket, func.count(), func.sum(per_subscription.c.visits)).group_by(bucket)
+        )
+        histogram = {low: 0 for low in VISIT_BUCKETS}
+        subscriptions = visits = 0
+        for low, count, total in result:
+            histogram[low] = count
+            subscriptions += count
+            visits += total or 0
+        return histogram, subscriptions, visits
+
+
+# ============== СВЕРКА ПЛАТЕЖЕЙ И АБОНЕМЕНТОВ ==============
+
+def _month_start(moment: datetime, months: int = 0) -> datetime:
+    """Начало месяца moment, сдвинутого на months месяцев"""
+    index = moment.year * 12 + moment.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _month_period(start: datetime) -> tuple:
+    """Календарный месяц: (1-е число 00:00, последний день 23:59:59)"""
+    last_day = calendar.monthrange(start.year, start.month)[1]
+    return start, start.replace(day=last_day, hour=23, minute=59, second=59)
+
+
+def _subscription_period(product: dict, paid_at: datetime, covered_until: datetime = None) -> tuple:
+    """Период абонемента: календарный месяц оплаты, а продление при действующем
+    абонементе (covered_until) — месяц после его окончания"""
+    start = _month_start(paid_at)
+    if product['renewal'] and covered_until and covered_until >= paid_at:
+        start = max(start, _month_start(covered_until, 1))
+    return _month_period(start)
+
+
+async def create_subscription_for_payment(payment: Payment, session: AsyncSession):
+    """Выдать абонемент по подтверждённому платежу (каталог config.SUBSCRIPTION_PRODUCTS).
+
+    None, если платёж — не абонемент. Коммит — за вызывающим (одна транзакция с confirm_payment).
+    """
+    product = config.SUBSCRIPTION_PRODUCTS.get(payment.payment_type)
+    if not product:
+        return None
+
+    paid_at = payment.confirmed_at or datetime.utcnow()
+    covered_until = None
+    if product['renewal']:
+        covered_until = (await session.execute(
+            select(func.max(Subscription.end_date)).where(
+                Subscription.user_id == payment.user_id,
+                Subscription.is_active == True,
+                Subscription.end_date >= paid_at
+            )
+        )).scalar()
+
+    start_date, end_date = _subscription_period(product, paid_at, covered_until)
+    subscription = Subscription(
+        user_id=payment.user_id,
+        subscription_type=product['subscription_type'],
+        start_date=start_date,
+        end_date=end_date,
+        is_active=True,
+        payment_id=payment.id
+    )
+    session.add(subscription)
+    return subscription
+
+
+def _paid_at():
+    return func.coalesce(Payment.confirmed_at, Payment.created_at)
+
+
+def _unlinked_month_query(month_start: datetime):
+    """Один запрос на месяц: оплаты абонементов без привязанного абонемента
+    (side='payment', с датой, до которой клиент уже покрыт, — для продления)
+    и непривязанные абонементы, начатые в этом месяце (side='legacy', выданы до сверки)
+    """
+    month_end = _month_start(month_start, 1)
+    subscription_type = case(
+        *[(Payment.payment_type == payment_type, product['subscription_type'])
+          for payment_type, product in config.SUBSCRIPTION_PRODUCTS.items()]
+    )
+    covered_until = select(func.max(Subscription.end_date)).where(
+        Subscription.user_id == Payment.user_id,
+        Subscription.start_date <= _paid_at(),
+        Subscription.end_date >= _paid_at()
+    ).scalar_subquery()
+
+    payments = select(
+        literal('payment').label('side'),
+        Payment.id,
+        Payment.user_id,
+        Payment.payment_type,
+        subscription_type.label('subscription_type'),
+        _paid_at().label('moment'),
+        covered_until.label('covered_until')
+    ).where(
+        Payment.status == 'confirmed',
+        Payment.payment_type.in_(list(config.SUBSCRIPTION_PRODUCTS)),
+        # То же, что paid_at в месяце, но в виде, который берёт индексы по status + дате
+        or_(
+            and_(Payment.confirmed_at >= month_start, Payment.confirmed_at < month_end),
+            and_(Payment.confirmed_at == None, Payment.created_at >= month_start, Payment.created_at < month_end)
+        ),
+        ~exists().where(Subscription.payment_id == Payment.id)
+    )
+
+    legacy = select(
+        literal('legacy'),
+        Subscription.id,
+        Subscription.user_id,
+        literal(None, String),
+        Subscription.subscription_type,
+        Subscription.start_date,
+        literal(None, DateTime)
+    ).where(
+        Subscription.payment_id == None,
+        Subscription.start_date >= month_start,
+        Subscription.start_date < month_end
+    )
+
+    return union_all(payments, legacy)
+
+
+def _pair_month_rows(rows) -> tuple:
+    """Оплатам месяца — непривязанные абонементы того же клиента и типа по порядку.
+    Возвращает ([(оплата, id абонемента)], [оплаты без абонемента])"""
+    legacy = {}
+    for row in sorted((r for r in rows if r.side == 'legacy'), key=lambda r: (r.moment, r.id)):
+        legacy.setdefault((row.user_id, row.subscription_type), []).append(row.id)
+
+    linked, missing = [], []
+    for row in sorted((r for r in rows if r.side == 'payment'), key=lambda r: r.id):
+        candidates = legacy.get((row.user_id, row.subscription_type))
+        if candidates:
+            linked.append((row, candidates.pop(0)))
+        else:
+            missing.append(row)
+    return linked, missing
+
+
+def _overlaps_query(now: datetime):
+    """Пары действующих абонементов одного клиента с пересекающимися периодами"""
+    first, second = aliased(Subscription), aliased(Subscription)
+    return select(
+        first.user_id,
+        first.id.label('first_id'),
+        second.id.label('second_id'),
+        first.subscription_type.label('first_type'),
+        second.subscription_type.label('second_type')
+    ).join(second, and_(
+        second.user_id == first.user_id,
+        second.id > first.id,
+        second.is_active == True,
+        second.end_date >= now,
+        second.start_date <= first.end_date,
+        first.start_date <= second.end_date
+    )).where(
+        first.is_active == True,
+        first.end_date >= now
+    ).order_by(first.user_id, first.id, second.id)
+
+
+async def _shift_overlapping(session: AsyncSession, user_ids: set) -> int:
+    """Раздвинуть пересекающиеся абонементы одного типа: следующий начинается
+    с месяца после окончания предыдущего. Возвращает число сдвинутых"""
+    subscriptions = (await session.execute(
+        select(Subscription.id, Subscription.user_id, Subscription.subscription_type,
+               Subscription.start_date, Subscription.end_date)
+        .where(Subscription.user_id.in_(user_ids), Subscription.is_active == True)
+        .order_by(Subscription.user_id, Subscription.subscription_type, Subscription.start_date, Subscription.id)
+    )).all()
+
+    changes = []
+    previous_key, previous_end = None, None
+    for sub in subscriptions:
+        key = (sub.user_id, sub.subscription_type)
+        if key == previous_key and sub.start_date <= previous_end:
+            start_date, end_date = _month_period(_month_start(previous_end, 1))
+            changes.append({'id': sub.id, 'start_date': start_date, 'end_date': end_date})
+            previous_end = end_date
+        else:
+            previous_key, previous_end = key, sub.end_date
+
+    if changes:
+        await session.execute(update(Subscription), changes)
+    return len(changes)
+
+
+async def reconcile_subscriptions(repair: bool = False) -> dict:
+    """Сверка подтверждённых оплат абонементов с выданными абонементами.
+
+    Находит оплаты без абонемента (по месяцу — один запрос), пересекающиеся
+    действующие абонементы и истёкшие, но не выключенные. repair=True в одной
+    транзакции привязывает старые абонементы к оплатам, выдаёт недостающие,
+    выключает истёкшие и раздвигает пересечения одного типа.
+    """
+    now = datetime.utcnow()
+    report = {
+        'repair': repair,
+        'months': 0,
+        'checked_until': now,
+        'missing': [],
+        'linked': 0,
+        'expired_active': 0,
+        'overlaps': [],
+        'created': 0,
+        'deactivated': 0,
+        'shifted': 0,
+    }
+
+    async with async_session() as session:
+        if repair and engine.dialect.name == 'sqlite':
+            await session.connection(execution_options={'sqlite_begin': 'BEGIN IMMEDIATE'})
+
+        first_paid = (await session.execute(
+            select(func.min(_paid_at())).where(
+                Payment.status == 'confirmed',
+                Payment.payment_type.in_(list(config.SUBSCRIPTION_PRODUCTS))
+            )
+        )).scalar()
+
+        month = _month_start(first_paid) if first_paid else None
+        while month is not None and month <= now:
+            linked, missing = _pair_month_rows((await session.execute(_unlinked_month_query(month))).all())
+            report['months'] += 1
+
+            links = [{'id': subscription_id, 'payment_id': row.id} for row, subscription_id in linked]
+            created = []
+            for row in missing:
+                product = config.SUBSCRIPTION_PRODUCTS[row.payment_type]
+                start_date, end_date = _subscription_period(product, row.moment, row.covered_until)
+                report['missing'].append({
+                    'payment_id': row.id,
+                    'user_id': row.user_id,
+                    'payment_type': row.payment_type,
+                    'paid_at': row.moment,
+                })
+                created.append({
+                    'user_id': row.user_id,
+                    'subscription_type': product['subscription_type'],
+                    'start_date': start_date,
+                    'end_date': end_date,
+                    'is_active': end_date >= now,
+                    'trainings_left': 8,
+                    'payment_id': row.id,
+                })
+            report['linked'] += len(links)
+
+            if repair:
+                if links:
+                    await session.execute(update(Subscription), links)
+                if created:
+                    await session.execute(insert(Subscription), created)
+                    report['created'] += len(created)
+
+            month = _month_start(month, 1)
+
+        expired = and_(Subscription.is_active == True, Subscription.end_date < now)
+        report['expired_active'] = (await session.execute(
+            select(func.count(Subscription.id)).where(expired)
+        )).scalar() or 0
+        if repair and report['expired_active']:
+            result = await session.execute(
+                update(Subscription).where(expired).values(is_active=False)
+                .execution_options(synchronize_session=False)
+            )
+            report['deactivated'] = result.rowcount
+
+        report['overlaps'] = [dict(row._mapping) for row in await session.execute(_overlaps_query(now))]
+        if repair:
+            same_type = {o['user_id'] for o in report['overlaps'] if o['first_type'] == o['second_type']}
+            if same_type:
+                report['shifted'] = await _shift_overlapping(session, same_type)
+            await session.commit()
+
+    return report
+
@@ -1,11 +1,27 @@
 from aiogram import Router, F, Bot
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from database import async_session, Payment, Subscription, User, get_all_clients, get_sales_stats, get_detailed_sales_stats, get_users_for_broadcast, get_today_bookings, mark_visit, get_recent_payments, get_recent_bookings
+from database import async_session, Payment, User, get_clients_page, get_detailed_sales_stats, confirm_payment, rebuild_sales_daily, get_users_for_broadcast, get_today_bookings, mark_visit, get_recent_payments, get_recent_bookings, create_broadcast, get_broadcast, search_clients, get_client_card, SEARCH_MIN_WORD, create_subscription_for_payment
+from utils.reconcile import run_reconciliation, format_reconciliation_report
 from utils.scheduler import schedule_menu_retry, schedule_video_funnel
+from utils.media import send_document
+from utils.analytics import get_retention_report, format_retention_report
+from utils.export import TABLE_EXPORTS, start_table_export
+from utils.schedule import day_schedule_to_text, parse_day_schedule, set_day_schedule, get_day_schedule_text
+from utils.broadcast import (
+    broadcast_control_keyboard,
+    format_broadcast_progress,
+    start_broadcast_job,
+    pause_broadcast_job,
+    resume_broadcast_job,
+    cancel_broadcast_job,
+    update_broadcast_message,
+    STATUS_NAMES,
+)
 
 
 class BroadcastStates(StatesGroup):
@@ -21,7 +37,8 @@ class ScheduleEditStates(StatesGroup):
     waiting_for_text = State()
 from keyboards.main import main_keyboard
 from sqlalchemy import select
-from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timedelta
 import calendar
 import os
 import config
@@ -51,6 +68,7 @@ async def admin_panel(message: Message):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
+            [InlineKeyboardButton(text="📈 Удержание", callback_data="admin_analytics")],
             [InlineKeyboardButton(text="👥 Клиенты", callback_data="admin_clients")],
             [InlineKeyboardButton(text="✅ Отметка посещений", callback_data="admin_attendance")],
             [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
@@ -61,39 +79,43 @@ async def admin_panel(message: Message):
     await message.answer(text, reply_markup=keyboard)
 
 
-@router.callback_query(F.data == "admin_stats")
-async def admin_statistics(callback: CallbackQuery):
-    """Статистика продаж"""
+# Названия типов продуктов
+SALES_TYPE_NAMES = {
+    'one_group': 'Абонемент (одна группа)',
+    'all_groups': 'Абонемент (все группы)',
+    'single': 'Разовое занятие',
+    'menu': 'Меню на похудение',
+    'menu_1200_week': 'Меню 1200 ккал (неделя)',
+    'menu_1200_month': 'Меню 1200 ккал (месяц)',
+    'menu_1500_week': 'Меню 1500 ккал (неделя)',
+    'menu_1500_month': 'Меню 1500 ккал (месяц)',
+    'menu_drying_week': 'Меню на сушку (неделя)',
+    'menu_drying_month': 'Меню на сушку (месяц)',
+    'plan': 'План тренировок',
+    'video': 'Онлайн-тренировка',
+    'mentoring': 'Наставничество',
+    'other': 'Другое'
+}
 
-    if not is_admin(callback.from_user.id):
-        await callback.answer("❌ Доступ запрещён", show_alert=True)
-        return
 
-    stats = await get_detailed_sales_stats()
+def _format_change(current, previous) -> str:
+    """Изменение к прошлому периоду: «+12% (было 40000₽)»"""
+    if not previous:
+        return "нет данных за прошлый период" if not current else "новые продажи"
+    change = (current - previous) / previous * 100
+    return f"{change:+.0f}% (было {previous:g}₽)"
 
-    # Названия типов продуктов
-    type_names = {
-        'one_group': 'Абонемент (одна группа)',
-        'all_groups': 'Абонемент (все группы)',
-        'single': 'Разовое занятие',
-        'menu': 'Меню на похудение',
-        'menu_1200_week': 'Меню 1200 ккал (неделя)',
-        'menu_1200_month': 'Меню 1200 ккал (месяц)',
-        'menu_1500_week': 'Меню 1500 ккал (неделя)',
-        'menu_1500_month': 'Меню 1500 ккал (месяц)',
-        'menu_drying_week': 'Меню на сушку (неделя)',
-        'menu_drying_month': 'Меню на сушку (месяц)',
-        'plan': 'План тренировок',
-        'video': 'Онлайн-тренировка',
-        'mentoring': 'Наставничество',
-        'other': 'Другое'
-    }
 
+def _sales_stats_text(stats: dict) -> str:
+    """Текст экрана статистики за период"""
+    date_from, date_to = stats['date_from'], stats['date_to']
+    period = f"{date_from.strftime('%d.%m.%Y')} — {date_to.strftime('%d.%m.%Y')}"
     text = f"""
-📊 СТАТИСТИКА ЗА ТЕКУЩИЙ МЕСЯЦ
+📊 СТАТИСТИКА ЗА {period}
 
-💰 Общий доход: {stats['total_income']}₽
+💰 Общий доход: {stats['total_income']:g}₽
 📈 Всего продаж: {stats['total_sales']}
+📅 К прошлому месяцу: {_format_change(stats['total_income'], stats['prev_income'])}
 
 👥 Всего клиентов: {stats['total_users']}
 ✅ С активным абонементом: {stats['active_subscriptions']}
@@ -103,23 +125,146 @@ async def admin_statistics(callback: CallbackQuery):
 
     if stats['by_type']:
         for p_type, data in stats['by_type'].items():
-            name = type_names.get(p_type, p_type)
-            text += f"• {name}: {data['count']} шт. — {data['amount']}₽\n"
+            name = SALES_TYPE_NAMES.get(p_type, p_type)
+            text += f"• {name}: {data['count']} шт. — {data['amount']:g}₽\n"
     else:
         text += "Пока нет продаж\n"
+    return text
 
-    keyboard = InlineKeyboardMarkup(
+
+def _month_bounds(year: int, month: int):
+    """Первый и последний день месяца (текущий месяц — по сегодня)"""
+    today = datetime.utcnow().date()
+    first = today.replace(year=year, month=month, day=1)
+    last = first.replace(day=calendar.monthrange(year, month)[1])
+    return first, min(last, today)
+
+
+def _stats_keyboard(date_from) -> InlineKeyboardMarkup:
+    """Кнопки экрана статистики: листание по месяцам"""
+    today = datetime.utcnow().date()
+    prev_month = (date_from.replace(day=1) - timedelta(days=1)).replace(day=1)
+    next_month = (date_from.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+    months = [InlineKeyboardButton(text=f"◀️ {prev_month.strftime('%m.%Y')}", callback_data=f"admin_stats:{prev_month.strftime('%Y-%m')}")]
+    if next_month <= today:
+        months.append(InlineKeyboardButton(text=f"{next_month.strftime('%m.%Y')} ▶️", callback_data=f"admin_stats:{next_month.strftime('%Y-%m')}"))
+
+    return InlineKeyboardMarkup(
         inline_keyboard=[
+            months,
             [InlineKeyboardButton(text="🛒 Покупки", callback_data="admin_purchases")],
             [InlineKeyboardButton(text="📝 Записи на тренировки", callback_data="admin_bookings_list")],
             [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_admin")]
         ]
     )
 
-    await callback.message.edit_text(text, reply_markup=keyboard)
+
+@router.callback_query(F.data == "admin_stats")
+async def admin_statistics(callback: CallbackQuery):
+    """Статистика продаж за текущий месяц"""
+
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    stats = await get_detailed_sales_stats()
+    await callback.message.edit_text(_sales_stats_text(stats), reply_markup=_stats_keyboard(stats['date_from']))
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("admin_stats:"))
+async def admin_statistics_month(callback: CallbackQuery):
+    """Статистика продаж за выбранный месяц"""
+
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    year, month = map(int, callback.data.split(":")[1].split("-"))
+    date_from, date_to = _month_bounds(year, month)
+    stats = await get_detailed_sales_stats(date_from, date_to)
+    await callback.message.edit_text(_sales_stats_text(stats), reply_markup=_stats_keyboard(date_from))
     await callback.answer()
 
 
+@router.message(Command("stats"))
+async def admin_statistics_range(message: Message, command: CommandObject):
+    """Статистика за произвольный период: /stats 01.09.2026 15.09.2026 или /stats 09.2026"""
+
+    if not is_admin(message.from_user.id):
+        return
+
+    args = (command.args or "").split()
+    try:
+        if len(args) == 1:
+            month = datetime.strptime(args[0], '%m.%Y')
+            date_from, date_to = _month_bounds(month.year, month.month)
+        elif len(args) == 2:
+            date_from = datetime.strptime(args[0], '%d.%m.%Y').date()
+            date_to = datetime.strptime(args[1], '%d.%m.%Y').date()
+            if date_from > date_to:
+                raise ValueError
+        else:
+            raise ValueError
+    except ValueError:
+        await message.answer(
+            "Укажи период: /stats 01.09.2026 15.09.2026\n"
+            "или месяц: /stats 09.2026"
+        )
+        return
+
+    stats = await get_detailed_sales_stats(date_from, date_to)
+    await message.answer(_sales_stats_text(stats), reply_markup=_stats_keyboard(date_from))
+
+
+@router.message(Command("rebuild_stats"))
+async def admin_rebuild_statistics(message: Message):
+    """Пересобрать сводку продаж по истории платежей"""
+
+    if not is_admin(message.from_user.id):
+        return
+
+    rows = await rebuild_sales_daily()
+    await message.answer(f"✅ Сводка продаж пересобрана: {rows} строк (день × тип продукта).")
+
+
+@router.message(Command("reconcile"))
+async def admin_reconcile(message: Message, command: CommandObject):
+    """Сверка оплат и абонементов: /reconcile — отчёт, /reconcile fix — исправить"""
+
+    if not is_admin(message.from_user.id):
+        return
+
+    repair = (command.args or "").strip().lower() == "fix"
+    await message.answer("⏳ Сверяю оплаты и абонементы…")
+    report = await run_reconciliation(repair=repair)
+    await message.answer(format_reconciliation_report(report))
+
+
+@router.callback_query(F.data.in_({"admin_analytics", "admin_analytics_refresh"}))
+async def admin_analytics(callback: CallbackQuery):
+    """Когорты, продления и частота посещений"""
+
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    await callback.answer("Считаю…" if callback.data == "admin_analytics_refresh" else None)
+    report = await get_retention_report(refresh=callback.data == "admin_analytics_refresh")
+
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🔄 Пересчитать", callback_data="admin_analytics_refresh")],
+            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_admin")]
+        ]
+    )
+    try:
+        await callback.message.edit_text(format_retention_report(report), reply_markup=keyboard, parse_mode="HTML")
+    except TelegramBadRequest:
+        pass  # «message is not modified» — отчёт не изменился
+
+
 @router.callback_query(F.data == "admin_purchases")
 async def admin_purchases(callback: CallbackQuery):
     """Последние покупки"""
@@ -157,6 +302,7 @@ async def admin_purchases(callback: CallbackQuery):
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
+            [InlineKeyboardButton(text="📥 Выгрузить все в CSV", callback_data="admin_export:payments")],
             [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_stats")]
         ]
     )
@@ -185,6 +331,7 @@ async def admin_bookings_list_handler(callback: CallbackQuery):
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
+            [InlineKeyboardButton(text="📥 Выгрузить все в CSV", callback_data="admin_export:bookings")],
             [InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_stats")]
         ]
     )
@@ -193,41 +340,186 @@ async def admin_bookings_list_handler(callback: CallbackQuery):
     await callback.answer()
 
 
+CLIENTS_PAGE_SIZE = 10
+
+
 @router.callback_query(F.data == "admin_clients")
+@router.callback_query(F.data.startswith("clients_page:"))
 async def admin_clients_list(callback: CallbackQuery):
-    """Список клиентов"""
+    """Список клиентов (постранично)"""
 
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Доступ запрещён", show_alert=True)
         return
 
-    clients = await get_all_clients()
+    # Формат: clients_page:next:{id} или clients_page:prev:{id}
+    after_id = before_id = None
+    if callback.data.startswith("clients_page:"):
+        _, direction, cursor = callback.data.split(":")
+        if direction == "next":
+            after_id = int(cursor)
+        else:
+            before_id = int(cursor)
+
+    page = await get_clients_page(after_id=after_id, before_id=before_id, limit=CLIENTS_PAGE_SIZE)
+    clients = page['clients']
 
     if not clients:
         text = "📋 Список клиентов пуст"
     else:
-        text = f"👥 СПИСОК КЛИЕНТОВ ({len(clients)} чел.)\n\n"
+        text = f"👥 СПИСОК КЛИЕНТОВ ({page['total']} чел.)\n🔎 Поиск: /find имя, @username или телефон\n\n"
 
-        for client in clients[:10]:
+        for client in clients:
             status = "✅" if client['sub_type'] else "❌"
             text += f"{status} {client['name'] or 'Без имени'} (@{client['username'] or 'нет'})\n"
             if client['end_date']:
                 text += f"   Абонемент до: {client['end_date']}\n"
             text += "\n"
 
-        if len(clients) > 10:
-            text += f"... и ещё {len(clients) - 10} чел."
+    nav = []
+    if clients and page['has_prev']:
+        nav.append(InlineKeyboardButton(text="⬅️ Пред.", callback_data=f"clients_page:prev:{clients[0]['id']}"))
+    if clients and page['has_next']:
+        nav.append(InlineKeyboardButton(text="След. ➡️", callback_data=f"clients_page:next:{clients[-1]['id']}"))
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_admin")]
-        ]
-    )
+    buttons = [nav] if nav else []
+    buttons.append([InlineKeyboardButton(text="📥 Выгрузить всех в CSV", callback_data="admin_export:clients")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="back_admin")])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
 
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
 
+FIND_LIMIT = 10
+
+
+def _client_card_text(card: dict) -> str:
+    username = f" (@{card['username']})" if card['username'] else ""
+    text = f"👤 {card['name'] or 'Без имени'}{username}\n"
+    text += f"ID: {card['user_id']}\n"
+    if card['phone']:
+        text += f"📞 {card['phone']}\n"
+    if card['reg_date']:
+        text += f"📅 С нами с {card['reg_date'].strftime('%d.%m.%Y')}\n"
+    if not card['is_active']:
+        text += "🔕 Бот заблокирован\n"
+
+    subscription = card['subscription']
+    if subscription:
+        name = SALES_TYPE_NAMES.get(subscription['type'], subscription['type'])
+        end_date = subscription['end_date'].strftime('%d.%m.%Y') if subscription['end_date'] else '—'
+        text += f"\n🎫 {name} до {end_date}\n"
+    else:
+        text += "\n🎫 Нет активного абонемента\n"
+
+    last_visit = card['last_visit'].strftime('%d.%m.%Y') if card['last_visit'] else "ещё не было"
+    text += f"🏃 Последнее посещение: {last_visit}\n"
+
+    if card['bookings']:
+        text += "\n📝 Записи:\n"
+        for b in card['bookings']:
+            text += f"• {b['booking_date'].strftime('%d.%m')} {b['training_time']} — {b['training_name']} ({b['trainer']})\n"
+    else:
+        text += "\n📝 Предстоящих записей нет\n"
+    return text
+
+
+@router.message(Command("find"))
+async def admin_find_client(message: Message, command: CommandObject, session: AsyncSession):
+    """Поиск клиента: /find имя, @username или телефон"""
+
+    if not is_admin(message.from_user.id):
+        return
+
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Укажи, кого искать: /find Анна, /find @username или /find 961908")
+        return
+
+    if max(len(word.lstrip('@')) for word in query.split()) < SEARCH_MIN_WORD:
+        await message.answer(f"Нужно хотя бы одно слово от {SEARCH_MIN_WORD} символов")
+        return
+
+    clients = await search_clients(query, limit=FIND_LIMIT + 1, session=session)
+    if not clients:
+        await message.answer(f"🔎 По запросу «{query}» никого не нашёл")
+        return
+
+    if len(clients) == 1:
+        card = await get_client_card(clients[0]['user_id'], session=session)
+        await message.answer(_client_card_text(card))
+        return
+
+    text = f"🔎 Найдено по запросу «{query}»"
+    text += f" (первые {FIND_LIMIT}, уточни запрос):" if len(clients) > FIND_LIMIT else ":"
+    buttons = []
+    for client in clients[:FIND_LIMIT]:
+        label = client['name'] or 'Без имени'
+        if client['username']:
+            label += f" (@{client['username']})"
+        buttons.append([InlineKeyboardButton(text=label, callback_data=f"client_card:{client['user_id']}")])
+
+    await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+
+
+@router.callback_query(F.data.startswith("client_card:"))
+async def admin_client_card(callback: CallbackQuery, session: AsyncSession):
+    """Карточка клиента из результатов /find"""
+
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    card = await get_client_card(int(callback.data.split(":")[1]), session=session)
+    if not card:
+        await callback.answer("Клиент не найден", show_alert=True)
+        return
+
+    await callback.message.answer(_client_card_text(card))
+    await callback.answer()
+
+
+@router.message(Command("export"))
+async def admin_export_command(message: Message, command: CommandObject, bot: Bot):
+    """Полная выгрузка в CSV: /export clients | payments | bookings"""
+
+    if not is_admin(message.from_user.id):
+        return
+
+    kind = (command.args or "").strip().lower()
+    if kind not in TABLE_EXPORTS:
+        await message.answer(
+            "Укажи, что выгрузить:\n"
+            + "\n".join(f"/export {key} — {title}" for key, (title, _) in TABLE_EXPORTS.items())
+        )
+        return
+
+    if start_table_export(bot, message.chat.id, kind):
+        await message.answer(f"⏳ Готовлю выгрузку «{TABLE_EXPORTS[kind][0]}», пришлю файлом.")
+    else:
+        await message.answer("⏳ Эта выгрузка уже готовится, дождись файла.")
+
+
+@router.callback_query(F.data.startswith("admin_export:"))
+async def admin_export_button(callback: CallbackQuery, bot: Bot):
+    """Кнопка «Выгрузить в CSV» на экранах покупок, записей и клиентов"""
+
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    kind = callback.data.split(":", 1)[1]
+    if kind not in TABLE_EXPORTS:
+        await callback.answer()
+        return
+
+    if start_table_export(bot, callback.message.chat.id, kind):
+        await callback.answer("⏳ Готовлю файл, пришлю отдельным сообщением")
+    else:
+        await callback.answer("⏳ Эта выгрузка уже готовится", show_alert=True)
+
+
 @router.callback_query(F.data == "admin_broadcast")
 async def admin_broadcast_menu(callback: CallbackQuery):
     """Меню рассылки"""
@@ -355,7 +647,7 @@ async def receive_broadcast_message(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "confirm_send_broadcast", BroadcastStates.confirm_broadcast)
 async def send_broadcast(callback: CallbackQuery, state: FSMContext, bot: Bot):
-    """Отправка рассылки"""
+    """Запуск рассылки — отправка идёт в фоне, сообщение обновляется прогрессом"""
 
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Доступ запрещён", show_alert=True)
@@ -365,40 +657,85 @@ async def send_broadcast(callback: CallbackQuery, state: FSMContext, bot: Bot):
     segment = data.get('segment', 'all')
     broadcast_text = data.get('broadcast_text', '')
 
-    users = await get_users_for_broadcast(segment)
+    await state.clear()
 
-    await callback.message.edit_text("⏳ Отправка рассылки...")
+    broadcast_id, total = await create_broadcast(
+        segment, broadcast_text, callback.message.chat.id, callback.message.message_id
+    )
 
-    success = 0
-    failed = 0
+    if not total:
+        await callback.message.edit_text(
+            "❌ Нет пользователей в этом сегменте",
+            reply_markup=broadcast_control_keyboard(broadcast_id, 'done')
+        )
+        await callback.answer()
+        return
 
-    for user_id in users:
-        try:
-            await bot.send_message(user_id, broadcast_text, parse_mode="Markdown")
-            success += 1
-        except Exception as e:
-            failed += 1
-            print(f"Ошибка отправки {user_id}: {e}")
+    progress = {'pending': total, 'sent': 0, 'failed': 0, 'total': total}
+    await callback.message.edit_text(
+        format_broadcast_progress(broadcast_id, 'running', progress),
+        reply_markup=broadcast_control_keyboard(broadcast_id, 'running')
+    )
+    await callback.answer("Рассылка запущена")
 
-    await state.clear()
+    start_broadcast_job(bot, broadcast_id)
 
-    text = f"""
-✅ РАССЫЛКА ЗАВЕРШЕНА
 
-📊 Статистика:
-• Успешно: {success}
-• Ошибки: {failed}
-• Всего: {len(users)}
-    """
+async def _answer_broadcast_unchanged(callback: CallbackQuery, broadcast_id: int):
+    """Ответ на устаревшую кнопку управления рассылкой"""
+    broadcast = await get_broadcast(broadcast_id)
+    if not broadcast or broadcast['status'] in ('cancelled', 'done'):
+        await callback.answer("Рассылка уже завершена", show_alert=True)
+    else:
+        await callback.answer(f"Статус уже изменён: {STATUS_NAMES[broadcast['status']]}", show_alert=True)
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="⬅️ В админку", callback_data="back_admin")]
-        ]
-    )
 
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
+@router.callback_query(F.data.startswith("bc_pause:"))
+async def pause_broadcast(callback: CallbackQuery, bot: Bot):
+    """Пауза рассылки"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    broadcast_id = int(callback.data.split(":")[1])
+    changed = await pause_broadcast_job(broadcast_id)
+    await update_broadcast_message(bot, broadcast_id)
+    if changed:
+        await callback.answer("Рассылка на паузе")
+    else:
+        await _answer_broadcast_unchanged(callback, broadcast_id)
+
+
+@router.callback_query(F.data.startswith("bc_resume:"))
+async def resume_broadcast(callback: CallbackQuery, bot: Bot):
+    """Продолжение рассылки"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    broadcast_id = int(callback.data.split(":")[1])
+    changed = await resume_broadcast_job(bot, broadcast_id)
+    await update_broadcast_message(bot, broadcast_id)
+    if changed:
+        await callback.answer("Рассылка продолжена")
+    else:
+        await _answer_broadcast_unchanged(callback, broadcast_id)
+
+
+@router.callback_query(F.data.startswith("bc_cancel:"))
+async def stop_broadcast(callback: CallbackQuery, bot: Bot):
+    """Отмена запущенной рассылки"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+
+    broadcast_id = int(callback.data.split(":")[1])
+    changed = await cancel_broadcast_job(broadcast_id)
+    await update_broadcast_message(bot, broadcast_id)
+    if changed:
+        await callback.answer("Рассылка отменена")
+    else:
+        await _answer_broadcast_unchanged(callback, broadcast_id)
 
 
 @router.callback_query(F.data == "cancel_broadcast")
@@ -416,6 +753,7 @@ async def cancel_broadcast(callback: CallbackQuery, state: FSMContext):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
+            [InlineKeyboardButton(text="📈 Удержание", callback_data="admin_analytics")],
             [InlineKeyboardButton(text="👥 Клиенты", callback_data="admin_clients")],
             [InlineKeyboardButton(text="✅ Отметка посещений", callback_data="admin_attendance")],
             [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
@@ -581,15 +919,18 @@ async def schedule_edit_start(callback: CallbackQuery, state: FSMContext):
 
     day = callback.data.split(":")[1]
     name = DAY_NAMES.get(day, day)
-    current = config.SCHEDULE.get(day, "(пусто)")
+    current = day_schedule_to_text(day)
 
     await state.set_state(ScheduleEditStates.waiting_for_text)
     await state.update_data(schedule_day=day)
 
     text = (
         f"✏️ Редактирование: {name}\n\n"
-        f"📋 Текущий текст:\n{current}\n\n"
-        f"Введи новый текст расписания для этого дня:"
+        f"📋 Сейчас:\n{current}\n\n"
+        f"Введи новое расписание — по строке на тренера:\n"
+        f"Тип Тренер время, время\n\n"
+        f"Например:\nСиловая Анна 8:30, 17:10\nПилатес Анна 9:30\n\n"
+        f"Типы: {', '.join(config.TRAINING_EMOJIS)}. Для выходного — «выходной»."
     )
 
     keyboard = InlineKeyboardMarkup(
@@ -612,15 +953,21 @@ async def schedule_edit_receive(message: Message, state: FSMContext):
     day = data['schedule_day']
     name = DAY_NAMES.get(day, day)
 
-    config.SCHEDULE[day] = message.text.strip()
-    config.save_schedule()
+    try:
+        entries = parse_day_schedule(message.text or "")
+    except ValueError as e:
+        # Остаёмся в состоянии редактирования — можно сразу прислать исправленный текст
+        await message.answer(f"❌ {e}\n\nПопробуй ещё раз или нажми «Отмена».")
+        return
 
+    await set_day_schedule(day, entries)
     await state.clear()
 
     await message.answer(
         f"✅ Расписание обновлено!\n\n"
-        f"📅 {name}\n"
-        f"📋 Новый текст:\n{config.SCHEDULE[day]}"
+        f"📅 {name}\n\n"
+        f"{get_day_schedule_text(day)}",
+        parse_mode="Markdown"
     )
 
 
@@ -637,6 +984,7 @@ async def back_to_admin(callback: CallbackQuery):
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
+            [InlineKeyboardButton(text="📈 Удержание", callback_data="admin_analytics")],
             [InlineKeyboardButton(text="👥 Клиенты", callback_data="admin_clients")],
             [InlineKeyboardButton(text="✅ Отметка посещений", callback_data="admin_attendance")],
             [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
@@ -649,7 +997,7 @@ async def back_to_admin(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("admin_confirm_"))
-async def admin_confirm_payment(callback: CallbackQuery):
+async def admin_confirm_payment(callback: CallbackQuery, session: AsyncSession):
     """Подтверждение оплаты админом"""
     if not is_admin(callback.from_user.id):
         await callback.answer("Нет доступа")
@@ -657,42 +1005,22 @@ async def admin_confirm_payment(callback: CallbackQuery):
 
     payment_id = int(callback.data.split("_")[-1])
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(Payment).where(Payment.id == payment_id)
-        )
-        payment = result.scalar_one_or_none()
-
-        if not payment:
-            await callback.answer("Платёж не найден")
-            return
+    # Статус, сводка продаж и абонемент — одной транзакцией
+    payment = await confirm_payment(payment_id, session=session)
 
-        payment.status = 'confirmed'
-        payment.confirmed_at = datetime.utcnow()
-
-        # Создаём абонемент если это абонемент
-        if payment.amount in [3500, 6000]:
-            sub_type = "one_group" if payment.amount == 3500 else "all_groups"
-
-            now = datetime.utcnow()
-            start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            last_day = calendar.monthrange(now.year, now.month)[1]
-            end_date = now.replace(day=last_day, hour=23, minute=59, second=59)
+    if not payment:
+        await callback.answer("Платёж не найден или уже подтверждён", show_alert=True)
+        return
 
-            subscription = Subscription(
-                user_id=payment.user_id,
-                subscription_type=sub_type,
-                start_date=start_date,
-                end_date=end_date,
-                is_active=True
-            )
-            session.add(subscription)
+    # Абонемент — по типу платежа из каталога (покупка и продление)
+    subscription = await create_subscription_for_payment(payment, session)
 
-        await session.commit()
+    # Коммит до сообщений клиенту: не держим блокировку записи на время запросов к Telegram
+    await session.commit()
 
     # Уведомляем пользователя с персонализированным cross-sell
     try:
-        if payment.payment_type in ('one_group', 'all_groups'):
+        if subscription:
             cross_sell_kb = InlineKeyboardMarkup(
                 inline_keyboard=[
                     [InlineKeyboardButton(text="📝 Записаться на тренировку", callback_data="book_start")],
@@ -702,7 +1030,8 @@ async def admin_confirm_payment(callback: CallbackQuery):
             )
             await callback.bot.send_message(
                 payment.user_id,
-                "✅ Абонемент активирован, спасибо!\n\n"
+                f"✅ Абонемент активирован: {subscription.start_date.strftime('%d.%m')}"
+                f"–{subscription.end_date.strftime('%d.%m.%Y')}, спасибо!\n\n"
                 "Запишись на ближайшую тренировку. Для лучшего результата "
                 "может пригодиться меню питания или план тренировок 👇",
                 reply_markup=cross_sell_kb
@@ -754,7 +1083,7 @@ async def admin_confirm_payment(callback: CallbackQuery):
                 reply_markup=cross_sell_kb
             )
             # Запускаем воронку follow-up сообщений
-            schedule_video_funnel(callback.bot, payment.user_id)
+            await schedule_video_funnel(payment.user_id)
 
         elif payment.payment_type == 'mentoring':
             cross_sell_kb = InlineKeyboardMarkup(
@@ -827,10 +1156,10 @@ async def admin_confirm_payment(callback: CallbackQuery):
         menu_info = menu_files.get(payment.payment_type)
         if menu_info:
             if menu_info['path'] and os.path.exists(menu_info['path']):
-                menu_file = FSInputFile(menu_info['path'])
-                await callback.bot.send_document(
+                await send_document(
+                    callback.bot,
                     payment.user_id,
-                    document=menu_file,
+                    menu_info['path'],
                     caption=menu_info['caption']
                 )
             else:
@@ -846,7 +1175,7 @@ async def admin_confirm_payment(callback: CallbackQuery):
         if menu_info and menu_info['path']:
             import asyncio
             asyncio.create_task(
-                schedule_menu_retry(callback.bot, payment.user_id, menu_info['path'], menu_info['caption'])
+                schedule_menu_retry(payment.user_id, menu_info['path'], menu_info['caption'])
             )
 
     # Cross-sell после доставки меню
@@ -888,6 +1217,10 @@ async def admin_reject_payment(callback: CallbackQuery):
         )
         payment = result.scalar_one_or_none()
 
+        if payment and payment.status == 'confirmed':
+            await callback.answer("Оплата уже подтверждена", show_alert=True)
+            return
+
         if payment:
             payment.status = 'rejected'
             await session.commit()
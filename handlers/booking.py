@@ -2,31 +2,38 @@
 Обработчики записи на тренировку — полный флоу:
 Тип → Тренер (для Силовой) → День → Время → Подтверждение → Готово
 """
+import logging
+
 from aiogram import Router, F, Bot
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 
 from database import (
     get_trainings_by_filter,
     get_training_by_id,
-    get_bookings_count,
+    get_slot_occupancy,
     check_user_booking,
-    create_booking,
+    reserve_seat,
+    ReserveStatus,
     cancel_booking,
     get_active_subscription,
 )
+from utils.scheduler import schedule_booking_reminder, cancel_booking_reminder
 import config
 
+logger = logging.getLogger(__name__)
+
 router = Router()
 
 DAYS_RU = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
 DAYS_SHORT = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
 
-# Маппинг коротких кодов типа тренировки
+# Маппинг коротких кодов типа тренировки (названия — как в trainings, см. config.TRAINING_NAMES)
 TYPE_MAP = {
-    's': ('Силовая тренировка', '💪'),
-    'p': ('Пилатес с роллом и досками Садху', '🧘'),
-    'b': ('Барре', '🩰'),
+    's': (config.TRAINING_NAMES['Силовая'], '💪'),
+    'p': (config.TRAINING_NAMES['Пилатес'], '🧘'),
+    'b': (config.TRAINING_NAMES['Барре'], '🩰'),
 }
 
 TRAINER_MAP = {
@@ -90,7 +97,7 @@ async def book_info(callback: CallbackQuery):
 
 # ─── 2. Выбран тип: Силовая → тренер, иначе → день ─────────────────
 @router.callback_query(F.data.startswith("bt:"))
-async def book_type(callback: CallbackQuery):
+async def book_type(callback: CallbackQuery, session: AsyncSession):
     """Обработка выбора типа тренировки"""
     await callback.answer()
 
@@ -110,12 +117,12 @@ async def book_type(callback: CallbackQuery):
         await callback.message.edit_text(text, reply_markup=keyboard)
     else:
         # Пилатес / Барре — сразу выбор дня (тренер Анна)
-        await _show_day_selection(callback, type_code, 'a')
+        await _show_day_selection(callback, type_code, 'a', session)
 
 
 # ─── 3. Выбран тренер (только Силовая) ──────────────────────────────
 @router.callback_query(F.data.startswith("btr:"))
-async def book_trainer(callback: CallbackQuery):
+async def book_trainer(callback: CallbackQuery, session: AsyncSession):
     """Обработка выбора тренера → переход к выбору дня"""
     await callback.answer()
 
@@ -123,11 +130,11 @@ async def book_trainer(callback: CallbackQuery):
     type_code = parts[1]
     trainer_code = parts[2]
 
-    await _show_day_selection(callback, type_code, trainer_code)
+    await _show_day_selection(callback, type_code, trainer_code, session)
 
 
 # ─── Хелпер: показ доступных дней ──────────────────────────────────
-async def _show_day_selection(callback: CallbackQuery, type_code: str, trainer_code: str):
+async def _show_day_selection(callback: CallbackQuery, type_code: str, trainer_code: str, session: AsyncSession = None):
     """Показать доступные дни на 7 дней вперёд"""
     name, emoji = TYPE_MAP[type_code]
     trainer_name = TRAINER_MAP[trainer_code]
@@ -150,30 +157,39 @@ async def _show_day_selection(callback: CallbackQuery, type_code: str, trainer_c
     now = datetime.now()
     buttons = []
 
+    # Занятость всех слотов на 7 дней вперёд — одним запросом
+    occupancy = await get_slot_occupancy([t.id for t in trainings], now, days=7, session=session)
+
     for offset in range(7):
         date = now + timedelta(days=offset)
         dow = date.weekday()
         if dow not in available_days:
             continue
 
-        # Для сегодня — проверяем, есть ли ещё не прошедшие слоты
-        if offset == 0:
-            has_future = False
-            for t in trainings:
-                if t.day_of_week == dow:
-                    hour, minute = map(int, t.time.split(':'))
-                    slot_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-                    if now < slot_time:
-                        has_future = True
-                        break
-            if not has_future:
+        day_slots = []
+        for t in trainings:
+            if t.day_of_week != dow:
                 continue
+            # Для сегодня — только ещё не прошедшие слоты
+            if offset == 0:
+                hour, minute = map(int, t.time.split(':'))
+                slot_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+                if now >= slot_time:
+                    continue
+            day_slots.append(t)
+
+        if not day_slots:
+            continue
 
         date_str = date.strftime('%Y%m%d')
         day_label = f"{DAYS_RU[dow]}, {date.strftime('%d.%m')}"
         if offset == 0:
             day_label += " (сегодня)"
 
+        is_full = all(occupancy.get(t.id, 0) >= t.max_participants for t in day_slots)
+        if is_full:
+            day_label = f"🔴 {day_label} — мест нет"
+
         # callback_data: bd:{type}:{trainer}:{date}
         buttons.append([
             InlineKeyboardButton(
@@ -216,7 +232,7 @@ async def back_to_trainer(callback: CallbackQuery):
 
 # ─── 4. Выбран день: показываем временные слоты ─────────────────────
 @router.callback_query(F.data.startswith("bd:"))
-async def book_day(callback: CallbackQuery):
+async def book_day(callback: CallbackQuery, session: AsyncSession):
     """Показать доступные слоты на выбранный день"""
     await callback.answer()
 
@@ -236,6 +252,9 @@ async def book_day(callback: CallbackQuery):
     now = datetime.now()
     buttons = []
 
+    # Занятые места по всем слотам дня — одним запросом
+    occupancy = await get_slot_occupancy([t.id for t in trainings], date, session=session)
+
     for t in trainings:
         hour, minute = map(int, t.time.split(':'))
         slot_time = date.replace(hour=hour, minute=minute, second=0, microsecond=0)
@@ -244,9 +263,7 @@ async def book_day(callback: CallbackQuery):
         if date.date() == now.date() and now >= slot_time:
             continue
 
-        # Считаем занятые места
-        booked = await get_bookings_count(t.id, date)
-        free = t.max_participants - booked
+        free = t.max_participants - occupancy.get(t.id, 0)
 
         if free <= 0:
             slot_label = f"🔴 {t.time} — мест нет"
@@ -283,18 +300,18 @@ async def book_day(callback: CallbackQuery):
 
 # Кнопка "Назад" из выбора времени к выбору дня
 @router.callback_query(F.data.startswith("bback_day:"))
-async def back_to_day_selection(callback: CallbackQuery):
+async def back_to_day_selection(callback: CallbackQuery, session: AsyncSession):
     """Назад к выбору дня"""
     await callback.answer()
     parts = callback.data.split(":")  # bback_day:s:a
     type_code = parts[1]
     trainer_code = parts[2]
-    await _show_day_selection(callback, type_code, trainer_code)
+    await _show_day_selection(callback, type_code, trainer_code, session)
 
 
 # ─── 5. Выбрано время: экран подтверждения ──────────────────────────
 @router.callback_query(F.data.startswith("btm:"))
-async def book_time(callback: CallbackQuery):
+async def book_time(callback: CallbackQuery, session: AsyncSession):
     """Экран подтверждения записи"""
     await callback.answer()
 
@@ -303,7 +320,7 @@ async def book_time(callback: CallbackQuery):
     date_str = parts[2]
 
     date = datetime.strptime(date_str, '%Y%m%d')
-    training = await get_training_by_id(training_id)
+    training = await get_training_by_id(training_id, session=session)
 
     if not training:
         await callback.message.edit_text(
@@ -316,7 +333,7 @@ async def book_time(callback: CallbackQuery):
 
     # Проверка двойной записи
     user_id = callback.from_user.id
-    existing = await check_user_booking(user_id, training_id, date)
+    existing = await check_user_booking(user_id, training_id, date, session=session)
     if existing:
         await callback.message.edit_text(
             "Ты уже записан(а) на эту тренировку!\n\nВыбери другое время или день.",
@@ -327,7 +344,7 @@ async def book_time(callback: CallbackQuery):
         return
 
     # Проверка мест
-    booked = await get_bookings_count(training_id, date)
+    booked = (await get_slot_occupancy([training_id], date, session=session)).get(training_id, 0)
     free = training.max_participants - booked
     if free <= 0:
         await callback.message.edit_text(
@@ -367,7 +384,7 @@ async def book_time(callback: CallbackQuery):
 
 # ─── 6. Подтверждение: создание записи + уведомление админу ────────
 @router.callback_query(F.data.startswith("bconf:"))
-async def book_confirm(callback: CallbackQuery, bot: Bot):
+async def book_confirm(callback: CallbackQuery, bot: Bot, session: AsyncSession):
     """Создание записи и уведомление админов"""
     await callback.answer()
 
@@ -378,14 +395,25 @@ async def book_confirm(callback: CallbackQuery, bot: Bot):
     date = datetime.strptime(date_str, '%Y%m%d')
     user_id = callback.from_user.id
 
-    training = await get_training_by_id(training_id)
+    training = await get_training_by_id(training_id, session=session)
     if not training:
         await callback.message.edit_text("Тренировка не найдена.")
         return
 
-    # Повторная проверка двойной записи
-    existing = await check_user_booking(user_id, training_id, date)
-    if existing:
+    # Атомарная запись: проверка дубля и мест в своей транзакции (BEGIN IMMEDIATE),
+    # а не в сессии обновления — коммит сразу, без ожидания конца обработчика
+    hour, minute = map(int, training.time.split(':'))
+    booking_datetime = date.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    reservation = await reserve_seat(user_id, training_id, booking_datetime)
+    if reservation.status == ReserveStatus.RESERVED:
+        try:
+            schedule_booking_reminder(reservation.booking_id, booking_datetime)
+        except Exception as e:
+            # Запись уже создана — клиенту отвечаем как обычно, напоминание
+            # восстановит rebuild_booking_reminders при следующем запуске
+            logger.error(f"[REMINDER] Не удалось запланировать напоминание о записи {reservation.booking_id}: {e}")
+
+    if reservation.status == ReserveStatus.ALREADY_BOOKED:
         await callback.message.edit_text(
             "Ты уже записан(а) на эту тренировку!",
             reply_markup=InlineKeyboardMarkup(
@@ -394,9 +422,7 @@ async def book_confirm(callback: CallbackQuery, bot: Bot):
         )
         return
 
-    # Повторная проверка мест
-    booked = await get_bookings_count(training_id, date)
-    if booked >= training.max_participants:
+    if reservation.status == ReserveStatus.FULL:
         await callback.message.edit_text(
             "К сожалению, все места уже заняты.",
             reply_markup=InlineKeyboardMarkup(
@@ -405,10 +431,14 @@ async def book_confirm(callback: CallbackQuery, bot: Bot):
         )
         return
 
-    # Создаём запись
-    hour, minute = map(int, training.time.split(':'))
-    booking_datetime = date.replace(hour=hour, minute=minute, second=0, microsecond=0)
-    await create_booking(user_id, training_id, booking_datetime)
+    if reservation.status == ReserveStatus.UNAVAILABLE:
+        await callback.message.edit_text(
+            "Эта тренировка больше не проводится.",
+            reply_markup=InlineKeyboardMarkup(
+                inline_keyboard=[[InlineKeyboardButton(text="📝 Записаться на другую", callback_data="book_start")]]
+            )
+        )
+        return
 
     dow = date.weekday()
 
@@ -440,7 +470,7 @@ async def book_confirm(callback: CallbackQuery, bot: Bot):
         f"🏋️ {training.name} — {training.trainer}\n"
         f"📅 {DAYS_RU[dow]}, {date.strftime('%d.%m.%Y')}\n"
         f"🕐 {training.time}\n"
-        f"👥 Записано: {booked + 1}/{training.max_participants}"
+        f"👥 Записано: {reservation.booked}/{training.max_participants}"
     )
 
     for admin_id in config.ADMIN_IDS:
@@ -451,7 +481,7 @@ async def book_confirm(callback: CallbackQuery, bot: Bot):
 
     # Cross-sell после записи
     try:
-        subscription = await get_active_subscription(user_id)
+        subscription = await get_active_subscription(user_id, session=session)
         if not subscription:
             cross_sell_kb = InlineKeyboardMarkup(
                 inline_keyboard=[
@@ -487,6 +517,12 @@ async def cancel_book(callback: CallbackQuery, bot: Bot):
     user_id = callback.from_user.id
 
     result = await cancel_booking(booking_id, user_id)
+    if result:
+        try:
+            cancel_booking_reminder(booking_id)
+        except Exception as e:
+            # Запись уже отменена; оставшееся напоминание не уйдёт — send_booking_reminder берёт только активные записи
+            logger.error(f"[REMINDER] Не удалось убрать напоминание об отменённой записи {booking_id}: {e}")
 
     if not result:
         await callback.message.edit_text(
@@ -6,7 +6,7 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 
 from keyboards.inline import online_menu_keyboard, subscription_keyboard, schedule_keyboard, payment_methods, payment_confirm_keyboard
 from database import async_session, Training, Booking, Subscription
-from schedule_data import SCHEDULE_TEXT
+from utils.schedule import get_full_schedule_text
 from sqlalchemy import select
 from datetime import datetime, timedelta
 import config
@@ -122,7 +122,7 @@ async def online_schedule(callback: CallbackQuery):
         ]
     )
 
-    await callback.message.edit_text(SCHEDULE_TEXT, reply_markup=keyboard, parse_mode='Markdown')
+    await callback.message.edit_text(get_full_schedule_text(), reply_markup=keyboard, parse_mode='Markdown')
     await callback.answer()
 
 
@@ -1,6 +1,7 @@
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
 
 from database import get_user, get_active_subscription, get_user_payments, get_user_visits, get_user_active_bookings, async_session, Payment
@@ -10,11 +11,11 @@ router = Router()
 
 
 @router.message(F.text == "👤 Мой профиль")
-async def show_profile(message: Message):
+async def show_profile(message: Message, session: AsyncSession):
     """Профиль пользователя"""
 
-    user = await get_user(message.from_user.id)
-    subscription = await get_active_subscription(message.from_user.id)
+    user = await get_user(message.from_user.id, session=session)
+    subscription = await get_active_subscription(message.from_user.id, session=session)
 
     if not user:
         await message.answer("❌ Ошибка: пользователь не найден")
@@ -68,11 +69,11 @@ DAYS_RU = ['Понедельник', 'Вторник', 'Среда', 'Четве
 
 
 @router.callback_query(F.data == "my_bookings")
-async def my_bookings(callback: CallbackQuery):
+async def my_bookings(callback: CallbackQuery, session: AsyncSession):
     """Список активных записей пользователя"""
     await callback.answer()
 
-    bookings = await get_user_active_bookings(callback.from_user.id)
+    bookings = await get_user_active_bookings(callback.from_user.id, session=session)
 
     if not bookings:
         text = "📋 МОИ ЗАПИСИ\n\nУ тебя нет предстоящих записей."
@@ -166,12 +167,12 @@ async def contact_reject(callback: CallbackQuery, bot: Bot):
 
 
 @router.callback_query(F.data == "purchase_history")
-async def purchase_history(callback: CallbackQuery):
+async def purchase_history(callback: CallbackQuery, session: AsyncSession):
     """История покупок"""
 
     user_id = callback.from_user.id
-    payments = await get_user_payments(user_id)
-    visits = await get_user_visits(user_id)
+    payments = await get_user_payments(user_id, session=session)
+    visits = await get_user_visits(user_id, session=session)
 
     text = "📜 ИСТОРИЯ ПОКУПОК\n\n"
 
@@ -218,11 +219,11 @@ async def purchase_history(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "back_profile")
-async def back_to_profile(callback: CallbackQuery):
+async def back_to_profile(callback: CallbackQuery, session: AsyncSession):
     """Возврат в профиль"""
 
-    user = await get_user(callback.from_user.id)
-    subscription = await get_active_subscription(callback.from_user.id)
+    user = await get_user(callback.from_user.id, session=session)
+    subscription = await get_active_subscription(callback.from_user.id, session=session)
 
     text = f"""
 👤 ТВОЙ ПРОФИЛЬ
@@ -3,15 +3,16 @@
 """
 from aiogram import Router, F
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ChatMemberUpdated, FSInputFile
 from aiogram.fsm.context import FSMContext
 
 from keyboards.main import main_keyboard
-from database import async_session, User, Subscription, Booking, Payment, Visit
+from database import async_session, User, Subscription, Booking, Payment, Visit, set_users_active
+from utils.export import export_user_data
 from sqlalchemy import select, delete
-from datetime import datetime
 import config
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -75,6 +76,9 @@ async def _continue_start(message: Message, from_user, state: FSMContext):
 
         await message.answer(text, reply_markup=keyboard)
     else:
+        if not user.is_active:
+            # Вернулся после блокировки бота — снова получает уведомления
+            await set_users_active([user_id], True)
         await show_main_menu(message)
 
 
@@ -107,6 +111,13 @@ async def cmd_start(message: Message, state: FSMContext):
     await _continue_start(message, message.from_user, state)
 
 
+@router.my_chat_member(F.chat.type == "private")
+async def bot_blocked_changed(event: ChatMemberUpdated):
+    """Пользователь заблокировал или разблокировал бота"""
+    is_active = event.new_chat_member.status == "member"
+    await set_users_active([event.chat.id], is_active)
+
+
 @router.callback_query(F.data == "check_subscription")
 async def check_subscription_callback(callback: CallbackQuery, state: FSMContext):
     """Проверка подписки на канал после нажатия кнопки"""
@@ -346,111 +357,29 @@ async def cancel_data_deletion(callback: CallbackQuery):
 async def export_user_data_command(message: Message):
     """Экспорт персональных данных пользователя"""
 
-    user_id = message.from_user.id
-
-    async with async_session() as session:
-        # Получаем профиль
-        result = await session.execute(
-            select(User).where(User.user_id == user_id)
-        )
-        user = result.scalar_one_or_none()
-
-        if not user:
-            await message.answer("Данные не найдены. Используй /start для регистрации.")
-            return
-
-        # Получаем абонементы
-        subs_result = await session.execute(
-            select(Subscription).where(Subscription.user_id == user_id)
-        )
-        subscriptions = subs_result.scalars().all()
-
-        # Получаем платежи
-        payments_result = await session.execute(
-            select(Payment).where(Payment.user_id == user_id)
-        )
-        payments = payments_result.scalars().all()
+    export = await export_user_data(message.from_user.id)
+    if not export:
+        await message.answer("Данные не найдены. Используй /start для регистрации.")
+        return
 
-        # Получаем бронирования
-        bookings_result = await session.execute(
-            select(Booking).where(Booking.user_id == user_id)
-        )
-        bookings = bookings_result.scalars().all()
+    if export['text']:
+        await message.answer(export['text'])
+        return
 
-        # Получаем посещения
-        visits_result = await session.execute(
-            select(Visit).where(Visit.user_id == user_id)
+    # История не помещается в сообщение — отправляем файлом
+    stats = export['stats']
+    try:
+        await message.answer_document(
+            FSInputFile(export['path'], filename=f"my_data_{message.from_user.id}.json"),
+            caption=(
+                "Ваши персональные данные (JSON)\n\n"
+                f"Всего потрачено: {stats['total_spent']}₽\n"
+                f"Всего записей: {stats['booking']}\n"
+                f"Всего посещений: {stats['visit']}"
+            )
         )
-        visits = visits_result.scalars().all()
-
-    # Формируем текстовое представление
-    subscriptions_text = ""
-    if subscriptions:
-        for sub in subscriptions:
-            status = "Активен" if sub.is_active else "Истёк"
-            end_date = sub.end_date.strftime('%d.%m.%Y') if sub.end_date else "—"
-            subscriptions_text += f"- {sub.subscription_type} до {end_date} ({status})\n"
-    else:
-        subscriptions_text = "Нет данных\n"
-
-    payments_text = ""
-    total_spent = 0
-    if payments:
-        for pay in payments:
-            date = pay.created_at.strftime('%d.%m.%Y') if pay.created_at else "—"
-            payments_text += f"- {date}: {pay.amount}₽ ({pay.status})\n"
-            if pay.status == 'confirmed':
-                total_spent += pay.amount
-    else:
-        payments_text = "Нет данных\n"
-
-    bookings_text = ""
-    if bookings:
-        for book in bookings:
-            date = book.booking_date.strftime('%d.%m.%Y %H:%M') if book.booking_date else "—"
-            bookings_text += f"- {date} ({book.status})\n"
-    else:
-        bookings_text = "Нет данных\n"
-
-    visits_text = ""
-    if visits:
-        for visit in visits:
-            date = visit.visit_date.strftime('%d.%m.%Y %H:%M') if visit.visit_date else "—"
-            visits_text += f"- {date}\n"
-    else:
-        visits_text = "Нет данных\n"
-
-    reg_date = user.created_at.strftime('%d.%m.%Y') if user.created_at else "—"
-    export_date = datetime.now().strftime("%d.%m.%Y %H:%M")
-
-    text = f"""
-ВАШИ ПЕРСОНАЛЬНЫЕ ДАННЫЕ
-
-ПРОФИЛЬ:
-- ID: {user.user_id}
-- Имя: {user.name}
-- Username: @{user.username or '—'}
-- Дата регистрации: {reg_date}
-
-АБОНЕМЕНТЫ:
-{subscriptions_text}
-ПЛАТЕЖИ:
-{payments_text}
-ЗАПИСИ НА ТРЕНИРОВКИ:
-{bookings_text}
-ПОСЕЩЕНИЯ:
-{visits_text}
-СТАТИСТИКА:
-- Всего потрачено: {total_spent}₽
-- Всего записей: {len(bookings)}
-- Всего посещений: {len(visits)}
-
-Дата экспорта: {export_date}
-
-Эти данные предоставлены в соответствии с законом о защите персональных данных.
-    """
-
-    await message.answer(text)
+    finally:
+        os.remove(export['path'])
 
 
 async def show_main_menu(message: Message):
@@ -1,9 +1,11 @@
 import os
 
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, InputMediaPhoto
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 
 from keyboards import payment_methods
+from utils.media import answer_photo_group
+from utils.schedule import get_full_schedule_text
 import config
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -41,19 +43,10 @@ async def studio_services(message: Message):
 
 @router.callback_query(F.data == "studio_schedule")
 async def show_schedule(callback: CallbackQuery):
-    """Расписание тренировок — текстом из config.SCHEDULE"""
+    """Расписание тренировок — готовый текст из utils.schedule"""
     await callback.answer()
 
-    # Собираем текст расписания из всех дней
-    days_order = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
-    schedule_parts = ["📅 *РАСПИСАНИЕ ТРЕНИРОВОК*\n\n📍 г. Новотроицк, пр. Комсомольский 3 (2 этаж)\n"]
-    for day in days_order:
-        day_text = config.SCHEDULE.get(day, "")
-        if day_text:
-            schedule_parts.append(day_text)
-    schedule_parts.append("\n📞 Анна: @\\_an\\_sport\\_\n📞 Алена: +7 961 908 0598")
-
-    text = "\n━━━━━━━━━━━━━━━━━━━\n".join(schedule_parts)
+    text = get_full_schedule_text()
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -411,10 +404,10 @@ async def about_me(message: Message):
     for filename, caption in about_photos:
         path = os.path.join(ABOUT_IMAGES_DIR, filename)
         if os.path.isfile(path):
-            media.append(InputMediaPhoto(media=FSInputFile(path), caption=caption))
+            media.append((path, caption))
 
     if media:
-        await message.answer_media_group(media=media)
+        await answer_photo_group(message, media)
     else:
         await message.answer("🙋‍♀️ Фото пока не добавлены.")
 
@@ -520,8 +513,8 @@ async def show_reviews(message: Message):
         media = []
         for i, photo_path in enumerate(photos):
             caption = "⭐ ОТЗЫВЫ НАШИХ КЛИЕНТОВ" if i == 0 else None
-            media.append(InputMediaPhoto(media=FSInputFile(photo_path), caption=caption))
-        await message.answer_media_group(media=media)
+            media.append((photo_path, caption))
+        await answer_photo_group(message, media)
     else:
         await message.answer(
             "⭐ ОТЗЫВЫ НАШИХ КЛИЕНТОВ\n\n"
@@ -592,8 +585,8 @@ async def show_before_after(message: Message):
         media = []
         for i, photo_path in enumerate(photos[:10]):
             caption = "🔄 ДО И ПОСЛЕ\n\nРезультаты наших клиентов говорят сами за себя!" if i == 0 else None
-            media.append(InputMediaPhoto(media=FSInputFile(photo_path), caption=caption))
-        await message.answer_media_group(media=media)
+            media.append((photo_path, caption))
+        await answer_photo_group(message, media)
     else:
         await message.answer("🔄 Фото до/после скоро будут добавлены!")
 
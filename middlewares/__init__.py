@@ -0,0 +1,2 @@
+from middlewares.inflight import InFlightMiddleware
+from middlewares.db_session import DbSessionMiddleware
@@ -0,0 +1,61 @@
+"""
+Одна сессия БД на обновление и счётчик SQL-запросов обработчика
+"""
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from database import async_session, start_query_count, stop_query_count
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Передаёт обработчику data['session'] — AsyncSession на всё обновление.
+
+    Соединение берётся из пула только при первом запросе, поэтому обновления
+    без обращений к БД ничего не стоят. После обработчика сессия коммитится
+    (или откатывается при исключении) и закрывается. Число SQL-запросов
+    обновления (включая хелперы со своей сессией) пишется в лог; больше
+    config.DB_QUERIES_WARN — предупреждение.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        counter, token = start_query_count()
+        started = time.monotonic()
+        try:
+            async with async_session() as session:
+                data['session'] = session
+                try:
+                    result = await handler(event, data)
+                except Exception:
+                    await session.rollback()
+                    raise
+                if session.in_transaction():
+                    await session.commit()
+                return result
+        finally:
+            stop_query_count(token)
+            self._log(event, counter[0], time.monotonic() - started)
+
+    @staticmethod
+    def _log(event: TelegramObject, queries: int, elapsed: float):
+        if isinstance(event, Update):
+            name = f"update {event.update_id} ({event.event_type})"
+        else:
+            name = type(event).__name__
+        message = f"[DB] {name}: {queries} запросов за {elapsed * 1000:.0f} мс"
+        if queries > config.DB_QUERIES_WARN:
+            logger.warning(message)
+        else:
+            logger.debug(message)
@@ -0,0 +1,188 @@
+"""
+Версионированные миграции схемы базы данных.
+
+init_db создаёт только отсутствующие таблицы, поэтому всё, что меняет уже
+существующие таблицы (индексы, новые колонки), добавляется сюда новой версией.
+Применённые версии хранятся в таблице schema_migrations.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Integer, BigInteger, String, DateTime, select, insert, text, inspect
+
+from database import engine, Base, SalesDaily, _sales_daily_backfill, USERS_SEARCH_TABLE
+
+logger = logging.getLogger(__name__)
+
+_metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', _metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', String(200)),
+    Column('applied_at', DateTime),
+)
+
+
+def _create_indexes(conn, *names):
+    """Создать индексы, объявленные в моделях, если их ещё нет"""
+    indexes = {
+        index.name: index
+        for table in Base.metadata.tables.values()
+        for index in table.indexes
+    }
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+
+def _hot_query_indexes(conn):
+    _create_indexes(
+        conn,
+        'ix_bookings_training_status_date',
+        'ix_bookings_user_status_date',
+        'ix_bookings_status_date',
+        'ix_subscriptions_user_active_end',
+        'ix_subscriptions_active_end',
+        'ix_payments_status_created',
+    )
+
+
+def _unique_active_booking(conn):
+    # Перед созданием уникального индекса снимаем уже накопившиеся дубли
+    conn.execute(text(
+        "UPDATE bookings SET status = 'cancelled' "
+        "WHERE status = 'active' AND id NOT IN ("
+        "SELECT min(id) FROM bookings WHERE status = 'active' "
+        "GROUP BY user_id, training_id, booking_date)"
+    ))
+    _create_indexes(conn, 'ux_bookings_active_slot')
+
+
+def _add_column(conn, table_name, column_name):
+    """Добавить колонку, объявленную в модели, если её ещё нет"""
+    existing = {column['name'] for column in inspect(conn).get_columns(table_name)}
+    if column_name in existing:
+        return
+    column = Base.metadata.tables[table_name].c[column_name]
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+
+
+def _user_last_visit(conn):
+    _add_column(conn, 'users', 'last_visit_at')
+    _create_indexes(conn, 'ix_visits_user_date')
+    # Заполняем по истории посещений одним агрегирующим запросом
+    conn.execute(text(
+        "UPDATE users SET last_visit_at = ("
+        "SELECT max(visit_date) FROM visits WHERE visits.user_id = users.user_id)"
+    ))
+    _create_indexes(conn, 'ix_users_active_last_visit')
+
+
+def _training_is_active(conn):
+    _add_column(conn, 'trainings', 'is_active')
+    conn.execute(text("UPDATE trainings SET is_active = TRUE WHERE is_active IS NULL"))
+
+
+def _telegram_ids_bigint(conn):
+    # В SQLite INTEGER и так 64-битный; в остальных СУБД расширяем колонки,
+    # объявленные в моделях как BigInteger (id пользователей и чатов Telegram)
+    if conn.dialect.name == 'sqlite':
+        return
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        current = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if isinstance(column.type, BigInteger) and column.name in current \
+                    and not isinstance(current[column.name], BigInteger):
+                conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT"))
+
+
+def _sales_daily(conn):
+    # Таблицу создаёт init_db, здесь — заполнение по истории платежей
+    conn.execute(SalesDaily.__table__.delete())
+    conn.execute(_sales_daily_backfill())
+
+
+def _users_search_index(conn):
+    # Индекс для /find: в SQLite — FTS5 с trigram (подстроки, в том числе кириллица)
+    # поверх users и триггеры, в PostgreSQL — GIN-индексы pg_trgm для ILIKE.
+    # Если СУБД не умеет (старый SQLite, нет прав на расширение) — поиск работает LIKE
+    if conn.dialect.name == 'sqlite':
+        statements = [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {USERS_SEARCH_TABLE} USING fts5("
+            "name, username, phone, content='users', content_rowid='id', tokenize='trigram')",
+            f"CREATE TRIGGER IF NOT EXISTS {USERS_SEARCH_TABLE}_ai AFTER INSERT ON users BEGIN "
+            f"INSERT INTO {USERS_SEARCH_TABLE}(rowid, name, username, phone) "
+            "VALUES (new.id, new.name, new.username, new.phone); END",
+            f"CREATE TRIGGER IF NOT EXISTS {USERS_SEARCH_TABLE}_ad AFTER DELETE ON users BEGIN "
+            f"INSERT INTO {USERS_SEARCH_TABLE}({USERS_SEARCH_TABLE}, rowid, name, username, phone) "
+            "VALUES ('delete', old.id, old.name, old.username, old.phone); END",
+            f"CREATE TRIGGER IF NOT EXISTS {USERS_SEARCH_TABLE}_au AFTER UPDATE OF name, username, phone "
+            f"ON users BEGIN "
+            f"INSERT INTO {USERS_SEARCH_TABLE}({USERS_SEARCH_TABLE}, rowid, name, username, phone) "
+            "VALUES ('delete', old.id, old.name, old.username, old.phone); "
+            f"INSERT INTO {USERS_SEARCH_TABLE}(rowid, name, username, phone) "
+            "VALUES (new.id, new.name, new.username, new.phone); END",
+            f"INSERT INTO {USERS_SEARCH_TABLE}({USERS_SEARCH_TABLE}) VALUES ('rebuild')",
+        ]
+    elif conn.dialect.name == 'postgresql':
+        statements = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+            f"CREATE INDEX IF NOT EXISTS ix_users_{column}_trgm ON users USING gin ({column} gin_trgm_ops)"
+            for column in ('name', 'username', 'phone')
+        ]
+    else:
+        return
+
+    savepoint = conn.begin_nested()
+    try:
+        for statement in statements:
+            conn.execute(text(statement))
+    except Exception as e:
+        savepoint.rollback()
+        logger.warning(f"[MIGRATION] Индекс поиска клиентов не создан, /find будет искать через LIKE: {e}")
+    else:
+        savepoint.commit()
+
+
+def _subscription_payment_link(conn):
+    # Старые абонементы остаются без оплаты: их привязывает сверка (reconcile_subscriptions)
+    _add_column(conn, 'subscriptions', 'payment_id')
+    _create_indexes(conn, 'ix_subscriptions_payment', 'ix_payments_status_confirmed')
+
+
+# (версия, описание, функция(sync_connection))
+MIGRATIONS = [
+    (1, 'Составные индексы для горячих запросов', _hot_query_indexes),
+    (2, 'Уникальная активная запись на слот', _unique_active_booking),
+    (3, 'Дата последнего посещения в users', _user_last_visit),
+    (4, 'Флаг is_active у тренировок', _training_is_active),
+    (5, 'BIGINT для id пользователей и чатов Telegram', _telegram_ids_bigint),
+    (6, 'Сводка продаж по дням (sales_daily)', _sales_daily),
+    (7, 'Индекс поиска клиентов (/find)', _users_search_index),
+    (8, 'Связь абонемента с оплатой', _subscription_payment_link),
+]
+
+
+def _apply_migrations(conn):
+    schema_migrations.create(conn, checkfirst=True)
+    applied = set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"[MIGRATION] v{version}: {description}")
+        migrate(conn)
+        conn.execute(insert(schema_migrations).values(
+            version=version,
+            description=description,
+            applied_at=datetime.utcnow()
+        ))
+
+
+async def run_migrations():
+    """Применить недостающие миграции (идемпотентно)"""
+    async with engine.begin() as conn:
+        await conn.run_sync(_apply_migrations)
@@ -1,143 +0,0 @@
-# schedule_data.py
-
-SCHEDULE_TEXT = """
-📍 *Адрес студии:*
-г. Новотроицк, пр. Комсомольский 3 (второй этаж)
-
-💜💜💜💜💜💜💜💜💜💜
-
-🔘 *ПОНЕДЕЛЬНИК, СРЕДА, ПЯТНИЦА*
-
-🏃‍♀️ *Силовые тренировки*
-
-👩‍🏫 *Тренер Анна:*
-Понедельник, Среда:
-✅ Группа 1 — 8:30
-✅ Группа 2 — 17:10
-✅ Группа 3 — 18:10
-Пятница:
-✅ Группа 1 — 8:30
-✅ Группа 2, 3 — 17:10
-
-👩‍🏫 *Тренер Алена:*
-Понедельник — 19:10, 20:10
-Среда — 19:10, 20:10
-Пятница — 19:10
-
-🧘‍♀️ *Пилатес с роллом и досками Садху*
-✅ 9:30
-👩‍🏫 Тренер: Анна
-
-━━━━━━━━━━━━━━━━━━━
-
-🔘 *ВТОРНИК, ЧЕТВЕРГ*
-
-🏃‍♀️ *Барре*
-✅ 8:30
-👩‍🏫 Тренер: Анна
-
-━━━━━━━━━━━━━━━━━━━
-
-🔘 *СУББОТА*
-
-🏃‍♀️ *Барре*
-✅ 10:00
-👩‍🏫 Тренер: Анна
-
-━━━━━━━━━━━━━━━━━━━
-
-ℹ️ *Начало действия абонемента:*
-Срок действия начинается с 1-го числа месяца
-
-⏰ *Окончание действия:*
-Абонемент заканчивается в последний день месяца
-
-📞 *Контакты:*
-• Анна: @\\_an\\_sport\\_
-• Алена: +7 961 908 0598
-"""
-
-SCHEDULE_BY_DAY = {
-    "monday": """
-🔘 *ПОНЕДЕЛЬНИК*
-
-🏃‍♀️ *Силовые тренировки*
-👩‍🏫 Тренер Анна:
-✅ Группа 1 — 8:30
-✅ Группа 2 — 17:10
-✅ Группа 3 — 18:10
-👩‍🏫 Тренер Алена:
-✅ 19:10
-✅ 20:10
-
-🧘‍♀️ *Пилатес*
-✅ 9:30 - Анна
-""",
-
-    "tuesday": """
-🔘 *ВТОРНИК*
-
-🏃‍♀️ *Барре*
-✅ 8:30 - Анна
-""",
-
-    "wednesday": """
-🔘 *СРЕДА*
-
-🏃‍♀️ *Силовые тренировки*
-👩‍🏫 Тренер Анна:
-✅ Группа 1 — 8:30
-✅ Группа 2 — 17:10
-✅ Группа 3 — 18:10
-👩‍🏫 Тренер Алена:
-✅ 19:10
-✅ 20:10
-
-🧘‍♀️ *Пилатес*
-✅ 9:30 - Анна
-""",
-
-    "thursday": """
-🔘 *ЧЕТВЕРГ*
-
-🏃‍♀️ *Барре*
-✅ 8:30 - Анна
-""",
-
-    "friday": """
-🔘 *ПЯТНИЦА*
-
-🏃‍♀️ *Силовые тренировки*
-👩‍🏫 Тренер Анна:
-✅ Группа 1 — 8:30
-✅ Группа 2, 3 — 17:10
-👩‍🏫 Тренер Алена:
-✅ 19:10
-
-🧘‍♀️ *Пилатес*
-✅ 9:30 - Анна
-""",
-
-    "saturday": """
-🔘 *СУББОТА*
-
-🏃‍♀️ *Барре*
-✅ 10:00 - Анна
-""",
-
-    "sunday": """
-🔘 *ВОСКРЕСЕНЬЕ*
-
-🌴 Выходной день
-Восстанавливаемся и набираемся сил! 💪
-"""
-}
-
-CONTACT_INFO = """
-📞 *Контакты студии:*
-
-👩‍🏫 Анна: @\\_an\\_sport\\_
-👩‍🏫 Алена: +7 961 908 0598
-
-📍 Адрес: г. Новотроицк, пр. Комсомольский 3 (второй этаж)
-"""
@@ -0,0 +1,56 @@
+"""
+Общие настройки тестов.
+
+База и файлы данных (prices.json, schedule.json) — во временном каталоге:
+переменные окружения выставляются до первого импорта config/database.
+Тесты синхронные, корутины запускаются через run() — без pytest-asyncio.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TMP_DIR = tempfile.mkdtemp(prefix='fitness_bot_tests_')
+TEST_DB_PATH = os.path.join(_TMP_DIR, 'bot.db')
+
+os.environ['DATA_DIR'] = _TMP_DIR
+os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{TEST_DB_PATH}'
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('ADMIN_ID', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from migrations import run_migrations  # noqa: E402
+
+
+def run(coro):
+    """Выполнить корутину в новом цикле событий; пул соединений закрывается
+    в том же цикле, чтобы следующий тест начинал с чистого пула"""
+    async def main():
+        try:
+            return await coro
+        finally:
+            await database.engine.dispose()
+    return asyncio.run(main())
+
+
+async def _create_schema():
+    await database.init_db()
+    await run_migrations()
+
+
+@pytest.fixture
+def db():
+    """Пустая база со всеми таблицами и миграциями"""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(TEST_DB_PATH + suffix):
+            os.remove(TEST_DB_PATH + suffix)
+    database.invalidate_training_cache()
+    # Блокировка привязывается к циклу событий, а у каждого теста цикл свой
+    database._sqlite_reserve_lock = asyncio.Lock()
+    database._search_index['available'] = None
+    run(_create_schema())
+    return database
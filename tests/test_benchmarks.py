@@ -0,0 +1,537 @@
+"""
+Замеры производительности на синтетических данных.
+
+Не входят в обычный прогон: pytest -m benchmark -s
+Время печатается, пороги в assert — с большим запасом, чтобы ловить только
+деградацию на порядок (например, возврат к запросу на каждого клиента).
+"""
+import random
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from tests.conftest import run
+
+pytestmark = pytest.mark.benchmark
+
+CHUNK = 5000
+
+
+async def _bulk_insert(db, model, rows):
+    async with db.async_session() as session:
+        for i in range(0, len(rows), CHUNK):
+            await session.execute(insert(model), rows[i:i + CHUNK])
+        await session.commit()
+
+
+def _users(count, start=1):
+    now = datetime.utcnow()
+    return [
+        {
+            'user_id': 1_000_000 + i,
+            'username': f'user{i}',
+            'name': f'Клиент {i}',
+            'phone': f'+7900{i:07d}',
+            'created_at': now - timedelta(minutes=i),
+            'is_active': True,
+        }
+        for i in range(start, start + count)
+    ]
+
+
+def _subscriptions(user_ids, rng):
+    now = datetime.utcnow()
+    rows = []
+    for user_id in user_ids:
+        start = now - timedelta(days=rng.randint(0, 60))
+        rows.append({
+            'user_id': user_id,
+            'subscription_type': rng.choice(['8 занятий', '12 занятий', 'Безлимит']),
+            'start_date': start,
+            'end_date': start + timedelta(days=30),
+            'is_active': True,
+        })
+    return rows
+
+
+def _report(name, seconds, extra=''):
+    print(f"\n[BENCH] {name}: {seconds * 1000:.1f} мс{extra}")
+
+
+# --- user-002: список клиентов ---
+
+async def _old_get_all_clients(db):
+    """Прежняя реализация: все клиенты и запрос абонемента на каждого"""
+    async with db.async_session() as session:
+        users = (await session.execute(select(db.User).order_by(db.User.created_at.desc()))).scalars().all()
+        clients = []
+        for user in users:
+            sub = (await session.execute(
+                select(db.Subscription).where(
+                    db.Subscription.user_id == user.user_id,
+                    db.Subscription.is_active == True
+                ).limit(1)
+            )).scalar_one_or_none()
+            clients.append((user.user_id, sub.subscription_type if sub else None))
+        return clients
+
+
+def test_clients_page_50k(db):
+    rng = random.Random(2)
+
+    async def scenario():
+        users = _users(50_000)
+        await _bulk_insert(db, db.User, users)
+        with_sub = [u['user_id'] for u in users if rng.random() < 0.6]
+        await _bulk_insert(db, db.Subscription, _subscriptions(with_sub, rng))
+
+        started = time.perf_counter()
+        page = await db.get_clients_page(limit=10)
+        first = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in range(20):
+            page = await db.get_clients_page(after_id=page['clients'][-1]['id'], limit=10)
+        deep = (time.perf_counter() - started) / 20
+
+        started = time.perf_counter()
+        old = await _old_get_all_clients(db)
+        old_elapsed = time.perf_counter() - started
+        return first, deep, old_elapsed, len(old)
+
+    first, deep, old_elapsed, old_count = run(scenario())
+    _report('get_clients_page, первая страница из 50k', first)
+    _report('get_clients_page, следующая страница', deep)
+    _report('прежний get_all_clients (N+1)', old_elapsed, f', {old_count} клиентов')
+    assert old_count == 50_000
+    assert deep * 20 < old_elapsed
+
+
+# --- user-008: FSM-хранилище в БД ---
+
+def _fsm_dispatcher(storage, isolation=None):
+    from aiogram import Dispatcher, F
+    from aiogram.fsm.context import FSMContext
+    from aiogram.types import Message
+
+    dp = Dispatcher(storage=storage, events_isolation=isolation) if isolation else Dispatcher(storage=storage)
+
+    @dp.message(F.text == 'меню')
+    async def menu(message: Message, state: FSMContext):
+        # Кнопка меню: сбросить незаконченный диалог (обычно сбрасывать нечего)
+        await state.clear()
+
+    @dp.message()
+    async def step(message: Message, state: FSMContext):
+        # Шаг диалога: прочитать данные, дописать, сменить состояние
+        data = await state.get_data()
+        await state.update_data(step=data.get('step', 0) + 1, text=message.text)
+        await state.set_state('Booking:confirm')
+
+    return dp
+
+
+def _message_updates(count, text=None, users=100):
+    from aiogram.types import Update
+    now = int(time.time())
+    return [
+        Update.model_validate({
+            'update_id': i,
+            'message': {
+                'message_id': i, 'date': now, 'text': text or f'шаг {i}',
+                'chat': {'id': 1000 + i % users, 'type': 'private'},
+                'from': {'id': 1000 + i % users, 'is_bot': False, 'first_name': 'Клиент'},
+            },
+        })
+        for i in range(count)
+    ]
+
+
+FSM_BUDGET = 0.001  # целевая надбавка к обновлению относительно MemoryStorage
+
+
+@pytest.mark.xfail(reason='чтение из БД на каждое обновление (нужно нескольким процессам) '
+                          'стоит 0.5–1.2 мс на SQLite — бюджет 1 мс пока не достигнут')
+def test_fsm_storage_overhead(db):
+    from aiogram import Bot
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from utils.fsm_storage import SQLAlchemyStorage, SQLAlchemyEventIsolation
+
+    menu_updates = _message_updates(2000, text='меню')
+    step_updates = _message_updates(2000)
+
+    async def feed(dp, updates):
+        bot = Bot(token='123456:TEST')
+        started = time.perf_counter()
+        for update in updates:
+            await dp.feed_update(bot, update)
+        return (time.perf_counter() - started) / len(updates)
+
+    async def scenario():
+        memory_dp = _fsm_dispatcher(MemoryStorage())
+        storage = SQLAlchemyStorage(ttl=3600)
+        sql_dp = _fsm_dispatcher(storage, SQLAlchemyEventIsolation(storage))
+        results = {
+            'menu': (await feed(memory_dp, menu_updates), await feed(sql_dp, menu_updates)),
+            'step': (await feed(memory_dp, step_updates), await feed(sql_dp, step_updates)),
+        }
+        await storage.close()
+        return results
+
+    results = run(scenario())
+    for name, title in (('menu', 'обновление без изменений FSM'), ('step', 'шаг диалога с записью')):
+        memory, sql = results[name]
+        _report(f'{title}, MemoryStorage', memory)
+        _report(f'{title}, SQLAlchemyStorage', sql, f' (+{(sql - memory) * 1000:.2f} мс на обновление)')
+    assert results['menu'][1] - results['menu'][0] < FSM_BUDGET
+    assert results['step'][1] - results['step'][0] < FSM_BUDGET
+
+
+# --- user-010: неактивные клиенты ---
+
+async def _iterate_inactive(db, slot):
+    import tracemalloc
+    from sqlalchemy import delete
+    from utils.notifications import iter_inactive_users
+
+    async with db.async_session() as session:
+        await session.execute(delete(db.NotificationLog))
+        await session.commit()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = 0
+    async for _ in iter_inactive_users(slot):
+        count += 1
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+
+def test_inactive_users_10k_x_200_visits(db):
+    from migrations import _user_last_visit
+
+    users, visits_per_user = 10_000, 200
+    now = datetime.utcnow()
+
+    def visit_rows(days_back):
+        # Последнее посещение: у чётных — вчера, у нечётных — 10 дней назад
+        for i in range(users):
+            last = now - timedelta(days=1 if i % 2 == 0 else 10)
+            for day in days_back:
+                yield {'user_id': 1_000_000 + i, 'training_id': 1, 'visit_date': last - timedelta(days=day)}
+
+    async def insert_visits(days_back):
+        batch = []
+        async with db.async_session() as session:
+            for row in visit_rows(days_back):
+                batch.append(row)
+                if len(batch) == CHUNK * 4:
+                    await session.execute(insert(db.Visit), batch)
+                    batch = []
+            if batch:
+                await session.execute(insert(db.Visit), batch)
+            await session.commit()
+
+    async def backfill():
+        started = time.perf_counter()
+        async with db.engine.begin() as conn:
+            await conn.run_sync(_user_last_visit)
+        return time.perf_counter() - started
+
+    async def scenario():
+        await _bulk_insert(db, db.User, _users(users))
+        await insert_visits([0])
+        await backfill()
+        short = await _iterate_inactive(db, now)
+        # Та же последняя дата, но ещё 199 посещений в истории каждого клиента
+        await insert_visits(range(2, visits_per_user * 2, 2)[:visits_per_user - 1])
+        migration = await backfill()
+        long = await _iterate_inactive(db, now)
+        return short, long, migration
+
+    short, long, migration = run(scenario())
+    _report('миграция last_visit_at (10k × 200 посещений)', migration)
+    for title, (count, elapsed, peak) in (('1 посещение', short), ('200 посещений', long)):
+        _report(f'iter_inactive_users, {title} на клиента', elapsed,
+                f', {count} клиентов, пик памяти {peak / 1024 / 1024:.2f} МБ')
+    assert short[0] == long[0] == users // 2
+    # Память не растёт с историей посещений
+    assert long[2] < short[2] * 1.5 + 512 * 1024
+
+
+# --- user-013: отложенные задачи воронок ---
+
+async def _max_loop_lag(coro):
+    """Выполнить корутину, замеряя наибольшую задержку цикла событий"""
+    import asyncio
+
+    lags = [0.0]
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    task = asyncio.create_task(ticker())
+    try:
+        result = await coro
+    finally:
+        done.set()
+        await task
+    return result, max(lags)
+
+
+def test_funnel_jobs_10k(db):
+    import utils.scheduler as scheduler_module
+
+    funnels = 10_000
+
+    async def schedule_all():
+        for user_id in range(funnels):
+            await scheduler_module.schedule_video_funnel(1_000_000 + user_id)
+
+    async def scenario():
+        scheduler = scheduler_module.setup_scheduler(bot=None)
+        started = time.perf_counter()
+        _, schedule_lag = await _max_loop_lag(schedule_all())
+        scheduling = time.perf_counter() - started
+        scheduler.shutdown(wait=False)
+
+        # Перезапуск: новый планировщик, задачи из scheduled_jobs
+        scheduler = scheduler_module.setup_scheduler(bot=None)
+        started = time.perf_counter()
+        loaded, reload_lag = await _max_loop_lag(scheduler_module.load_durable_jobs())
+        reload = time.perf_counter() - started
+        jobs = len(scheduler.get_jobs())
+        scheduler.shutdown(wait=False)
+        return scheduling, schedule_lag, loaded, reload, reload_lag, jobs
+
+    scheduling, schedule_lag, loaded, reload, reload_lag, jobs = run(scenario())
+    _report(f'schedule_video_funnel × {funnels}', scheduling,
+            f' ({scheduling / funnels / 2 * 1000:.2f} мс на задачу, задержка цикла до {schedule_lag * 1000:.1f} мс)')
+    _report(f'load_durable_jobs, {loaded} задач', reload, f' (задержка цикла до {reload_lag * 1000:.0f} мс)')
+    assert loaded == funnels * 2
+    assert jobs >= loaded
+
+
+# --- user-017: пул соединений SQLite под конкурентной записью ---
+
+CLIENTS = 50
+ROUNDS = 10
+
+
+class _NullPool(NullPool):
+    """NullPool, принимающий настройки пула из create_engine_from_config"""
+
+    def __init__(self, creator, pool_size=None, max_overflow=None, timeout=None, **kw):
+        super().__init__(creator, **kw)
+
+
+async def _book_and_pay(db, user_id, training_id, slot):
+    """Запись на тренировку, pending-платёж и его подтверждение — три транзакции записи"""
+    await db.reserve_seat(user_id, training_id, slot)
+    async with db.async_session() as session:
+        payment = db.Payment(user_id=user_id, amount=1000, payment_type='8 занятий', status='pending')
+        session.add(payment)
+        await session.commit()
+    await db.confirm_payment(payment.id)
+
+
+async def _write_throughput(db, engine, training_id, slot):
+    import asyncio
+
+    saved = db.engine, db.async_session
+    db.engine = engine
+    db.async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    try:
+        started = time.perf_counter()
+        for round_no in range(ROUNDS):
+            base = 1_000_000 + round_no * CLIENTS
+            await asyncio.gather(*(
+                _book_and_pay(db, base + i, training_id, slot) for i in range(CLIENTS)
+            ))
+        return time.perf_counter() - started
+    finally:
+        await engine.dispose()
+        db.engine, db.async_session = saved
+
+
+def test_write_contention_pool_vs_nullpool(db, monkeypatch):
+    writes = CLIENTS * ROUNDS * 3
+    pooled = db.create_engine_from_config()
+    monkeypatch.setattr(db, 'AsyncAdaptedQueuePool', _NullPool)
+    unpooled = db.create_engine_from_config()
+    monkeypatch.undo()
+
+    async def scenario():
+        await _bulk_insert(db, db.User, _users(CLIENTS * ROUNDS))
+        async with db.async_session() as session:
+            trainings = [
+                db.Training(name='Пилатес', trainer='Анна', day_of_week=0, time=f'{hour}:00',
+                            max_participants=CLIENTS * ROUNDS, training_type='studio', is_active=True)
+                for hour in (18, 19)
+            ]
+            session.add_all(trainings)
+            await session.commit()
+        slot = (datetime.now() + timedelta(days=1)).replace(hour=19, minute=0, second=0, microsecond=0)
+        null_time = await _write_throughput(db, unpooled, trainings[0].id, slot)
+        pool_time = await _write_throughput(db, pooled, trainings[1].id, slot)
+        async with db.async_session() as session:
+            confirmed = (await session.execute(
+                select(func.count(db.Payment.id)).where(db.Payment.status == 'confirmed')
+            )).scalar()
+        return null_time, pool_time, confirmed
+
+    null_time, pool_time, confirmed = run(scenario())
+    _report(f'NullPool, {CLIENTS} клиентов × {ROUNDS}', null_time, f' ({writes / null_time:.0f} записей/с)')
+    _report(f'AsyncAdaptedQueuePool, {CLIENTS} клиентов × {ROUNDS}', pool_time, f' ({writes / pool_time:.0f} записей/с)')
+    assert confirmed == CLIENTS * ROUNDS * 2
+    assert pool_time < null_time * 2
+
+
+# --- user-022: аналитика удержания ---
+
+def _subscription_history(user_ids, rng, months=24):
+    """Абонементы по месяцам за months месяцев: клиент приходит в случайный месяц
+    и продлевает с вероятностью 0.6; посещений 0–12 за абонемент"""
+    today = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+    first = today.replace(day=1) - timedelta(days=30 * months)
+    subscriptions, visits = [], []
+    for user_id in user_ids:
+        start = first + timedelta(days=30 * rng.randrange(months) + rng.randrange(28))
+        while start < today:
+            end = start + timedelta(days=30)
+            subscriptions.append({
+                'user_id': user_id,
+                'subscription_type': rng.choice(['8 занятий', '12 занятий', 'Безлимит']),
+                'start_date': start,
+                'end_date': end,
+                'is_active': end >= today,
+            })
+            for _ in range(rng.randint(0, 12)):
+                visits.append({'user_id': user_id, 'visit_date': start + timedelta(days=rng.randrange(30))})
+            if rng.random() > 0.6:
+                break
+            start = end + timedelta(days=rng.randrange(3))
+    return subscriptions, visits
+
+
+def test_retention_report_20k_users_2_years(db):
+    from utils.analytics import build_retention_report
+
+    users = 20_000
+    rng = random.Random(22)
+
+    async def scenario():
+        rows = _users(users)
+        await _bulk_insert(db, db.User, rows)
+        subscriptions, visits = _subscription_history([row['user_id'] for row in rows], rng)
+        await _bulk_insert(db, db.Subscription, subscriptions)
+        await _bulk_insert(db, db.Visit, visits)
+
+        timings = {}
+        today = datetime.now().date()
+        current_month = today.year * 12 + today.month - 1
+        for name, call in (
+            ('get_subscription_cohorts', lambda: db.get_subscription_cohorts(current_month - 11)),
+            ('get_renewal_stats', lambda: db.get_renewal_stats(current_month - 6, current_month - 1)),
+            ('get_visit_histogram', lambda: db.get_visit_histogram(datetime.now() - timedelta(days=180))),
+        ):
+            started = time.perf_counter()
+            await call()
+            timings[name] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        report = await build_retention_report()
+        timings['build_retention_report'] = time.perf_counter() - started
+        return len(subscriptions), len(visits), timings, report
+
+    subscriptions, visits, timings, report = run(scenario())
+    for name, seconds in timings.items():
+        _report(f'{name} ({users} клиентов, {subscriptions} абонементов, {visits} посещений)', seconds)
+    assert report['cohorts'] and report['renewals']
+    assert report['subscriptions'] > 0
+    assert timings['build_retention_report'] < 10
+
+
+# --- user-024: поиск клиентов ---
+
+FIRST_NAMES = ['Анна', 'Мария', 'Елена', 'Ольга', 'Наталья', 'Ирина', 'Светлана', 'Татьяна', 'Юлия', 'Дарья']
+LAST_NAMES = ['Иванова', 'Смирнова', 'Кузнецова', 'Попова', 'Соколова', 'Лебедева', 'Козлова',
+              'Новикова', 'Морозова', 'Петрова', 'Волкова', 'Соловьёва', 'Васильева', 'Зайцева']
+
+
+def _named_users(count, rng):
+    rows = _users(count)
+    for row in rows:
+        row['name'] = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    return rows
+
+
+def test_client_search_100k(db):
+    users = 100_000
+    repeats = 20
+    rng = random.Random(24)
+    queries = {
+        'редкая фамилия + имя': 'Зайцева Дарья',
+        'частое имя': 'Анна',
+        'username': 'user77777',
+        'фрагмент телефона': '0054321',
+        'короткое слово + длинное': 'Ан Петрова',
+        'только короткое слово': 'Ол',
+        'нет совпадений': 'Ксенофонтова',
+        'нет совпадений, короткое': 'Щз',
+    }
+
+    async def timed(call):
+        samples = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            result = await call()
+            samples.append(time.perf_counter() - started)
+        samples.sort()
+        return result, samples[len(samples) // 2], samples[-1]
+
+    async def scenario():
+        rows = _named_users(users, rng)
+        await _bulk_insert(db, db.User, rows)
+        user_ids = [row['user_id'] for row in rows]
+        await _bulk_insert(db, db.Subscription, _subscriptions(user_ids[::3], rng))
+        async with db.async_session() as session:
+            training = db.Training(name='Пилатес', trainer='Анна', day_of_week=0, time='19:00',
+                                   max_participants=20, training_type='studio', is_active=True)
+            session.add(training)
+            await session.commit()
+        tomorrow = datetime.now() + timedelta(days=1)
+        await _bulk_insert(db, db.Booking, [
+            {'user_id': user_id, 'training_id': training.id, 'status': 'active',
+             'booking_date': tomorrow + timedelta(days=7 * week)}
+            for user_id in user_ids[::50] for week in range(4)
+        ])
+
+        results = {}
+        for name, query in queries.items():
+            results[name] = await timed(lambda: db.search_clients(query))
+        card_user = user_ids[0]
+        results['карточка клиента'] = await timed(lambda: db.get_client_card(card_user))
+        return results
+
+    results = run(scenario())
+    for name, (result, median, worst) in results.items():
+        found = len(result) if isinstance(result, list) else 1
+        _report(f'{name} ({users} клиентов)', median, f' медиана, худший {worst * 1000:.1f} мс, найдено {found}')
+    assert len(results['редкая фамилия + имя'][0]) == 10
+    assert results['username'][0][0]['username'] == 'user77777'
+    assert results['нет совпадений'][0] == []
+    assert results['карточка клиента'][0]['subscription'] is not None
+    assert len(results['карточка клиента'][0]['bookings']) == 4
+    assert max(worst for _, _, worst in results.values()) < 1
@@ -0,0 +1,68 @@
+"""Смена статуса рассылки: устаревшие кнопки не возобновляют завершённую рассылку"""
+from tests.conftest import run
+
+
+async def _broadcast(db):
+    async with db.async_session() as session:
+        session.add(db.User(user_id=100, username='client', name='Клиент'))
+        await session.commit()
+    broadcast_id, total = await db.create_broadcast('all', 'Привет', admin_chat_id=1, admin_message_id=1)
+    assert total == 1
+    return broadcast_id
+
+
+def test_pause_resume_cancel(db):
+    async def scenario():
+        broadcast_id = await _broadcast(db)
+        assert await db.set_broadcast_status(broadcast_id, 'paused')
+        assert not await db.set_broadcast_status(broadcast_id, 'paused')
+        assert await db.set_broadcast_status(broadcast_id, 'running')
+        assert await db.set_broadcast_status(broadcast_id, 'cancelled')
+        return (await db.get_broadcast(broadcast_id))['status']
+    assert run(scenario()) == 'cancelled'
+
+
+def test_stale_buttons_after_finish(db):
+    async def scenario():
+        broadcast_id = await _broadcast(db)
+        assert await db.set_broadcast_status(broadcast_id, 'done')
+        changed = [
+            await db.set_broadcast_status(broadcast_id, status)
+            for status in ('running', 'paused', 'cancelled', 'done')
+        ]
+        return changed, (await db.get_broadcast(broadcast_id))['status']
+    assert run(scenario()) == ([False, False, False, False], 'done')
+
+
+class _ResumingBot:
+    """Бот, у которого админ жмёт «Продолжить», пока воркер обновляет прогресс после паузы"""
+
+    def __init__(self, broadcast_id):
+        self.broadcast_id = broadcast_id
+        self.resumed = None
+        self.sent = []
+
+    async def edit_message_text(self, text, **kwargs):
+        if self.resumed is None and '⏸' in text:
+            from utils.broadcast import resume_broadcast_job
+            self.resumed = await resume_broadcast_job(self, self.broadcast_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+
+
+def test_resume_while_worker_finishes(db):
+    from utils import broadcast as broadcast_module
+
+    async def scenario():
+        broadcast_id = await _broadcast(db)
+        assert await db.set_broadcast_status(broadcast_id, 'paused')
+        bot = _ResumingBot(broadcast_id)
+        await broadcast_module.start_broadcast_job(bot, broadcast_id)
+        return bot, (await db.get_broadcast(broadcast_id))['status'], broadcast_module._tasks
+
+    bot, status, tasks = run(scenario())
+    assert bot.resumed is True
+    assert bot.sent == [100]
+    assert status == 'done'
+    assert not tasks
@@ -0,0 +1,30 @@
+"""Keyset-пагинация списка клиентов"""
+from datetime import datetime, timedelta
+
+from tests.conftest import run
+
+
+def test_pages_cover_all_clients(db):
+    async def scenario():
+        async with db.async_session() as session:
+            for i in range(1, 26):
+                session.add(db.User(user_id=1000 + i, name=f'Клиент {i}'))
+            session.add(db.Subscription(
+                user_id=1025, subscription_type='12 занятий',
+                start_date=datetime.utcnow(), end_date=datetime.utcnow() + timedelta(days=30), is_active=True
+            ))
+            await session.commit()
+
+        pages = [await db.get_clients_page(limit=10)]
+        while pages[-1]['has_next']:
+            pages.append(await db.get_clients_page(after_id=pages[-1]['clients'][-1]['id'], limit=10))
+        back = await db.get_clients_page(before_id=pages[1]['clients'][0]['id'], limit=10)
+        return pages, back
+
+    pages, back = run(scenario())
+    ids = [c['user_id'] for page in pages for c in page['clients']]
+    assert ids == list(range(1025, 1000, -1))
+    assert [len(p['clients']) for p in pages] == [10, 10, 5]
+    assert pages[0]['total'] == 25 and not pages[0]['has_prev'] and not pages[-1]['has_next']
+    assert pages[0]['clients'][0]['sub_type'] == '12 занятий'
+    assert back['clients'] == pages[0]['clients']
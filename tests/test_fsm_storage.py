@@ -0,0 +1,104 @@
+"""FSM-хранилище в БД: чтение без долгого кэша и запись в конце обновления"""
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Message, Update
+
+import utils.fsm_storage as fsm_storage
+from utils.fsm_storage import SQLAlchemyStorage, SQLAlchemyEventIsolation
+from tests.conftest import run
+
+TTL = 3600
+KEY = StorageKey(bot_id=1, chat_id=100, user_id=100)
+
+
+def _message_update(update_id: int, text: str) -> Update:
+    return Update.model_validate({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 100, 'type': 'private'},
+            'from': {'id': 100, 'is_bot': False, 'first_name': 'Клиент'},
+            'text': text,
+        },
+    })
+
+
+def _count_saves(monkeypatch):
+    calls = []
+    save = fsm_storage.save_fsm_states
+
+    async def counting_save(records):
+        calls.append(len(records))
+        await save(records)
+
+    monkeypatch.setattr(fsm_storage, 'save_fsm_states', counting_save)
+    return calls
+
+
+def test_other_process_sees_changes_immediately(db):
+    first, second = SQLAlchemyStorage(ttl=TTL), SQLAlchemyStorage(ttl=TTL)
+
+    async def scenario():
+        assert await second.get_state(KEY) is None
+        async with first.update_scope():
+            await first.set_state(KEY, 'Booking:date')
+            await first.set_data(KEY, {'training_id': 7})
+            # До конца обновления изменения видны только своему обработчику
+            assert await second.get_state(KEY) is None
+        seen = await second.get_state(KEY), await second.get_data(KEY)
+
+        async with second.update_scope():
+            await second.set_state(KEY, None)
+            await second.set_data(KEY, {})
+        return seen, await first.get_state(KEY), await first.get_data(KEY)
+
+    seen, state, data = run(scenario())
+    assert seen == ('Booking:date', {'training_id': 7})
+    assert state is None and data == {}
+
+
+def test_one_write_per_update(db, monkeypatch):
+    saves = _count_saves(monkeypatch)
+    storage = SQLAlchemyStorage(ttl=TTL)
+
+    async def scenario():
+        async with storage.update_scope():
+            await storage.set_state(KEY, 'Booking:date')
+            await storage.set_data(KEY, {'a': 1})
+            await storage.set_data(KEY, {'a': 1, 'b': 2})
+        assert saves == [1]
+        # Сброс пустого состояния (кнопки меню) ничего не пишет
+        async with storage.update_scope():
+            await storage.set_state(StorageKey(bot_id=1, chat_id=200, user_id=200), None)
+            await storage.set_data(StorageKey(bot_id=1, chat_id=200, user_id=200), {})
+        assert saves == [1]
+        # Вне обновления — сразу в БД
+        await storage.set_data(KEY, {'a': 3})
+        return await SQLAlchemyStorage(ttl=TTL).get_data(KEY)
+
+    assert run(scenario()) == {'a': 3}
+    assert saves == [1, 1]
+
+
+def test_dispatcher_flushes_when_update_finishes(db):
+    storage = SQLAlchemyStorage(ttl=TTL)
+    dp = Dispatcher(storage=storage, events_isolation=SQLAlchemyEventIsolation(storage))
+
+    @dp.message()
+    async def handler(message: Message, state: FSMContext):
+        await state.set_state('Booking:date')
+        await state.update_data(step=(await state.get_data()).get('step', 0) + 1)
+
+    async def scenario():
+        bot = Bot(token='123456:TEST')
+        await dp.feed_update(bot, _message_update(1, 'привет'))
+        await dp.feed_update(bot, _message_update(2, 'ещё'))
+        key = StorageKey(bot_id=bot.id, chat_id=100, user_id=100)
+        reader = SQLAlchemyStorage(ttl=TTL)
+        return await reader.get_state(key), await reader.get_data(key)
+
+    assert run(scenario()) == ('Booking:date', {'step': 2})
@@ -0,0 +1,63 @@
+"""Отправка по сохранённому file_id: заново загружаем, только если отклонён сам file_id"""
+import os
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+import utils.media as media
+from tests.conftest import run, _TMP_DIR
+
+PDF_PATH = os.path.join(_TMP_DIR, 'menu.pdf')
+
+
+class _Bot:
+    """Бот, который отклоняет отправку по file_id с заданной ошибкой"""
+
+    def __init__(self, error: str = None):
+        self.error = error
+        self.uploads = 0
+
+    async def send_document(self, chat_id, document, caption=None):
+        if isinstance(document, FSInputFile):
+            self.uploads += 1
+            return SimpleNamespace(document=SimpleNamespace(file_id=f'uploaded-{self.uploads}'))
+        if self.error:
+            raise TelegramBadRequest(method=None, message=f'Bad Request: {self.error}')
+        return SimpleNamespace(document=SimpleNamespace(file_id=document))
+
+
+@pytest.fixture
+def pdf(db, monkeypatch):
+    with open(PDF_PATH, 'wb') as f:
+        f.write(b'%PDF-1.4')
+    monkeypatch.setattr(media, '_registry', None)
+    run(media.send_document(_Bot(), 1, PDF_PATH))
+    return PDF_PATH
+
+
+def test_rejected_file_id_is_uploaded_again(pdf):
+    bot = _Bot('wrong file identifier/HTTP URL specified')
+    message = run(media.send_document(bot, 1, pdf))
+    assert bot.uploads == 1
+    assert message.document.file_id == 'uploaded-1'
+
+
+def test_other_errors_keep_file_id(pdf):
+    bot = _Bot('chat not found')
+    with pytest.raises(TelegramBadRequest):
+        run(media.send_document(bot, 1, pdf))
+    assert bot.uploads == 0
+    assert run(media._cached_file_id(pdf)) == 'uploaded-1'
+
+
+def test_failed_delete_does_not_stop_upload(pdf, monkeypatch):
+    async def broken_delete(paths):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(media, 'delete_media_file_ids', broken_delete)
+    bot = _Bot('file reference expired')
+    message = run(media.send_document(bot, 1, pdf))
+    assert bot.uploads == 1
+    assert message.document.file_id == 'uploaded-1'
@@ -0,0 +1,34 @@
+"""Снятие отметок неотправленных уведомлений: только просроченные, не чужие свежие"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from tests.conftest import run
+
+LEASE = timedelta(minutes=60)
+
+
+def test_release_only_stale_pending_claims(db):
+    now = datetime.utcnow()
+
+    async def scenario():
+        async with db.async_session() as session:
+            for user_id, status, age in (
+                (1, 'pending', timedelta(hours=2)),     # процесс упал посреди отправки
+                (2, 'pending', timedelta(minutes=5)),   # сейчас отправляет другой процесс
+                (3, 'sent', timedelta(hours=2)),
+            ):
+                session.add(db.NotificationLog(
+                    user_id=user_id, kind='expiring', subject_id=user_id,
+                    scheduled_for=now, status=status, created_at=now - age
+                ))
+            await session.commit()
+
+        released = await db.release_pending_notifications(LEASE)
+        async with db.async_session() as session:
+            left = (await session.execute(
+                select(db.NotificationLog.user_id).order_by(db.NotificationLog.user_id)
+            )).scalars().all()
+        return released, left
+
+    assert run(scenario()) == (1, [2, 3])
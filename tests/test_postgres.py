@@ -0,0 +1,103 @@
+"""
+Проверки на PostgreSQL: схема и миграции, запись на тренировку (SELECT ... FOR UPDATE),
+подтверждение оплаты (ON CONFLICT в sales_daily).
+
+Пропускаются, если TEST_POSTGRES_URL не задан. База из TEST_POSTGRES_URL
+очищается перед каждым тестом — только отдельная тестовая база.
+"""
+import asyncio
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import migrations
+from tests.conftest import run
+
+TEST_POSTGRES_URL = os.getenv('TEST_POSTGRES_URL')
+
+pytestmark = [
+    pytest.mark.postgres,
+    pytest.mark.skipif(not TEST_POSTGRES_URL, reason='TEST_POSTGRES_URL не задан'),
+]
+
+
+async def _recreate_schema(db):
+    async with db.engine.begin() as conn:
+        await conn.execute(text('DROP SCHEMA public CASCADE'))
+        await conn.execute(text('CREATE SCHEMA public'))
+    await db.init_db()
+    await migrations.run_migrations()
+
+
+@pytest.fixture
+def pg(db, monkeypatch):
+    """Пустая база PostgreSQL со всеми таблицами и миграциями"""
+    engine = db.create_engine_from_config(TEST_POSTGRES_URL)
+    monkeypatch.setattr(db, 'engine', engine)
+    monkeypatch.setattr(db, 'async_session', sessionmaker(engine, class_=AsyncSession, expire_on_commit=False))
+    monkeypatch.setattr(migrations, 'engine', engine)
+    run(_recreate_schema(db))
+    return db
+
+
+async def _training(db, max_participants):
+    async with db.async_session() as session:
+        training = db.Training(
+            name='Пилатес', trainer='Анна', day_of_week=0, time='19:00',
+            max_participants=max_participants, training_type='studio', is_active=True
+        )
+        session.add(training)
+        await session.commit()
+        return training.id
+
+
+def test_schema_and_migrations(pg):
+    async def scenario():
+        async with pg.engine.connect() as conn:
+            return await conn.run_sync(lambda sync_conn: set(inspect(sync_conn).get_table_names()))
+
+    tables = run(scenario())
+    assert set(pg.Base.metadata.tables) <= tables
+
+
+def test_concurrent_reservations_fill_exactly(pg):
+    seats, calls = 28, 200
+
+    async def scenario():
+        training_id = await _training(pg, seats)
+        slot = (datetime.now() + timedelta(days=1)).replace(hour=19, minute=0, second=0, microsecond=0)
+        results = await asyncio.gather(*(
+            pg.reserve_seat(10_000 + i, training_id, slot) for i in range(calls)
+        ))
+        async with pg.async_session() as session:
+            booked = (await session.execute(
+                select(func.count(pg.Booking.id)).where(pg.Booking.training_id == training_id)
+            )).scalar()
+        return Counter(r.status for r in results), booked
+
+    statuses, booked = run(scenario())
+    assert statuses[pg.ReserveStatus.RESERVED] == seats
+    assert statuses[pg.ReserveStatus.FULL] == calls - seats
+    assert booked == seats
+
+
+def test_confirm_payment_counts_once(pg):
+    async def scenario():
+        async with pg.async_session() as session:
+            session.add(pg.User(user_id=10_000, name='Клиент'))
+            payment = pg.Payment(user_id=10_000, amount=3000, payment_type='8 занятий', status='pending')
+            session.add(payment)
+            await session.commit()
+        first, second = await asyncio.gather(pg.confirm_payment(payment.id), pg.confirm_payment(payment.id))
+        async with pg.async_session() as session:
+            sales = (await session.execute(select(pg.SalesDaily))).scalars().all()
+        return first, second, [(s.count, s.amount) for s in sales]
+
+    first, second, sales = run(scenario())
+    assert (first is None) != (second is None)
+    assert sales == [(1, 3000)]
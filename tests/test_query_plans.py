@@ -0,0 +1,79 @@
+"""
+Горячие запросы используют составные индексы (EXPLAIN QUERY PLAN, SQLite).
+
+SQL перехватывается при вызове настоящих функций, поэтому тест следит
+и за индексами, и за тем, чтобы запросы не разошлись с ними.
+"""
+import sqlite3
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from tests.conftest import run, TEST_DB_PATH
+from utils.notifications import _subscription_candidates
+
+
+async def _capture(db, coro):
+    """SQL-запросы (SELECT), выполненные корутиной, с параметрами"""
+    statements = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine.sync_engine, 'before_cursor_execute', before_execute)
+    try:
+        await coro
+    finally:
+        event.remove(db.engine.sync_engine, 'before_cursor_execute', before_execute)
+    return statements
+
+
+def _plan(statement, parameters) -> str:
+    with sqlite3.connect(TEST_DB_PATH) as conn:
+        rows = conn.execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+    return '\n'.join(row[-1] for row in rows)
+
+
+def _assert_index(db, coro, index_name):
+    statements = run(_capture(db, coro))
+    assert statements
+    plans = [_plan(statement, parameters) for statement, parameters in statements]
+    assert any(index_name in plan for plan in plans), '\n\n'.join(plans)
+
+
+async def _select(db, query):
+    async with db.async_session() as session:
+        await session.execute(query)
+
+
+def test_slot_occupancy_uses_training_status_date(db):
+    day = datetime.now() + timedelta(days=1)
+    _assert_index(db, db.get_bookings_count(1, day), 'ix_bookings_training_status_date')
+    _assert_index(db, db.get_slot_occupancy([1, 2, 3], day, days=7), 'ix_bookings_training_status_date')
+
+
+def test_my_bookings_uses_user_status_date(db):
+    _assert_index(db, db.get_user_active_bookings(1001), 'ix_bookings_user_status_date')
+
+
+def test_today_bookings_uses_status_date(db):
+    _assert_index(db, db.get_today_bookings(), 'ix_bookings_status_date')
+
+
+def test_active_subscription_uses_user_active_end(db):
+    _assert_index(db, db.get_active_subscription(1001), 'ix_subscriptions_user_active_end')
+
+
+def test_expiring_notifications_use_active_end(db):
+    now = datetime.utcnow()
+    query = _subscription_candidates(
+        db.Subscription.is_active == True,
+        db.Subscription.end_date <= now + timedelta(days=3),
+        db.Subscription.end_date > now
+    )
+    _assert_index(db, _select(db, query), 'ix_subscriptions_active_end')
+
+
+def test_recent_payments_use_status_created(db):
+    _assert_index(db, db.get_recent_payments(), 'ix_payments_status_created')
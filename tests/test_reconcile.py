@@ -0,0 +1,136 @@
+"""Сверка оплат абонементов с выданными абонементами (reconcile_subscriptions)"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from tests.conftest import run
+
+
+def _paid_at():
+    return datetime.utcnow() - timedelta(minutes=1)
+
+
+def _this_month(db, moment):
+    return db._month_period(db._month_start(moment))
+
+
+async def _client(db, user_id):
+    async with db.async_session() as session:
+        session.add(db.User(user_id=user_id, name='Клиент'))
+        await session.commit()
+
+
+async def _payment(db, user_id, payment_type, paid_at):
+    async with db.async_session() as session:
+        payment = db.Payment(
+            user_id=user_id, amount=3500, payment_type=payment_type,
+            status='confirmed', created_at=paid_at, confirmed_at=paid_at
+        )
+        session.add(payment)
+        await session.commit()
+        return payment.id
+
+
+async def _subscription(db, user_id, subscription_type, period, payment_id=None, is_active=True):
+    async with db.async_session() as session:
+        subscription = db.Subscription(
+            user_id=user_id, subscription_type=subscription_type,
+            start_date=period[0], end_date=period[1], is_active=is_active, payment_id=payment_id
+        )
+        session.add(subscription)
+        await session.commit()
+        return subscription.id
+
+
+async def _subscriptions(db, user_id):
+    async with db.async_session() as session:
+        return (await session.execute(
+            select(db.Subscription).where(db.Subscription.user_id == user_id).order_by(db.Subscription.id)
+        )).scalars().all()
+
+
+def test_renewal_without_subscription_is_reported_then_issued(db):
+    paid_at = _paid_at()
+
+    async def scenario():
+        await _client(db, 100)
+        first = await _payment(db, 100, 'one_group', paid_at)
+        await _subscription(db, 100, 'one_group', _this_month(db, paid_at), payment_id=first)
+        renewal = await _payment(db, 100, 'renewal_one', paid_at)
+        report = await db.reconcile_subscriptions()
+        before = await _subscriptions(db, 100)
+        repaired = await db.reconcile_subscriptions(repair=True)
+        return renewal, report, before, repaired, await _subscriptions(db, 100)
+
+    renewal, report, before, repaired, after = run(scenario())
+    assert [m['payment_id'] for m in report['missing']] == [renewal]
+    assert report['created'] == 0 and len(before) == 1
+    assert repaired['created'] == 1
+    issued = after[-1]
+    assert issued.payment_id == renewal and issued.subscription_type == 'one_group'
+    # Клиент уже покрыт до конца месяца — продление начинается со следующего
+    assert issued.start_date == db._month_start(paid_at, 1)
+
+
+def test_legacy_subscription_is_linked_not_duplicated(db):
+    paid_at = _paid_at()
+
+    async def scenario():
+        await _client(db, 100)
+        payment_id = await _payment(db, 100, 'all_groups', paid_at)
+        await _subscription(db, 100, 'all_groups', _this_month(db, paid_at))
+        report = await db.reconcile_subscriptions()
+        repaired = await db.reconcile_subscriptions(repair=True)
+        return payment_id, report, repaired, await _subscriptions(db, 100)
+
+    payment_id, report, repaired, subscriptions = run(scenario())
+    assert report['missing'] == [] and report['linked'] == 1
+    assert repaired['created'] == 0
+    assert [s.payment_id for s in subscriptions] == [payment_id]
+
+
+def test_second_repair_is_noop(db):
+    paid_at = _paid_at()
+
+    async def scenario():
+        await _client(db, 100)
+        await _payment(db, 100, 'one_group', paid_at)
+        await _payment(db, 100, 'all_groups', paid_at)
+        await _subscription(db, 100, 'all_groups', _this_month(db, paid_at))
+        await _subscription(db, 100, 'one_group', _this_month(db, db._month_start(paid_at, -3)))
+        first = await db.reconcile_subscriptions(repair=True)
+        snapshot = [(s.id, s.start_date, s.is_active, s.payment_id) for s in await _subscriptions(db, 100)]
+        second = await db.reconcile_subscriptions(repair=True)
+        unchanged = [(s.id, s.start_date, s.is_active, s.payment_id) for s in await _subscriptions(db, 100)]
+        return first, second, snapshot, unchanged
+
+    first, second, snapshot, unchanged = run(scenario())
+    assert (first['created'], first['linked'], first['deactivated']) == (1, 1, 1)
+    assert all(payment_id for *_, is_active, payment_id in snapshot if is_active)
+    assert second['missing'] == []
+    # Пересечение разных типов остаётся в отчёте, но не исправляется
+    assert second['overlaps'] == first['overlaps']
+    assert all(o['first_type'] != o['second_type'] for o in second['overlaps'])
+    assert (second['created'], second['linked'], second['deactivated'], second['shifted']) == (0, 0, 0, 0)
+    assert unchanged == snapshot
+
+
+def test_same_type_overlaps_shifted_other_types_kept(db):
+    now = datetime.utcnow()
+    month = _this_month(db, now)
+
+    async def scenario():
+        await _client(db, 100)
+        await _client(db, 200)
+        await _subscription(db, 100, 'one_group', month)
+        await _subscription(db, 100, 'one_group', month)
+        await _subscription(db, 200, 'one_group', month)
+        await _subscription(db, 200, 'all_groups', month)
+        report = await db.reconcile_subscriptions(repair=True)
+        return report, await _subscriptions(db, 100), await _subscriptions(db, 200)
+
+    report, same_type, other_types = run(scenario())
+    assert {o['user_id'] for o in report['overlaps']} == {100, 200}
+    assert report['shifted'] == 1
+    assert [s.start_date for s in same_type] == [month[0], db._month_start(now, 1)]
+    assert [(s.start_date, s.end_date) for s in other_types] == [month, month]
@@ -0,0 +1,96 @@
+"""Конкурентная запись на тренировку: мест выдаётся ровно столько, сколько есть"""
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+
+from tests.conftest import run
+
+SEATS = 28
+CALLS = 200
+
+
+async def _training(db, max_participants=SEATS):
+    async with db.async_session() as session:
+        training = db.Training(
+            name='Пилатес', trainer='Анна', day_of_week=0, time='19:00',
+            max_participants=max_participants, training_type='studio', is_active=True
+        )
+        session.add(training)
+        await session.commit()
+        return training.id
+
+
+def _slot():
+    return (datetime.now() + timedelta(days=1)).replace(hour=19, minute=0, second=0, microsecond=0)
+
+
+async def _active_bookings(db, training_id):
+    async with db.async_session() as session:
+        return (await session.execute(
+            select(func.count(db.Booking.id)).where(
+                db.Booking.training_id == training_id, db.Booking.status == 'active'
+            )
+        )).scalar()
+
+
+def test_concurrent_reservations_fill_exactly(db):
+    async def scenario():
+        training_id = await _training(db)
+        slot = _slot()
+        results = await asyncio.gather(*(
+            db.reserve_seat(10_000 + i, training_id, slot) for i in range(CALLS)
+        ))
+        return Counter(r.status for r in results), await _active_bookings(db, training_id)
+
+    statuses, booked = run(scenario())
+    assert statuses[db.ReserveStatus.RESERVED] == SEATS
+    assert statuses[db.ReserveStatus.FULL] == CALLS - SEATS
+    assert booked == SEATS
+
+
+def test_concurrent_duplicates_are_rejected(db):
+    async def scenario():
+        training_id = await _training(db)
+        slot = _slot()
+        # Пять клиентов жмут кнопку по два раза одновременно
+        user_ids = [10_000 + i for i in range(5)] * 2
+        results = await asyncio.gather(*(db.reserve_seat(u, training_id, slot) for u in user_ids))
+        return Counter(r.status for r in results), await _active_bookings(db, training_id)
+
+    statuses, booked = run(scenario())
+    assert statuses == {db.ReserveStatus.RESERVED: 5, db.ReserveStatus.ALREADY_BOOKED: 5}
+    assert booked == 5
+
+
+def test_begin_immediate_without_process_lock(db):
+    """Без внутрипроцессной очереди (как при нескольких процессах) мест не больше лимита"""
+    async def scenario():
+        training_id = await _training(db, max_participants=5)
+        slot = _slot()
+        results = await asyncio.gather(*(
+            db._reserve_seat(10_000 + i, training_id, slot) for i in range(30)
+        ))
+        return Counter(r.status for r in results), await _active_bookings(db, training_id)
+
+    statuses, booked = run(scenario())
+    assert statuses[db.ReserveStatus.RESERVED] == 5
+    assert booked == 5
+
+
+def test_inactive_training_is_rejected(db):
+    async def scenario():
+        training_id = await _training(db)
+        async with db.async_session() as session:
+            training = await session.get(db.Training, training_id)
+            training.is_active = False
+            await session.commit()
+        result = await db.reserve_seat(10_000, training_id, _slot())
+        missing = await db.reserve_seat(10_000, training_id + 1, _slot())
+        return result.status, missing.status, await _active_bookings(db, training_id)
+
+    inactive, missing, booked = run(scenario())
+    assert inactive == db.ReserveStatus.UNAVAILABLE
+    assert missing == db.ReserveStatus.UNAVAILABLE
+    assert booked == 0
@@ -0,0 +1,32 @@
+"""Расписание из schedule.json в старом текстовом формате"""
+import copy
+import logging
+
+import config
+from utils.schedule import convert_skipped_days
+
+
+def test_legacy_text_days_are_converted_or_reported(monkeypatch, caplog):
+    monkeypatch.setattr(config, 'SCHEDULE', copy.deepcopy(config.SCHEDULE))
+    monkeypatch.setattr(config, 'SCHEDULE_SKIPPED', {
+        'monday': "🏃‍♀️ Силовая (Анна-Мария) — 8:30, 17:10\n🧘‍♀️ Пилатес Анна - 9:30",
+        'tuesday': "Приходите когда удобно",
+        'sunday': "Выходной",
+        'friday': [{"type": "Йога", "trainer": "Анна", "times": ["8:30"]}],
+    })
+    default_tuesday = copy.deepcopy(config.SCHEDULE['tuesday'])
+
+    with caplog.at_level(logging.WARNING, logger='utils.schedule'):
+        converted = convert_skipped_days()
+
+    assert converted == ['monday', 'sunday']
+    assert config.SCHEDULE['monday'] == [
+        {"type": "Силовая", "trainer": "Анна-Мария", "times": ["8:30", "17:10"]},
+        {"type": "Пилатес", "trainer": "Анна", "times": ["9:30"]},
+    ]
+    assert config.SCHEDULE['sunday'] == []
+    assert config.SCHEDULE['tuesday'] == default_tuesday
+    assert set(config.SCHEDULE_SKIPPED) == {'tuesday', 'friday'}
+    warnings = caplog.text
+    assert 'ВТОРНИК' in warnings and 'Приходите когда удобно' in warnings
+    assert 'ПЯТНИЦА' in warnings
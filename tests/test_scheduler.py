@@ -0,0 +1,60 @@
+"""Разовые задачи планировщика: хранятся в scheduled_jobs и возвращаются после перезапуска"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import utils.scheduler as scheduler_module
+from database import iter_scheduled_jobs
+from tests.conftest import run
+
+
+async def _stored_jobs():
+    return [job async for batch in iter_scheduled_jobs() for job in batch]
+
+
+def _restart():
+    old = scheduler_module.get_scheduler()
+    if old and old.running:
+        old.shutdown(wait=False)
+    return scheduler_module.setup_scheduler(bot=None)
+
+
+def test_funnel_survives_restart(db):
+    async def scenario():
+        _restart()
+        await scheduler_module.schedule_video_funnel(42)
+        scheduler = _restart()
+        assert not scheduler.get_job('video_funnel_step1_42')
+        loaded = await scheduler_module.load_durable_jobs()
+        jobs = {job.id: job.next_run_time for job in scheduler.get_jobs()}
+        scheduler.shutdown(wait=False)
+        return loaded, jobs, await _stored_jobs()
+
+    loaded, jobs, stored = run(scenario())
+    assert loaded == 2
+    now = datetime.now(timezone.utc)
+    assert timedelta(hours=23) < jobs['video_funnel_step1_42'] - now <= timedelta(hours=24)
+    assert timedelta(days=2) < jobs['video_funnel_step2_42'] - now <= timedelta(days=3)
+    assert sorted(row[0] for row in stored) == ['video_funnel_step1_42', 'video_funnel_step2_42']
+
+
+def test_overdue_job_runs_once_and_expired_is_dropped(db, monkeypatch):
+    calls = []
+
+    async def step(user_id):
+        calls.append(user_id)
+
+    monkeypatch.setitem(scheduler_module.DURABLE_JOBS, 'video_funnel_step1', step)
+
+    async def scenario():
+        now = datetime.utcnow()
+        await db.save_scheduled_job('video_funnel_step1_1', 'video_funnel_step1', [1], now - timedelta(hours=1))
+        await db.save_scheduled_job('video_funnel_step1_2', 'video_funnel_step1', [2], now - timedelta(days=30))
+        scheduler = _restart()
+        await scheduler_module.load_durable_jobs()
+        await asyncio.sleep(0.3)
+        scheduler.shutdown(wait=False)
+        return await _stored_jobs()
+
+    assert run(scenario()) == []
+    assert calls == [1]
+
@@ -0,0 +1,119 @@
+"""
+Webhook: ответ Telegram не ждёт обработчика, остановка дожидается начатых.
+
+Диспетчер собирается так же, как в bot.run_webhook (SimpleRequestHandler
+и InFlightMiddleware), но с тестовыми обработчиками без обращений к API.
+"""
+import asyncio
+import statistics
+import time
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Message
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from middlewares import InFlightMiddleware
+
+SECRET = 'test-secret'
+PATH = '/webhook'
+SLOW_HANDLER = 1.0
+
+
+def _update(update_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 100, 'type': 'private'},
+            'from': {'id': 100, 'is_bot': False, 'first_name': 'Клиент'},
+            'text': text,
+        },
+    }
+
+
+def _setup():
+    inflight = InFlightMiddleware()
+    dp = Dispatcher()
+    dp.update.outer_middleware(inflight)
+    finished = []
+
+    @dp.message(F.text == 'slow')
+    async def slow(message: Message):
+        await asyncio.sleep(SLOW_HANDLER)
+        finished.append(message.message_id)
+
+    @dp.message()
+    async def fast(message: Message):
+        finished.append(message.message_id)
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=Bot(token='123456:TEST'), secret_token=SECRET).register(app, path=PATH)
+    return app, inflight, finished
+
+
+async def _post(client, update: dict) -> float:
+    started = time.perf_counter()
+    response = await client.post(PATH, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': SECRET})
+    assert response.status == 200
+    return time.perf_counter() - started
+
+
+def test_webhook_answers_during_slow_handler_and_drains():
+    async def scenario():
+        app, inflight, finished = _setup()
+        async with TestClient(TestServer(app)) as client:
+            await _post(client, _update(1, 'slow'))
+            await asyncio.sleep(0.05)
+            assert inflight.active == 1
+
+            # Пока медленный обработчик работает, остальные обновления принимаются и обрабатываются
+            latencies = [await _post(client, _update(i, 'fast')) for i in range(2, 202)]
+            await asyncio.sleep(0.05)
+            assert 1 not in finished and len(finished) == 200
+
+            started = time.perf_counter()
+            await inflight.wait_idle(timeout=5)
+            drained = time.perf_counter() - started
+            assert finished[-1] == 1 and inflight.active == 0
+        return latencies, drained
+
+    latencies, drained = asyncio.run(scenario())
+    p99 = statistics.quantiles(latencies, n=100)[98]
+    assert p99 < SLOW_HANDLER / 2
+    assert drained < SLOW_HANDLER
+
+
+def test_wrong_or_missing_secret_is_rejected():
+    async def scenario():
+        app, inflight, finished = _setup()
+        async with TestClient(TestServer(app)) as client:
+            statuses = []
+            for headers in ({'X-Telegram-Bot-Api-Secret-Token': 'wrong'}, {}):
+                response = await client.post(PATH, json=_update(1, 'fast'), headers=headers)
+                statuses.append(response.status)
+            await asyncio.sleep(0.05)
+        return statuses, finished
+
+    statuses, finished = asyncio.run(scenario())
+    assert statuses == [401, 401]
+    assert finished == []
+
+
+def test_wait_idle_gives_up_after_timeout():
+    async def scenario():
+        app, inflight, finished = _setup()
+        async with TestClient(TestServer(app)) as client:
+            await _post(client, _update(1, 'slow'))
+            await asyncio.sleep(0.05)
+            started = time.perf_counter()
+            await inflight.wait_idle(timeout=0.2)
+            waited = time.perf_counter() - started
+            active = inflight.active
+            await inflight.wait_idle(timeout=5)
+        return waited, active
+
+    waited, active = asyncio.run(scenario())
+    assert 0.2 <= waited < SLOW_HANDLER and active == 1
@@ -0,0 +1,130 @@
+"""
+Аналитика удержания клиентов: когорты по месяцу первого абонемента,
+продления месяц к месяцу и частота посещений за месяц абонемента.
+
+Всё считается агрегатами в БД (без цикла по пользователям),
+готовый отчёт кэшируется до конца дня.
+"""
+import html
+import logging
+import time
+from datetime import datetime
+
+from database import get_subscription_cohorts, get_renewal_stats, get_visit_histogram, VISIT_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+COHORT_MONTHS = 12  # сколько последних когорт показывать
+OFFSETS_SHOWN = 5  # колонки удержания: +1 … +5 месяцев
+RENEWAL_MONTHS = 6  # продления за столько последних завершённых месяцев
+HISTOGRAM_MONTHS = 6  # гистограмма посещений по абонементам за столько месяцев
+
+_cache = {'day': None, 'report': None}
+
+
+def _month_label(index: int) -> str:
+    year, month = divmod(index, 12)
+    return f"{month + 1:02d}.{year % 100:02d}"
+
+
+async def build_retention_report(today=None) -> dict:
+    """Посчитать отчёт заново (три агрегирующих запроса)"""
+    today = today or datetime.now().date()
+    current_month = today.year * 12 + today.month - 1
+    started = time.monotonic()
+
+    cohorts = {}
+    for cohort, offset, users in await get_subscription_cohorts(current_month - COHORT_MONTHS + 1):
+        cohorts.setdefault(cohort, {})[offset] = users
+
+    renewals = await get_renewal_stats(current_month - RENEWAL_MONTHS, current_month - 1)
+
+    since_index = current_month - HISTOGRAM_MONTHS + 1
+    since = datetime(since_index // 12, since_index % 12 + 1, 1)
+    histogram, subscriptions, visits = await get_visit_histogram(since)
+
+    elapsed = time.monotonic() - started
+    logger.info(f"[ANALYTICS] Отчёт удержания посчитан за {elapsed:.2f} с.")
+    return {
+        'day': today,
+        'current_month': current_month,
+        'cohorts': dict(sorted(cohorts.items())),
+        'renewals': renewals,
+        'histogram': histogram,
+        'subscriptions': subscriptions,
+        'visits': visits,
+        'elapsed': elapsed,
+    }
+
+
+async def get_retention_report(refresh: bool = False) -> dict:
+    """Отчёт удержания из кэша (пересчитывается раз в день или по запросу)"""
+    today = datetime.now().date()
+    if refresh or _cache['day'] != today:
+        _cache['report'] = await build_retention_report(today)
+        _cache['day'] = today
+    return _cache['report']
+
+
+def _cohort_table(report: dict) -> list:
+    header = "Когорта  Чел" + "".join(f"{'+' + str(k):>5}" for k in range(1, OFFSETS_SHOWN + 1))
+    lines = [header]
+    for cohort, offsets in report['cohorts'].items():
+        size = offsets.get(0, 0)
+        cells = []
+        for k in range(1, OFFSETS_SHOWN + 1):
+            if cohort + k > report['current_month'] or not size:
+                cells.append(f"{'':>5}")
+            else:
+                cells.append(f"{offsets.get(k, 0) * 100 // size:>4}%")
+        lines.append(f"{_month_label(cohort):<8}{size:>4}" + "".join(cells))
+    return lines
+
+
+def format_retention_report(report: dict) -> str:
+    """Отчёт для админки (HTML: таблицы в <pre>)"""
+    parts = ["📈 <b>УДЕРЖАНИЕ КЛИЕНТОВ</b>\n"]
+
+    parts.append("<b>Когорты</b> — месяц первого абонемента и доля, взявших абонемент через N месяцев:")
+    if report['cohorts']:
+        parts.append("<pre>" + html.escape("\n".join(_cohort_table(report))) + "</pre>")
+    else:
+        parts.append("Пока нет абонементов\n")
+
+    parts.append("<b>Продления</b> — взяли абонемент и на следующий месяц:")
+    if report['renewals']:
+        lines = []
+        total_subscribers = total_renewed = 0
+        for month, subscribers, renewed in report['renewals']:
+            total_subscribers += subscribers
+            total_renewed += renewed
+            lines.append(f"{_month_label(month):<8}{renewed:>4} из {subscribers:<4}{renewed * 100 // subscribers:>4}%")
+        renewal_rate = total_renewed * 100 / total_subscribers
+        lines.append(f"Итого: продление {renewal_rate:.0f}%, отток {100 - renewal_rate:.0f}%")
+        parts.append("<pre>" + html.escape("\n".join(lines)) + "</pre>")
+    else:
+        parts.append("Нет данных за прошлые месяцы\n")
+
+    subscriptions = report['subscriptions']
+    parts.append(f"<b>Посещения за месяц абонемента</b> (абонементы за {HISTOGRAM_MONTHS} мес.):")
+    if subscriptions:
+        lines = []
+        largest = max(report['histogram'].values()) or 1
+        bounds = list(VISIT_BUCKETS) + [None]
+        for low, high in zip(bounds, bounds[1:]):
+            count = report['histogram'][low]
+            if high is None:
+                label = f"{low}+"
+            elif high - low == 1:
+                label = f"{low}"
+            else:
+                label = f"{low}-{high - 1}"
+            bar = "█" * round(count * 10 / largest)
+            lines.append(f"{label:>5} {bar:<10} {count:>4} ({count * 100 // subscriptions}%)")
+        lines.append(f"В среднем: {report['visits'] / subscriptions:.1f} посещ. на абонемент")
+        parts.append("<pre>" + html.escape("\n".join(lines)) + "</pre>")
+    else:
+        parts.append("Нет абонементов за период\n")
+
+    parts.append(f"<i>Данные на {report['day'].strftime('%d.%m.%Y')}</i>")
+    return "\n".join(parts)
@@ -0,0 +1,181 @@
+"""
+Фоновая рассылка: ограничение скорости, прогресс, пауза/отмена и
+возобновление после перезапуска бота
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from database import (
+    get_broadcast,
+    set_broadcast_status,
+    get_pending_recipients,
+    mark_broadcast_recipient,
+    get_broadcast_progress,
+    get_unfinished_broadcasts,
+    set_users_active,
+)
+from utils.delivery import send_with_retry
+from utils.ratelimit import telegram_limiter
+import config
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+PROGRESS_INTERVAL = 3  # секунд между обновлениями сообщения с прогрессом
+
+STATUS_NAMES = {
+    'running': '⏳ Идёт отправка',
+    'paused': '⏸ На паузе',
+    'cancelled': '🚫 Отменена',
+    'done': '✅ Завершена',
+}
+
+# broadcast_id -> задача воркера
+_tasks = {}
+
+
+def broadcast_control_keyboard(broadcast_id: int, status: str):
+    """Кнопки управления рассылкой"""
+    if status == 'running':
+        buttons = [
+            [InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bc_pause:{broadcast_id}")],
+            [InlineKeyboardButton(text="🚫 Отменить", callback_data=f"bc_cancel:{broadcast_id}")],
+        ]
+    elif status == 'paused':
+        buttons = [
+            [InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bc_resume:{broadcast_id}")],
+            [InlineKeyboardButton(text="🚫 Отменить", callback_data=f"bc_cancel:{broadcast_id}")],
+        ]
+    else:
+        buttons = [[InlineKeyboardButton(text="⬅️ В админку", callback_data="back_admin")]]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def format_broadcast_progress(broadcast_id: int, status: str, progress: dict) -> str:
+    """Текст сообщения с прогрессом рассылки"""
+    done = progress['sent'] + progress['failed']
+    percent = int(done * 100 / progress['total']) if progress['total'] else 100
+    return (
+        f"📢 РАССЫЛКА #{broadcast_id}\n\n"
+        f"{STATUS_NAMES.get(status, status)} — {percent}%\n\n"
+        f"📊 Статистика:\n"
+        f"• Успешно: {progress['sent']}\n"
+        f"• Ошибки: {progress['failed']}\n"
+        f"• Осталось: {progress['pending']}\n"
+        f"• Всего: {progress['total']}"
+    )
+
+
+async def update_broadcast_message(bot: Bot, broadcast_id: int):
+    """Обновить у админа сообщение с прогрессом рассылки"""
+    broadcast = await get_broadcast(broadcast_id)
+    if not broadcast or not broadcast['admin_message_id']:
+        return
+
+    progress = await get_broadcast_progress(broadcast_id)
+    await telegram_limiter.acquire()
+    try:
+        await bot.edit_message_text(
+            format_broadcast_progress(broadcast_id, broadcast['status'], progress),
+            chat_id=broadcast['admin_chat_id'],
+            message_id=broadcast['admin_message_id'],
+            reply_markup=broadcast_control_keyboard(broadcast_id, broadcast['status'])
+        )
+    except TelegramRetryAfter as e:
+        telegram_limiter.on_retry_after(e.retry_after)
+    except TelegramBadRequest:
+        # message is not modified / сообщение удалено — не критично
+        pass
+
+
+async def _run_broadcast(bot: Bot, broadcast_id: int):
+    """Воркер рассылки: пачками отправляет неотправленным получателям"""
+    semaphore = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+    last_progress = time.monotonic()
+
+    async def deliver(recipient_id: int, user_id: int, text: str):
+        async with semaphore:
+            status, error = await send_with_retry(bot, user_id, text, parse_mode="Markdown")
+            if status == 'blocked':
+                await set_users_active([user_id], False)
+                status = 'failed'
+            await mark_broadcast_recipient(recipient_id, status, error)
+
+    while True:
+        # Статус перечитываем перед каждой пачкой — так работают пауза и отмена
+        broadcast = await get_broadcast(broadcast_id)
+        if not broadcast or broadcast['status'] != 'running':
+            await update_broadcast_message(bot, broadcast_id)
+            # Пока шло последнее обновление, рассылку могли продолжить: воркер
+            # ещё жив, и start_broadcast_job нового не запустил — продолжаем сами
+            broadcast = await get_broadcast(broadcast_id)
+            if not broadcast or broadcast['status'] != 'running':
+                return
+            continue
+
+        recipients = await get_pending_recipients(broadcast_id, BATCH_SIZE)
+        if not recipients:
+            await set_broadcast_status(broadcast_id, 'done')
+            logger.info(f"[BROADCAST] Рассылка #{broadcast_id} завершена")
+            await update_broadcast_message(bot, broadcast_id)
+            return
+
+        await asyncio.gather(*(
+            deliver(recipient_id, user_id, broadcast['text'])
+            for recipient_id, user_id in recipients
+        ))
+
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            await update_broadcast_message(bot, broadcast_id)
+            last_progress = time.monotonic()
+
+
+def start_broadcast_job(bot: Bot, broadcast_id: int):
+    """Запустить воркер рассылки в фоне (если ещё не запущен)"""
+    task = _tasks.get(broadcast_id)
+    if task and not task.done():
+        return task
+
+    task = asyncio.create_task(_run_broadcast(bot, broadcast_id))
+    _tasks[broadcast_id] = task
+
+    def _on_done(t: asyncio.Task):
+        if _tasks.get(broadcast_id) is t:
+            _tasks.pop(broadcast_id)
+        if not t.cancelled() and t.exception():
+            logger.error(f"[BROADCAST] Рассылка #{broadcast_id} упала: {t.exception()}")
+
+    task.add_done_callback(_on_done)
+    return task
+
+
+async def pause_broadcast_job(broadcast_id: int) -> bool:
+    """Поставить рассылку на паузу (воркер остановится после текущей пачки).
+    False — рассылка не идёт (уже на паузе или завершена)"""
+    return await set_broadcast_status(broadcast_id, 'paused')
+
+
+async def resume_broadcast_job(bot: Bot, broadcast_id: int) -> bool:
+    """Продолжить рассылку с места остановки. False — рассылка не на паузе"""
+    if not await set_broadcast_status(broadcast_id, 'running'):
+        return False
+    start_broadcast_job(bot, broadcast_id)
+    return True
+
+
+async def cancel_broadcast_job(broadcast_id: int) -> bool:
+    """Отменить рассылку; неотправленные получатели остаются pending.
+    False — рассылка уже завершена или отменена"""
+    return await set_broadcast_status(broadcast_id, 'cancelled')
+
+
+async def resume_unfinished_broadcasts(bot: Bot):
+    """Возобновить рассылки, прерванные перезапуском бота"""
+    for broadcast_id in await get_unfinished_broadcasts():
+        logger.info(f"[BROADCAST] Возобновляю рассылку #{broadcast_id}")
+        start_broadcast_job(bot, broadcast_id)
@@ -0,0 +1,117 @@
+"""
+Общая доставка массовых сообщений: пул воркеров, глобальный лимит скорости,
+повторы при RetryAfter и отключение заблокировавших бота пользователей
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+from database import set_users_active
+from utils.ratelimit import telegram_limiter
+import config
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+
+
+async def send_with_retry(bot: Bot, user_id: int, text: str, reply_markup=None, parse_mode=None):
+    """
+    Отправить сообщение через общий лимитер.
+    Возвращает (status, error): status — 'sent', 'blocked' или 'failed'.
+    """
+    for _ in range(MAX_ATTEMPTS):
+        await telegram_limiter.acquire()
+        try:
+            await bot.send_message(user_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+            telegram_limiter.on_success()
+            return 'sent', None
+        except TelegramRetryAfter as e:
+            logger.warning(f"[DELIVERY] RetryAfter {e.retry_after} с. на user_id={user_id}")
+            telegram_limiter.on_retry_after(e.retry_after)
+        except TelegramForbiddenError:
+            return 'blocked', 'blocked'
+        except Exception as e:
+            return 'failed', str(e)[:200]
+    return 'failed', 'retry_after'
+
+
+@dataclass
+class DeliveryStats:
+    """Итог одного запуска рассылки"""
+    job: str
+    sent: int = 0
+    blocked: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+    elapsed: float = 0.0
+
+    @property
+    def total(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    def __str__(self):
+        return (
+            f"{self.job}: total={self.total} sent={self.sent} "
+            f"blocked={self.blocked} failed={self.failed} elapsed={self.elapsed:.1f}s"
+        )
+
+
+async def deliver(bot: Bot, job: str, messages, concurrency: int = None, on_result=None) -> DeliveryStats:
+    """
+    Разослать сообщения пулом воркеров.
+
+    messages — итератор (обычный или асинхронный) кортежей
+    (user_id, text, reply_markup, ...). Заблокировавшие бота пользователи
+    помечаются is_active=False. on_result(item, status) — вызывается после
+    каждой отправки.
+    """
+    concurrency = concurrency or config.NOTIFICATION_CONCURRENCY
+    stats = DeliveryStats(job)
+    blocked_ids = []
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            user_id, text, reply_markup = item[:3]
+            status, error = await send_with_retry(bot, user_id, text, reply_markup)
+            if on_result:
+                try:
+                    await on_result(item, status)
+                except Exception as e:
+                    logger.error(f"[DELIVERY] {job}: ошибка обработки результата user_id={user_id}: {e}")
+            if status == 'sent':
+                stats.sent += 1
+            elif status == 'blocked':
+                stats.blocked += 1
+                blocked_ids.append(user_id)
+            else:
+                stats.failed += 1
+                logger.warning(f"[DELIVERY] {job}: ошибка отправки user_id={user_id}: {error}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        if hasattr(messages, '__aiter__'):
+            async for item in messages:
+                await queue.put(item)
+        else:
+            for item in messages:
+                await queue.put(item)
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    if blocked_ids:
+        await set_users_active(blocked_ids, False)
+
+    stats.elapsed = time.monotonic() - stats.started
+    logger.info(f"[DELIVERY] {stats}")
+    return stats
@@ -0,0 +1,284 @@
+"""
+Экспорт данных.
+
+/export_my_data — персональные данные пользователя: история читается одним
+потоковым запросом и сразу пишется во временный JSON-файл, в памяти остаётся
+только короткий текст для сообщения. Если текст не помещается в одно сообщение
+Telegram — отправляется файл.
+
+/export — полные выгрузки для админа в CSV: таблица читается серверным
+курсором пачками, запись в файл идёт в отдельном потоке, вся выгрузка —
+фоновой задачей, готовый файл отправляется документом.
+"""
+import asyncio
+import csv
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+
+from database import get_user, iter_user_history, iter_table_export, USER_HISTORY_KINDS
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+
+SECTION_TITLES = {
+    'subscription': 'АБОНЕМЕНТЫ',
+    'payment': 'ПЛАТЕЖИ',
+    'booking': 'ЗАПИСИ НА ТРЕНИРОВКИ',
+    'visit': 'ПОСЕЩЕНИЯ',
+}
+
+SUBSCRIPTION_STATUSES = {'active': 'Активен', 'expired': 'Истёк'}
+
+
+def _format_line(row: dict) -> str:
+    """Строка раздела в текстовом экспорте"""
+    kind = row['kind']
+    if kind == 'subscription':
+        end_date = row['date'].strftime('%d.%m.%Y') if row['date'] else "—"
+        return f"- {row['title']} до {end_date} ({SUBSCRIPTION_STATUSES[row['status']]})"
+    if kind == 'payment':
+        date = row['date'].strftime('%d.%m.%Y') if row['date'] else "—"
+        return f"- {date}: {row['amount']}₽ ({row['status']})"
+    date = row['date'].strftime('%d.%m.%Y %H:%M') if row['date'] else "—"
+    if kind == 'booking':
+        return f"- {date} ({row['status']})"
+    return f"- {date}"
+
+
+def _json_row(row: dict) -> dict:
+    item = {'date': row['date'].isoformat() if row['date'] else None}
+    if row['title'] is not None:
+        item['title'] = row['title']
+    if row['status'] is not None:
+        item['status'] = row['status']
+    if row['amount'] is not None:
+        item['amount'] = row['amount']
+    return item
+
+
+class _TextPreview:
+    """Текст для сообщения: копится, пока помещается в лимит, дальше — только флаг"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.lines = []
+        self.length = 0
+        self.overflow = False
+
+    def add(self, line: str):
+        if self.overflow:
+            return
+        self.length += len(line) + 1
+        if self.length > self.limit:
+            self.overflow = True
+            self.lines = []
+        else:
+            self.lines.append(line)
+
+
+async def export_user_data(user_id: int) -> dict:
+    """
+    Собрать экспорт данных пользователя.
+
+    Возвращает None, если пользователя нет, иначе
+    {'text': str | None, 'path': str | None, 'stats': {...}}:
+    text — готовое сообщение, если помещается в лимит Telegram,
+    path — временный JSON-файл (удаляет вызывающий), если не помещается.
+    """
+    user = await get_user(user_id)
+    if not user:
+        return None
+
+    reg_date = datetime.fromisoformat(user['reg_date']).strftime('%d.%m.%Y') if user['reg_date'] else "—"
+    export_date = datetime.now()
+    stats = {'total_spent': 0, 'booking': 0, 'visit': 0}
+
+    preview = _TextPreview(MESSAGE_LIMIT)
+    for line in (
+        "ВАШИ ПЕРСОНАЛЬНЫЕ ДАННЫЕ", "",
+        "ПРОФИЛЬ:",
+        f"- ID: {user['user_id']}",
+        f"- Имя: {user['name']}",
+        f"- Username: @{user['username'] or '—'}",
+        f"- Дата регистрации: {reg_date}",
+    ):
+        preview.add(line)
+
+    fd, path = tempfile.mkstemp(prefix=f"export_{user_id}_", suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('{"profile": ')
+            json.dump(user, f, ensure_ascii=False)
+
+            sections = iter(USER_HISTORY_KINDS)
+            current = None
+
+            def open_section(kind):
+                preview.add("")
+                preview.add(f"{SECTION_TITLES[kind]}:")
+                f.write(f', "{kind}s": [')
+
+            def close_section(empty: bool):
+                if empty:
+                    preview.add("Нет данных")
+                f.write(']')
+
+            empty = True
+            async for row in iter_user_history(user_id):
+                # Разделы без строк тоже выводим — «Нет данных»
+                while current != row['kind']:
+                    if current is not None:
+                        close_section(empty)
+                    current = next(sections)
+                    open_section(current)
+                    empty = True
+
+                f.write(('' if empty else ', ') + json.dumps(_json_row(row), ensure_ascii=False))
+                empty = False
+                preview.add(_format_line(row))
+
+                if row['kind'] == 'payment' and row['status'] == 'confirmed':
+                    stats['total_spent'] += row['amount'] or 0
+                elif row['kind'] in stats:
+                    stats[row['kind']] += 1
+
+            if current is not None:
+                close_section(empty)
+            for kind in sections:
+                open_section(kind)
+                close_section(True)
+
+            f.write(f', "exported_at": "{export_date.isoformat()}"}}')
+
+        for line in (
+            "",
+            "СТАТИСТИКА:",
+            f"- Всего потрачено: {stats['total_spent']}₽",
+            f"- Всего записей: {stats['booking']}",
+            f"- Всего посещений: {stats['visit']}",
+            "",
+            f"Дата экспорта: {export_date.strftime('%d.%m.%Y %H:%M')}",
+            "",
+            "Эти данные предоставлены в соответствии с законом о защите персональных данных.",
+        ):
+            preview.add(line)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    if preview.overflow:
+        return {'text': None, 'path': path, 'stats': stats}
+
+    os.remove(path)
+    return {'text': "\n".join(preview.lines), 'path': None, 'stats': stats}
+
+
+# ============== ВЫГРУЗКИ ДЛЯ АДМИНА ==============
+
+TABLE_EXPORT_BATCH_SIZE = 1000
+
+# kind -> (название, заголовки колонок в порядке запроса iter_table_export)
+TABLE_EXPORTS = {
+    'clients': ("Клиенты", [
+        "ID", "Имя", "Username", "Телефон", "Дата регистрации",
+        "Активен", "Последнее посещение", "Абонемент до",
+    ]),
+    'payments': ("Платежи", [
+        "№", "ID клиента", "Имя", "Username", "Тип",
+        "Сумма", "Статус", "Создан", "Подтверждён",
+    ]),
+    'bookings': ("Записи", [
+        "№", "ID клиента", "Имя", "Username", "Тренировка",
+        "Тренер", "Дата тренировки", "Статус", "Создана",
+    ]),
+}
+
+# (chat_id, kind) -> задача выгрузки
+_export_tasks = {}
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'да' if value else 'нет'
+    if isinstance(value, datetime):
+        return value.strftime('%d.%m.%Y %H:%M')
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _write_batch(writer, batch: list):
+    writer.writerows([_csv_value(value) for value in row] for row in batch)
+
+
+async def write_table_csv(kind: str) -> tuple:
+    """
+    Выгрузить таблицу в CSV (разделитель «;», UTF-8 с BOM — открывается в Excel).
+
+    Возвращает (путь к временному файлу, число строк); файл удаляет вызывающий.
+    """
+    _, headers = TABLE_EXPORTS[kind]
+    fd, path = tempfile.mkstemp(prefix=f"{kind}_", suffix='.csv')
+    rows = 0
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(headers)
+            async for batch in iter_table_export(kind, TABLE_EXPORT_BATCH_SIZE):
+                # Форматирование и запись на диск — в потоке, чтобы не держать цикл событий
+                await asyncio.to_thread(_write_batch, writer, batch)
+                rows += len(batch)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, rows
+
+
+async def _run_table_export(bot: Bot, chat_id: int, kind: str):
+    title, _ = TABLE_EXPORTS[kind]
+    started = time.monotonic()
+    try:
+        path, rows = await write_table_csv(kind)
+    except Exception:
+        await bot.send_message(chat_id, f"❌ Не удалось выгрузить «{title}», подробности в логах")
+        raise
+
+    elapsed = time.monotonic() - started
+    logger.info(f"[EXPORT] {kind}: {rows} строк за {elapsed:.1f} с")
+    try:
+        await bot.send_document(
+            chat_id,
+            FSInputFile(path, filename=f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"),
+            caption=f"📥 {title}: {rows} строк",
+        )
+    finally:
+        os.remove(path)
+
+
+def start_table_export(bot: Bot, chat_id: int, kind: str) -> bool:
+    """Запустить выгрузку в фоне. False — такая выгрузка для этого чата уже идёт"""
+    key = (chat_id, kind)
+    task = _export_tasks.get(key)
+    if task and not task.done():
+        return False
+
+    task = asyncio.create_task(_run_table_export(bot, chat_id, kind))
+    _export_tasks[key] = task
+
+    def _on_done(t: asyncio.Task):
+        _export_tasks.pop(key, None)
+        if not t.cancelled() and t.exception():
+            logger.error(f"[EXPORT] Выгрузка {kind} для {chat_id} упала: {t.exception()}")
+
+    task.add_done_callback(_on_done)
+    return True
@@ -0,0 +1,174 @@
+"""
+FSM-хранилище в базе данных: состояния диалогов переживают перезапуск бота
+"""
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, StateType, StorageKey
+
+from database import load_fsm_state, save_fsm_states, delete_expired_fsm_states
+
+logger = logging.getLogger(__name__)
+
+PURGE_INTERVAL = 3600  # секунд между чистками устаревших состояний
+
+
+class _Record:
+    """Состояние одного ключа, прочитанное в текущем обновлении"""
+    __slots__ = ('state', 'data')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data or {}
+
+
+class _UpdateScope:
+    """Прочитанные и изменённые ключи одного обновления"""
+    __slots__ = ('records', 'dirty')
+
+    def __init__(self):
+        self.records: Dict[tuple, _Record] = {}
+        self.dirty = set()
+
+
+class SQLAlchemyStorage(BaseStorage):
+    """
+    Хранилище FSM поверх SQLAlchemy.
+
+    Между обновлениями ничего не кэшируется: каждое обновление читает
+    состояние из БД, поэтому несколько процессов бота видят изменения друг
+    друга. Внутри обновления (см. SQLAlchemyEventIsolation) ключ читается
+    один раз, а изменения пишутся одной транзакцией после обработчика:
+    set_state + update_data дают одну запись. Вне обновления чтения и записи
+    идут прямо в БД.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        # Область текущего обновления (открывает SQLAlchemyEventIsolation)
+        self._scope: ContextVar[Optional[_UpdateScope]] = ContextVar('fsm_update_scope', default=None)
+        self._last_purge = 0.0
+        self._purge_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> tuple:
+        return key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.destiny
+
+    async def _load(self, db_key: tuple) -> _Record:
+        row = await load_fsm_state(db_key, self.ttl)
+        if row:
+            return _Record(row[0], json.loads(row[1]) if row[1] else {})
+        return _Record()
+
+    async def _record(self, key: StorageKey) -> _Record:
+        db_key = self._key(key)
+        scope = self._scope.get()
+        if scope is None:
+            return await self._load(db_key)
+        record = scope.records.get(db_key)
+        if record is None:
+            record = await self._load(db_key)
+            scope.records[db_key] = record
+        return record
+
+    @staticmethod
+    def _serialize(db_key: tuple, record: _Record) -> tuple:
+        if record.state is None and not record.data:
+            return db_key, None, None
+        return db_key, record.state, json.dumps(record.data, ensure_ascii=False)
+
+    async def _save(self, key: StorageKey, record: _Record):
+        db_key = self._key(key)
+        scope = self._scope.get()
+        if scope is not None:
+            scope.dirty.add(db_key)
+        else:
+            await save_fsm_states([self._serialize(db_key, record)])
+
+    @asynccontextmanager
+    async def update_scope(self) -> AsyncGenerator[None, None]:
+        """Кэш ключей на время обновления; изменения пишутся в БД при выходе"""
+        if self._scope.get() is not None:
+            yield
+            return
+        scope = _UpdateScope()
+        token = self._scope.set(scope)
+        try:
+            yield
+        finally:
+            self._scope.reset(token)
+            await self._flush(scope)
+
+    async def _flush(self, scope: _UpdateScope):
+        if scope.dirty:
+            records = [self._serialize(db_key, scope.records[db_key]) for db_key in scope.dirty]
+            try:
+                await save_fsm_states(records)
+            except Exception as e:
+                logger.error(f"[FSM] Не удалось сохранить {len(records)} состояний: {e}")
+
+        if time.monotonic() - self._last_purge >= PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            self._purge_task = asyncio.create_task(self._purge())
+
+    async def _purge(self):
+        """Удалить из БД состояния, не обновлявшиеся дольше ttl"""
+        try:
+            deleted = await delete_expired_fsm_states(self.ttl)
+            if deleted:
+                logger.info(f"[FSM] Удалено устаревших состояний: {deleted}")
+        except Exception as e:
+            logger.error(f"[FSM] Ошибка очистки состояний: {e}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        state = state.state if isinstance(state, State) else state
+        # state.clear() в меню вызывается на каждое нажатие — без изменений не пишем
+        if state == record.state:
+            return
+        record.state = state
+        await self._save(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        if data == record.data:
+            return
+        record.data = data.copy()
+        await self._save(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key)).data.copy()
+
+    async def close(self) -> None:
+        if self._purge_task and not self._purge_task.done():
+            await self._purge_task
+
+
+class SQLAlchemyEventIsolation(BaseEventIsolation):
+    """
+    Область обновления для SQLAlchemyStorage.
+
+    Диспетчер входит в lock() до чтения состояния и выходит после обработчика,
+    поэтому это ровно одно обновление. Обновления не блокируют друг друга —
+    как и без изоляции по умолчанию.
+    """
+
+    def __init__(self, storage: SQLAlchemyStorage):
+        self.storage = storage
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        async with self.storage.update_scope():
+            yield
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,126 @@
+"""
+Реестр загруженных файлов: каждый файл с диска загружается в Telegram один раз,
+дальше отправляется по file_id
+"""
+import asyncio
+import logging
+import os
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputMediaPhoto, Message
+
+from database import get_media_file_ids, save_media_file_ids, delete_media_file_ids
+import config
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых сохранённый file_id больше не годится; на остальные
+# (чат не найден, ошибка в подписи и т. п.) повторная загрузка не поможет
+FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file reference expired',
+                  'file_reference_expired')
+
+# path -> (mtime, size, file_id); загружается из БД при первом обращении
+_registry = None
+_registry_lock = asyncio.Lock()
+
+
+async def _get_registry():
+    global _registry
+    if _registry is None:
+        async with _registry_lock:
+            if _registry is None:
+                _registry = await get_media_file_ids()
+    return _registry
+
+
+def _stat(path: str):
+    """Ключ файла: путь относительно проекта, mtime и размер"""
+    st = os.stat(path)
+    return os.path.relpath(path, config.BASE_DIR), st.st_mtime, st.st_size
+
+
+async def _cached_file_id(path: str):
+    """file_id файла, если он уже загружался и не менялся с тех пор"""
+    key, mtime, size = _stat(path)
+    cached = (await _get_registry()).get(key)
+    if cached and cached[0] == mtime and cached[1] == size:
+        return cached[2]
+    return None
+
+
+async def _remember(uploaded: list):
+    """Сохранить file_id загруженных файлов: uploaded = [(path, file_id)]"""
+    registry = await _get_registry()
+    records = []
+    for path, file_id in uploaded:
+        key, mtime, size = _stat(path)
+        registry[key] = (mtime, size, file_id)
+        records.append((key, mtime, size, file_id))
+    try:
+        await save_media_file_ids(records)
+    except Exception as e:
+        logger.error(f"[MEDIA] Не удалось сохранить file_id: {e}")
+
+
+def _is_file_id_error(error: TelegramBadRequest) -> bool:
+    text = error.message.lower()
+    return any(marker in text for marker in FILE_ID_ERRORS)
+
+
+async def _forget(paths: list):
+    registry = await _get_registry()
+    keys = [_stat(path)[0] for path in paths]
+    for key in keys:
+        registry.pop(key, None)
+    try:
+        await delete_media_file_ids(keys)
+    except Exception as e:
+        logger.error(f"[MEDIA] Не удалось удалить file_id: {e}")
+
+
+async def send_document(bot: Bot, chat_id: int, path: str, caption: str = None) -> Message:
+    """Отправить файл с диска как документ (по file_id, если уже загружался)"""
+    file_id = await _cached_file_id(path)
+    if file_id:
+        try:
+            return await bot.send_document(chat_id, document=file_id, caption=caption)
+        except TelegramBadRequest as e:
+            if not _is_file_id_error(e):
+                raise
+            logger.warning(f"[MEDIA] file_id для {path} отклонён ({e}), загружаю заново")
+            await _forget([path])
+
+    message = await bot.send_document(chat_id, document=FSInputFile(path), caption=caption)
+    await _remember([(path, message.document.file_id)])
+    return message
+
+
+async def answer_photo_group(message: Message, photos: list):
+    """Отправить альбом фото с диска: photos = [(path, caption)]"""
+    file_ids = [await _cached_file_id(path) for path, _ in photos]
+
+    if any(file_ids):
+        media = [
+            InputMediaPhoto(media=file_id or FSInputFile(path), caption=caption)
+            for (path, caption), file_id in zip(photos, file_ids)
+        ]
+        try:
+            sent = await message.answer_media_group(media=media)
+        except TelegramBadRequest as e:
+            if not _is_file_id_error(e):
+                raise
+            logger.warning(f"[MEDIA] file_id альбома отклонён ({e}), загружаю заново")
+            await _forget([path for (path, _), file_id in zip(photos, file_ids) if file_id])
+        else:
+            await _remember([
+                (path, msg.photo[-1].file_id)
+                for (path, _), file_id, msg in zip(photos, file_ids, sent)
+                if not file_id
+            ])
+            return sent
+
+    media = [InputMediaPhoto(media=FSInputFile(path), caption=caption) for path, caption in photos]
+    sent = await message.answer_media_group(media=media)
+    await _remember([(path, msg.photo[-1].file_id) for (path, _), msg in zip(photos, sent)])
+    return sent
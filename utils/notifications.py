@@ -2,9 +2,11 @@
 Модуль уведомлений
 """
 from aiogram import Bot
-from database import async_session, User, Subscription, Visit, Booking, Training
-from sqlalchemy import select
-from datetime import datetime, timedelta
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from database import User, Subscription, Booking, Training, claim_notifications, mark_notification, set_users_active
+from sqlalchemy import select, literal, DateTime
+from datetime import datetime, timedelta, time
+from utils.delivery import deliver, send_with_retry
 import config
 
 
@@ -20,100 +22,82 @@ async def send_to_channel(bot: Bot, text: str, reply_markup=None):
         print(f"Ошибка отправки в канал {config.CHANNEL_USERNAME}: {e}")
 
 
-async def get_users_for_notification(notification_type: str) -> list:
-    """Получение списка пользователей для уведомлений"""
-    async with async_session() as session:
-        if notification_type == 'expiring':
-            # Абонементы, истекающие через 3 дня
-            target_date = datetime.utcnow() + timedelta(days=3)
-            result = await session.execute(
-                select(Subscription, User)
-                .join(User, Subscription.user_id == User.user_id)
-                .where(
-                    Subscription.is_active == True,
-                    Subscription.end_date <= target_date,
-                    Subscription.end_date > datetime.utcnow()
-                )
-            )
-            rows = result.all()
-            return [
-                {
-                    'user_id': row.User.user_id,
-                    'name': row.User.name,
-                    'end_date': row.Subscription.end_date.strftime('%d.%m.%Y')
-                }
-                for row in rows
-            ]
-
-        elif notification_type == 'inactive':
-            # Пользователи, не посещавшие 7 дней
-            target_date = datetime.utcnow() - timedelta(days=7)
-            result = await session.execute(
-                select(User, Visit)
-                .outerjoin(Visit, User.user_id == Visit.user_id)
-                .where(User.is_active == True)
-            )
-            rows = result.all()
-
-            inactive_users = []
-            user_last_visits = {}
-
-            for row in rows:
-                user_id = row.User.user_id
-                if user_id not in user_last_visits:
-                    user_last_visits[user_id] = {
-                        'user': row.User,
-                        'last_visit': None
-                    }
-                if row.Visit and (
-                    user_last_visits[user_id]['last_visit'] is None or
-                    row.Visit.visit_date > user_last_visits[user_id]['last_visit']
-                ):
-                    user_last_visits[user_id]['last_visit'] = row.Visit.visit_date
-
-            for user_id, data in user_last_visits.items():
-                if data['last_visit'] and data['last_visit'] < target_date:
-                    inactive_users.append({
-                        'user_id': user_id,
-                        'name': data['user'].name,
-                        'last_visit_date': data['last_visit'].strftime('%d.%m.%Y')
-                    })
-
-            return inactive_users
-
-        elif notification_type == 'expired':
-            # Абонементы, истёкшие 7 дней назад
-            target_date = datetime.utcnow() - timedelta(days=7)
-            result = await session.execute(
-                select(Subscription, User)
-                .join(User, Subscription.user_id == User.user_id)
-                .where(
-                    Subscription.is_active == False,
-                    Subscription.end_date <= target_date,
-                    Subscription.end_date > target_date - timedelta(days=1)
-                )
-            )
-            rows = result.all()
-            return [
-                {
-                    'user_id': row.User.user_id,
-                    'name': row.User.name
-                }
-                for row in rows
-            ]
-
-    return []
-
-
-async def send_expiring_notifications(bot: Bot):
-    """Уведомления об истекающих абонементах"""
-    users = await get_users_for_notification('expiring')
-
-    for user in users:
-        text = f"""
+def _subscription_candidates(*conditions):
+    """Абонементы-кандидаты на уведомление: ключ журнала — (абонемент, дата окончания)"""
+    return (
+        select(
+            User.user_id.label('user_id'),
+            Subscription.id.label('subject_id'),
+            Subscription.end_date.label('scheduled_for'),
+            User.name.label('name')
+        )
+        .join(User, Subscription.user_id == User.user_id)
+        .where(User.is_active == True, *conditions)
+    )
+
+
+async def _log_result(item, status: str):
+    """Записать в журнал результат отправки (log_id — четвёртый элемент)"""
+    await mark_notification(item[3], status)
+
+
+async def iter_inactive_users(slot: datetime, batch_size: int = 500):
+    """Пользователи, не посещавшие 7 дней и ещё не получившие уведомление за эту неделю (пачками)"""
+    target_date = slot - timedelta(days=7)
+    week = datetime.combine(slot.date(), time.min)
+    candidates = select(
+        User.user_id.label('user_id'),
+        literal(0).label('subject_id'),
+        literal(week, DateTime).label('scheduled_for'),
+        User.name.label('name'),
+        User.last_visit_at.label('last_visit_at')
+    ).where(
+        User.is_active == True,
+        User.last_visit_at < target_date
+    )
+
+    while True:
+        # Отобранные записываются в журнал, поэтому следующий вызов вернёт следующую пачку
+        rows = await claim_notifications('inactive', candidates, limit=batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield {
+                'user_id': row['user_id'],
+                'name': row['name'],
+                'last_visit_date': row['last_visit_at'].strftime('%d.%m.%Y'),
+                'log_id': row['log_id']
+            }
+
+
+async def send_expiring_notifications(bot: Bot, slot: datetime = None):
+    """Уведомления об истекающих абонементах (за 3 дня, один раз на абонемент)"""
+    slot = slot or datetime.utcnow()
+    users = await claim_notifications('expiring', _subscription_candidates(
+        Subscription.is_active == True,
+        Subscription.end_date <= slot + timedelta(days=3),
+        Subscription.end_date > slot
+    ))
+
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(
+                text=f"Продлить в одну группу ({config.PRICES['renewal_one']}₽)",
+                callback_data="renew_one_group"
+            )],
+            [InlineKeyboardButton(
+                text=f"Продлить во все группы ({config.PRICES['renewal_all']}₽)",
+                callback_data="renew_all_groups"
+            )]
+        ]
+    )
+
+    def messages():
+        for user in users:
+            text = f"""
 Привет, {user['name']}!
 
-Твой абонемент заканчивается через 3 дня ({user['end_date']}).
+Твой абонемент заканчивается через 3 дня ({user['scheduled_for'].strftime('%d.%m.%Y')}).
 
 Продли сейчас со СКИДКОЙ:
 - В одну группу: {config.PRICES['renewal_one']}₽ вместо {config.PRICES['one_group']}₽
@@ -121,33 +105,23 @@ async def send_expiring_notifications(bot: Bot):
 
 Скидка только до конца месяца!
         """
+            yield user['user_id'], text, keyboard, user['log_id']
 
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(
-                    text=f"Продлить в одну группу ({config.PRICES['renewal_one']}₽)",
-                    callback_data="renew_one_group"
-                )],
-                [InlineKeyboardButton(
-                    text=f"Продлить во все группы ({config.PRICES['renewal_all']}₽)",
-                    callback_data="renew_all_groups"
-                )]
-            ]
-        )
-
-        try:
-            await bot.send_message(user['user_id'], text, reply_markup=keyboard)
-        except Exception as e:
-            print(f"Ошибка отправки уведомления пользователю {user['user_id']}: {e}")
+    return await deliver(bot, 'expiring', messages(), on_result=_log_result)
 
 
-async def send_inactive_notifications(bot: Bot):
-    """Уведомления неактивным клиентам (не был 7 дней)"""
-    users = await get_users_for_notification('inactive')
+async def send_inactive_notifications(bot: Bot, slot: datetime = None):
+    """Уведомления неактивным клиентам (не был 7 дней, раз в неделю)"""
+    slot = slot or datetime.utcnow()
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Записаться на тренировку", callback_data="book_training")]
+        ]
+    )
 
-    for user in users:
-        text = f"""
+    async def messages():
+        async for user in iter_inactive_users(slot):
+            text = f"""
 Привет, {user['name']}!
 
 Заметила, что ты давно не была на тренировках (последний раз — {user['last_visit_date']}).
@@ -156,26 +130,38 @@ async def send_inactive_notifications(bot: Bot):
 
 Напиши, если нужна помощь!
         """
-
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(text="Записаться на тренировку", callback_data="book_training")]
-            ]
-        )
-
-        try:
-            await bot.send_message(user['user_id'], text, reply_markup=keyboard)
-        except Exception as e:
-            print(f"Ошибка отправки уведомления пользователю {user['user_id']}: {e}")
-
-
-async def send_comeback_notifications(bot: Bot):
-    """Уведомления возврата (абонемент истёк 7 дней назад)"""
-    users = await get_users_for_notification('expired')
-
-    for user in users:
-        text = f"""
+            yield user['user_id'], text, keyboard, user['log_id']
+
+    return await deliver(bot, 'inactive', messages(), on_result=_log_result)
+
+
+async def send_comeback_notifications(bot: Bot, slot: datetime = None):
+    """Уведомления возврата (абонемент истёк 7 дней назад, один раз на абонемент)"""
+    slot = slot or datetime.utcnow()
+    target_date = slot - timedelta(days=7)
+    # Окно в 3 дня — срок действия предложения: пропущенные запуски догоняются
+    users = await claim_notifications('comeback', _subscription_candidates(
+        Subscription.is_active == False,
+        Subscription.end_date <= target_date,
+        Subscription.end_date > target_date - timedelta(days=3)
+    ))
+
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(
+                text=f"В одну группу ({config.PRICES['renewal_one']}₽)",
+                callback_data="comeback_one_group"
+            )],
+            [InlineKeyboardButton(
+                text=f"Во все группы ({config.PRICES['renewal_all']}₽)",
+                callback_data="comeback_all_groups"
+            )]
+        ]
+    )
+
+    def messages():
+        for user in users:
+            text = f"""
 Соскучились!
 
 Прошла неделя с окончания твоего абонемента.
@@ -187,74 +173,55 @@ async def send_comeback_notifications(bot: Bot):
 
 Предложение действует 3 дня!
         """
+            yield user['user_id'], text, keyboard, user['log_id']
 
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(
-                    text=f"В одну группу ({config.PRICES['renewal_one']}₽)",
-                    callback_data="comeback_one_group"
-                )],
-                [InlineKeyboardButton(
-                    text=f"Во все группы ({config.PRICES['renewal_all']}₽)",
-                    callback_data="comeback_all_groups"
-                )]
-            ]
-        )
+    return await deliver(bot, 'comeback', messages(), on_result=_log_result)
 
-        try:
-            await bot.send_message(user['user_id'], text, reply_markup=keyboard)
-        except Exception as e:
-            print(f"Ошибка отправки уведомления пользователю {user['user_id']}: {e}")
-
-
-async def send_training_reminders(bot: Bot):
-    """Напоминания о тренировках (за 2 часа)"""
-    now = datetime.now()
-    reminder_time = now + timedelta(hours=2)
-
-    # Временное окно: от 1 ч 50 мин до 2 ч 10 мин до тренировки
-    window_start = now + timedelta(hours=1, minutes=50)
-    window_end = now + timedelta(hours=2, minutes=10)
-
-    async with async_session() as session:
-        # Получаем записи на ближайшие тренировки
-        result = await session.execute(
-            select(Booking, Training, User)
-            .join(Training, Booking.training_id == Training.id)
-            .join(User, Booking.user_id == User.user_id)
-            .where(
-                Booking.status == 'active',
-                Booking.booking_date >= window_start,
-                Booking.booking_date <= window_end
-            )
-        )
-        rows = result.all()
 
-    for row in rows:
-        booking = row.Booking
-        training = row.Training
-        user = row.User
+async def send_booking_reminder(bot: Bot, booking_id: int, now: datetime):
+    """Напоминание об одной записи на тренировку (отправляется один раз)"""
+    rows = await claim_notifications('training_reminder', (
+        select(
+            User.user_id.label('user_id'),
+            Booking.id.label('subject_id'),
+            Booking.booking_date.label('scheduled_for'),
+            User.name.label('name'),
+            Training.name.label('training_name'),
+            Training.training_type.label('training_type')
+        )
+        .join(Training, Booking.training_id == Training.id)
+        .join(User, Booking.user_id == User.user_id)
+        .where(
+            Booking.id == booking_id,
+            Booking.status == 'active',
+            Booking.booking_date > now,
+            User.is_active == True
+        )
+    ))
+    if not rows:
+        return None
 
-        training_type_text = "онлайн" if training.training_type == "online" else "в студии"
-        text = f"""
-Привет, {user.name}!
+    row = rows[0]
+    training_type_text = "онлайн" if row['training_type'] == "online" else "в студии"
+    text = f"""
+Привет, {row['name']}!
 
-Напоминаю о тренировке через 2 часа:
+Напоминаю о тренировке сегодня:
 
-{training.name}
-Время: {booking.booking_date.strftime('%H:%M')}
+{row['training_name']}
+Время: {row['scheduled_for'].strftime('%H:%M')}
 Формат: {training_type_text}
 """
 
-        if training.training_type == "online":
-            text += "\nСсылка на Zoom будет отправлена за 10 минут до начала."
-        else:
-            text += f"\nАдрес: {config.STUDIO_ADDRESS}"
+    if row['training_type'] == "online":
+        text += "\nСсылка на Zoom будет отправлена за 10 минут до начала."
+    else:
+        text += f"\nАдрес: {config.STUDIO_ADDRESS}"
 
-        text += "\n\nЖдём тебя!"
+    text += "\n\nЖдём тебя!"
 
-        try:
-            await bot.send_message(user.user_id, text)
-        except Exception as e:
-            print(f"Ошибка отправки напоминания пользователю {user.user_id}: {e}")
+    status, _ = await send_with_retry(bot, row['user_id'], text)
+    await mark_notification(row['log_id'], status)
+    if status == 'blocked':
+        await set_users_active([row['user_id']], False)
+    return status
@@ -0,0 +1,58 @@
+"""
+Ограничитель частоты запросов к Telegram Bot API
+"""
+import asyncio
+import time
+
+import config
+
+
+class TokenBucket:
+    """Token bucket: не больше rate запросов в секунду, адаптируется к RetryAfter"""
+
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = 1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Дождаться разрешения на один запрос (ожидающие обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_retry_after(self, retry_after: float):
+        """Telegram вернул RetryAfter: пауза для всех и снижение скорости вдвое"""
+        now = time.monotonic()
+        # Параллельные запросы получают RetryAfter пачкой — скорость снижаем один раз
+        if now >= self._blocked_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self._blocked_until = max(self._blocked_until, now + retry_after)
+        self._tokens = 0
+        self._updated = now
+
+    def on_success(self):
+        """Успешный запрос: плавно возвращаем скорость к максимальной"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+# Общий лимитер на все массовые отправки бота
+telegram_limiter = TokenBucket(config.TELEGRAM_RATE_LIMIT)
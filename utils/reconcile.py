@@ -0,0 +1,98 @@
+"""
+Сверка оплат абонементов с выданными абонементами.
+
+Каждую ночь сверяются все подтверждённые оплаты из каталога
+config.SUBSCRIPTION_PRODUCTS: оплаты без абонемента, пересекающиеся
+действующие абонементы, истёкшие, но не выключенные. По умолчанию ночью
+только отчёт админам; исправление — /reconcile fix или
+SUBSCRIPTION_RECONCILE_REPAIR=true.
+"""
+import logging
+import time
+
+from aiogram import Bot
+
+from database import reconcile_subscriptions
+import config
+
+logger = logging.getLogger(__name__)
+
+MISSING_SHOWN = 10  # сколько оплат без абонемента перечислять в отчёте
+
+
+def _same_type_overlaps(report: dict) -> int:
+    return sum(1 for o in report['overlaps'] if o['first_type'] == o['second_type'])
+
+
+def has_problems(report: dict) -> bool:
+    """Есть ли о чём сообщить админам: выключение истёкших — плановое, а пересечение
+    разных типов — обычный переход на другой абонемент"""
+    return bool(report['missing'] or _same_type_overlaps(report))
+
+
+async def run_reconciliation(repair: bool = False) -> dict:
+    """Сверка с замером времени и записью в лог"""
+    started = time.monotonic()
+    report = await reconcile_subscriptions(repair=repair)
+    report['elapsed'] = time.monotonic() - started
+    logger.info(
+        f"[RECONCILE] {report['months']} мес. за {report['elapsed']:.2f} с: "
+        f"без абонемента {len(report['missing'])}, истёкших активных {report['expired_active']}, "
+        f"пересечений {len(report['overlaps'])}, привязано старых {report['linked']}"
+        + (f"; выдано {report['created']}, выключено {report['deactivated']}, "
+           f"сдвинуто {report['shifted']}" if repair else "")
+    )
+    return report
+
+
+def format_reconciliation_report(report: dict) -> str:
+    """Отчёт сверки для админа"""
+    text = "🧾 СВЕРКА ОПЛАТ И АБОНЕМЕНТОВ\n\n"
+    text += f"Проверено месяцев: {report['months']} ({report['elapsed']:.1f} с)\n\n"
+
+    missing = report['missing']
+    if missing:
+        text += f"❗ Оплаты без абонемента: {len(missing)}\n"
+        for item in missing[:MISSING_SHOWN]:
+            date_str = item['paid_at'].strftime('%d.%m.%Y') if item['paid_at'] else '—'
+            text += f"• платёж #{item['payment_id']}, клиент {item['user_id']}, {item['payment_type']}, {date_str}\n"
+        if len(missing) > MISSING_SHOWN:
+            text += f"… и ещё {len(missing) - MISSING_SHOWN}\n"
+    else:
+        text += "✅ У всех оплат есть абонемент\n"
+
+    if report['expired_active']:
+        text += f"❗ Истёкшие, но активные абонементы: {report['expired_active']}\n"
+
+    overlaps = report['overlaps']
+    if overlaps:
+        text += f"❗ Пересекающиеся абонементы: {len(overlaps)} (одного типа: {_same_type_overlaps(report)})\n"
+
+    if report['linked']:
+        text += f"ℹ️ Старых абонементов без связи с оплатой: {report['linked']}\n"
+
+    if report['repair']:
+        text += (
+            f"\n🔧 Исправлено: выдано {report['created']}, привязано {report['linked']}, "
+            f"выключено {report['deactivated']}, сдвинуто {report['shifted']}"
+        )
+        if len(overlaps) > _same_type_overlaps(report):
+            text += "\nПересечения разных типов (переход на другой абонемент) оставлены как есть"
+    elif has_problems(report) or report['expired_active'] or report['linked']:
+        text += "\nИсправить: /reconcile fix"
+    return text
+
+
+async def nightly_reconciliation(bot: Bot):
+    """Ночная сверка; админам пишем, только если что-то нашлось"""
+    report = await run_reconciliation(repair=config.SUBSCRIPTION_RECONCILE_REPAIR)
+    if not has_problems(report):
+        return report
+
+    text = format_reconciliation_report(report)
+    for admin_id in config.ADMIN_IDS:
+        try:
+            await bot.send_message(admin_id, text)
+        except Exception as e:
+            logger.error(f"[RECONCILE] Не удалось отправить отчёт админу {admin_id}: {e}")
+    return report
@@ -0,0 +1,204 @@
+"""
+Расписание студии: config.SCHEDULE — единственный источник.
+Отсюда рисуется текст (с кэшем по версии) и синхронизируется таблица trainings,
+здесь же разбор/проверка правок из админки
+"""
+import logging
+import re
+
+from database import sync_trainings
+import config
+
+logger = logging.getLogger(__name__)
+
+DAYS_ORDER = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+_TIME_RE = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+_TRAINER_RE = re.compile(r'^[A-Za-zА-Яа-яЁё][A-Za-zА-Яа-яЁё \-]*$')
+_DAY_OFF_WORDS = {'', '-', 'выходной'}
+# В старом текстовом формате встречаются эмодзи, скобки, тире — перед разбором убираем
+_LEGACY_NOISE_RE = re.compile(r'[^\w:,\s-]|_|(?<!\w)-|-(?!\w)')
+
+# Отрисованный текст и версия расписания, из которой он получен
+_rendered = {'version': None, 'full': None, 'days': {}}
+
+
+def _render_day(day: str) -> str:
+    """Markdown-текст одного дня"""
+    title = config.DAY_TITLES.get(day, day.upper())
+    trainings = config.SCHEDULE.get(day, [])
+
+    if not trainings:
+        return f"🔘 *{title}*\n\n🌴 Выходной день\nВосстанавливаемся и набираемся сил! 💪"
+
+    lines = [f"🔘 *{title}*\n"]
+
+    # Группируем по типу тренировки
+    grouped = {}
+    for t in trainings:
+        grouped.setdefault(t["type"], []).append(t)
+
+    for training_type, entries in grouped.items():
+        emoji = config.TRAINING_EMOJIS.get(training_type, "🏃‍♀️")
+        lines.append(f"{emoji} *{training_type}*")
+
+        if len(entries) == 1 and len(entries[0]["times"]) == 1:
+            lines.append(f"✅ {entries[0]['times'][0]} - {entries[0]['trainer']}")
+        else:
+            for entry in entries:
+                lines.append(f"👩‍🏫 Тренер {entry['trainer']}:")
+                for time in entry["times"]:
+                    lines.append(f"✅ {time}")
+
+        lines.append("")
+
+    return "\n".join(lines).rstrip()
+
+
+def _render():
+    days = {day: _render_day(day) for day in DAYS_ORDER}
+    parts = ["📅 *РАСПИСАНИЕ ТРЕНИРОВОК*\n\n📍 г. Новотроицк, пр. Комсомольский 3 (2 этаж)\n"]
+    parts.extend(days[day] for day in DAYS_ORDER)
+    parts.append("\n📞 Анна: @\\_an\\_sport\\_\n📞 Алена: +7 961 908 0598")
+
+    _rendered['days'] = days
+    _rendered['full'] = "\n━━━━━━━━━━━━━━━━━━━\n".join(parts)
+    _rendered['version'] = config.SCHEDULE_VERSION
+
+
+def _ensure_rendered():
+    if _rendered['version'] != config.SCHEDULE_VERSION:
+        _render()
+
+
+def get_full_schedule_text() -> str:
+    """Полное расписание (Markdown); перерисовывается только после save_schedule"""
+    _ensure_rendered()
+    return _rendered['full']
+
+
+def get_day_schedule_text(day: str) -> str:
+    """Расписание одного дня (Markdown)"""
+    _ensure_rendered()
+    return _rendered['days'][day]
+
+
+def day_schedule_to_text(day: str) -> str:
+    """Расписание дня в формате для редактирования: «Тип Тренер время, время» по строке"""
+    entries = config.SCHEDULE.get(day, [])
+    if not entries:
+        return "выходной"
+    return "\n".join(
+        f"{entry['type']} {entry['trainer']} {', '.join(entry['times'])}"
+        for entry in entries
+    )
+
+
+def parse_day_schedule(text: str) -> list:
+    """
+    Разобрать расписание дня из текста админа.
+
+    Каждая строка — «Тип Тренер время, время», например «Силовая Анна 8:30, 17:10».
+    «выходной» или «-» — день без тренировок. При ошибке — ValueError с понятным текстом.
+    """
+    if text.strip().lower() in _DAY_OFF_WORDS:
+        return []
+
+    known_types = list(config.TRAINING_EMOJIS)
+    entries = []
+    for number, line in enumerate(text.strip().splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+
+        training_type = next((t for t in known_types if line.lower().startswith(t.lower() + ' ')), None)
+        if not training_type:
+            raise ValueError(f"Строка {number}: тип тренировки должен быть одним из: {', '.join(known_types)}")
+
+        rest = line[len(training_type):].strip()
+        match = re.match(r'^(.*?)\s+(\d.*)$', rest)
+        if not match:
+            raise ValueError(f"Строка {number}: укажи тренера и время, например «{training_type} Анна 8:30, 17:10»")
+
+        trainer, times_text = match.group(1).strip(), match.group(2)
+        if not _TRAINER_RE.match(trainer):
+            raise ValueError(f"Строка {number}: имя тренера может содержать только буквы, пробел и дефис")
+
+        times = []
+        for raw in re.split(r'[,\s]+', times_text.strip()):
+            time_match = _TIME_RE.match(raw)
+            if not time_match:
+                raise ValueError(f"Строка {number}: неверное время «{raw}», нужно ЧЧ:ММ")
+            times.append(f"{int(time_match.group(1))}:{time_match.group(2)}")
+
+        entries.append({"type": training_type, "trainer": trainer, "times": times})
+
+    config.validate_day_schedule(entries)
+    return entries
+
+
+def convert_skipped_days() -> list:
+    """
+    Перевести дни schedule.json в старом текстовом формате (до структурного расписания).
+
+    Разобранные сохраняются в новом формате; что не разобрать — предупреждение
+    в логе с названием дня и прежним текстом, для дня действует расписание по умолчанию.
+    Возвращает переведённые дни.
+    """
+    converted = []
+    for day, value in list(config.SCHEDULE_SKIPPED.items()):
+        try:
+            if not isinstance(value, str):
+                raise ValueError("неверная структура")
+            lines = (_LEGACY_NOISE_RE.sub(' ', line) for line in value.splitlines())
+            entries = parse_day_schedule("\n".join(' '.join(line.split()) for line in lines))
+        except ValueError as e:
+            logger.warning(
+                f"[SCHEDULE] {config.DAY_TITLES[day]}: сохранённое расписание не принято ({e}), "
+                f"действует расписание по умолчанию. Было: {value!r}"
+            )
+            continue
+        config.SCHEDULE[day] = entries
+        del config.SCHEDULE_SKIPPED[day]
+        converted.append(day)
+
+    if converted:
+        config.save_schedule()
+        logger.info(f"[SCHEDULE] Переведены из старого формата: {', '.join(config.DAY_TITLES[d] for d in converted)}")
+    return converted
+
+
+def _normalize_time(value: str) -> str:
+    """«8:30» → «08:30»: в trainings время хранится с ведущим нулём (сортировка строкой)"""
+    hour, _, minute = value.partition(':')
+    return f"{int(hour):02d}:{minute}"
+
+
+def schedule_slots() -> list:
+    """Слоты расписания для таблицы trainings: [{name, trainer, day_of_week, time}]"""
+    slots = []
+    for day_of_week, day in enumerate(DAYS_ORDER):
+        for entry in config.SCHEDULE.get(day, []):
+            for time in entry["times"]:
+                slots.append({
+                    "name": config.TRAINING_NAMES[entry["type"]],
+                    "trainer": entry["trainer"],
+                    "day_of_week": day_of_week,
+                    "time": _normalize_time(time),
+                })
+    return slots
+
+
+async def sync_schedule() -> dict:
+    """Привести таблицу trainings к config.SCHEDULE"""
+    return await sync_trainings(schedule_slots())
+
+
+async def set_day_schedule(day: str, entries: list) -> dict:
+    """Сохранить проверенное расписание дня и синхронизировать trainings"""
+    if day not in DAYS_ORDER:
+        raise ValueError(f"Неизвестный день: {day}")
+    config.validate_day_schedule(entries)
+    config.SCHEDULE[day] = entries
+    config.save_schedule()
+    return await sync_schedule()
@@ -1,18 +1,39 @@
 """
 Планировщик задач для автоматических уведомлений
 """
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 from utils.notifications import (
     send_expiring_notifications,
     send_inactive_notifications,
     send_comeback_notifications,
-    send_training_reminders
+    send_booking_reminder
+)
+from database import (
+    get_bookings_without_reminder,
+    release_pending_notifications,
+    save_scheduled_job,
+    delete_scheduled_job,
+    iter_scheduled_jobs,
+    delete_scheduled_jobs_before,
 )
+from utils.reconcile import nightly_reconciliation
+
+import config
+
+TIMEZONE = "Europe/Moscow"
 
 _scheduler = None
+_bot = None
 
 
 def get_scheduler():
@@ -20,41 +41,77 @@ def get_scheduler():
     return _scheduler
 
 
-def setup_scheduler(bot):
-    """Настройка планировщика задач"""
-    global _scheduler
-    scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+def get_bot():
+    """Бот для задач планировщика (в задачи передаются только сериализуемые аргументы)"""
+    return _bot
+
+
+def _studio_now() -> datetime:
+    """Текущее время студии (время записей хранится без часового пояса)"""
+    return datetime.now(ZoneInfo(TIMEZONE)).replace(tzinfo=None)
 
-    # Уведомления об истекающих абонементах (каждый день в 10:00)
-    scheduler.add_job(
-        send_expiring_notifications,
-        trigger=CronTrigger(hour=10, minute=0),
-        args=[bot],
-        id='expiring_notifications'
-    )
 
+# (id, функция, расписание) регулярных уведомлений
+CRON_JOBS = [
+    # Уведомления об истекающих абонементах (каждый день в 10:00)
+    ('expiring_notifications', send_expiring_notifications, CronTrigger(hour=10, minute=0, timezone=TIMEZONE)),
     # Уведомления неактивным (каждое воскресенье в 11:00)
-    scheduler.add_job(
-        send_inactive_notifications,
-        trigger=CronTrigger(day_of_week='sun', hour=11, minute=0),
-        args=[bot],
-        id='inactive_notifications'
+    ('inactive_notifications', send_inactive_notifications, CronTrigger(day_of_week='sun', hour=11, minute=0, timezone=TIMEZONE)),
+    # Уведомления возврата (каждый день в 12:00)
+    ('comeback_notifications', send_comeback_notifications, CronTrigger(hour=12, minute=0, timezone=TIMEZONE)),
+]
+
+# Как часто снимать просроченные отметки неотправленных уведомлений
+RELEASE_CLAIMS_TRIGGER = IntervalTrigger(minutes=15, timezone=TIMEZONE)
+
+# Ночная сверка оплат и абонементов (не уведомление — в догоняющий запуск не входит)
+RECONCILE_TRIGGER = CronTrigger(hour=3, minute=30, timezone=TIMEZONE)
+
+# За сколько до начала тренировки напоминать
+REMINDER_BEFORE = timedelta(hours=2)
+
+# add_job в APScheduler синхронный (~0.2 мс): при массовой загрузке задач
+# через столько штук отдаём управление циклу событий
+LOAD_YIELD_EVERY = 100
+
+
+@asynccontextmanager
+async def _bulk_load():
+    """Массовое добавление задач: на паузе планировщик не просыпается на каждую задачу"""
+    scheduler = get_scheduler()
+    scheduler.pause()
+    try:
+        yield scheduler
+    finally:
+        scheduler.resume()
+
+
+def setup_scheduler(bot):
+    """Настройка планировщика задач"""
+    global _scheduler, _bot
+    _bot = bot
+
+    # Все задачи живут в памяти: хранилище APScheduler на синхронном драйвере
+    # блокировало бы цикл событий. Регулярные задачи объявлены в коде,
+    # напоминания восстанавливаются из записей, а разовые задачи пользователей
+    # (воронки, повторы) — из таблицы scheduled_jobs (load_durable_jobs).
+    scheduler = AsyncIOScheduler(
+        timezone=TIMEZONE,
+        job_defaults={
+            'misfire_grace_time': config.SCHEDULER_MISFIRE_GRACE,
+            'coalesce': True,
+        }
     )
 
-    # Уведомления возврата (каждый день в 12:00)
+    for job_id, func, trigger in CRON_JOBS:
+        scheduler.add_job(func, trigger=trigger, args=[bot], id=job_id)
     scheduler.add_job(
-        send_comeback_notifications,
-        trigger=CronTrigger(hour=12, minute=0),
-        args=[bot],
-        id='comeback_notifications'
+        nightly_reconciliation, trigger=RECONCILE_TRIGGER, args=[bot],
+        id='subscription_reconcile'
     )
-
-    # Напоминания о тренировках (каждый час)
     scheduler.add_job(
-        send_training_reminders,
-        trigger=CronTrigger(minute=0),
-        args=[bot],
-        id='training_reminders'
+        release_stale_notifications, trigger=RELEASE_CLAIMS_TRIGGER,
+        id='release_notification_claims'
     )
 
     scheduler.start()
@@ -62,41 +119,176 @@ def setup_scheduler(bot):
     return scheduler
 
 
-def schedule_video_funnel(bot, user_id: int):
-    """Запуск воронки после оплаты онлайн-тренировки"""
+def _previous_fire_time(trigger, now: datetime, since: datetime):
+    """Последнее срабатывание расписания в промежутке (since, now]"""
+    previous = None
+    fire_time = trigger.get_next_fire_time(None, since)
+    while fire_time and fire_time <= now:
+        previous = fire_time
+        fire_time = trigger.get_next_fire_time(previous, previous + timedelta(seconds=1))
+    return previous
+
+
+async def run_notification_catchup(bot):
+    """
+    Догнать уведомления, пропущенные пока бот был выключен.
+
+    Для каждой задачи берётся последнее плановое срабатывание за
+    NOTIFICATION_CATCHUP_HOURS часов; уже отправленное отсекает журнал уведомлений.
+    """
     import logging
-    from datetime import datetime, timedelta
 
     logger = logging.getLogger(__name__)
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(hours=config.NOTIFICATION_CATCHUP_HOURS)
+
+    for job_id, func, trigger in CRON_JOBS:
+        slot = _previous_fire_time(trigger, now, since)
+        if not slot:
+            continue
+        try:
+            stats = await func(bot, slot=slot.astimezone(timezone.utc).replace(tzinfo=None))
+            if stats.total:
+                logger.info(f"[CATCHUP] {job_id} за {slot:%d.%m %H:%M}: отправлено {stats.sent} из {stats.total}")
+        except Exception as e:
+            logger.error(f"[CATCHUP] Ошибка догоняющего запуска {job_id}: {e}")
+
+
+async def release_stale_notifications():
+    """Вернуть в очередь уведомления, отобранные процессом, который не дожил до отправки"""
+    import logging
+
+    logger = logging.getLogger(__name__)
+    released = await release_pending_notifications(
+        timedelta(minutes=config.NOTIFICATION_CLAIM_LEASE_MINUTES)
+    )
+    if released:
+        logger.info(f"[NOTIFY] Брошенных уведомлений к повторной отправке: {released}")
+    return released
+
+
+def schedule_booking_reminder(booking_id: int, booking_date: datetime):
+    """Запланировать напоминание о записи за 2 часа (сразу, если до начала меньше)"""
     scheduler = get_scheduler()
     if not scheduler:
-        logger.error(f"[FUNNEL] Планировщик не найден, воронка для {user_id} не запущена")
         return
-
-    # Шаг 1: Через 24 часа — напоминание + cross-sell
-    run_time_1 = datetime.now() + timedelta(hours=24)
+    run_date = max(booking_date - REMINDER_BEFORE, _studio_now())
     scheduler.add_job(
-        _video_funnel_step1,
-        trigger=DateTrigger(run_date=run_time_1),
-        args=[bot, user_id],
-        id=f'video_funnel_step1_{user_id}',
+        _booking_reminder,
+        trigger=DateTrigger(run_date=run_date, timezone=TIMEZONE),
+        args=[booking_id],
+        id=f'booking_reminder_{booking_id}',
         replace_existing=True
     )
 
-    # Шаг 2: Через 3 дня — предложение регулярных тренировок
-    run_time_2 = datetime.now() + timedelta(days=3)
-    scheduler.add_job(
-        _video_funnel_step2,
-        trigger=DateTrigger(run_date=run_time_2),
-        args=[bot, user_id],
-        id=f'video_funnel_step2_{user_id}',
+
+def cancel_booking_reminder(booking_id: int):
+    """Убрать напоминание об отменённой записи"""
+    scheduler = get_scheduler()
+    if not scheduler:
+        return
+    try:
+        scheduler.remove_job(f'booking_reminder_{booking_id}')
+    except JobLookupError:
+        pass
+
+
+async def _booking_reminder(booking_id: int):
+    await send_booking_reminder(get_bot(), booking_id, _studio_now())
+
+
+async def rebuild_booking_reminders():
+    """Запланировать напоминания для всех будущих записей, по которым напоминание ещё не отправлено"""
+    import logging
+
+    logger = logging.getLogger(__name__)
+    restored = 0
+    # Напоминания живут только в памяти: при запуске планируем все заново
+    async with _bulk_load():
+        for booking_id, booking_date in await get_bookings_without_reminder(_studio_now()):
+            schedule_booking_reminder(booking_id, booking_date)
+            restored += 1
+            if restored % LOAD_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+    if restored:
+        logger.info(f"[REMINDER] Восстановлено напоминаний: {restored}")
+
+
+async def add_durable_job(job_id: str, name: str, run_at: datetime, args: list):
+    """Запланировать разовую задачу из DURABLE_JOBS: сначала в БД, потом в планировщик"""
+    await save_scheduled_job(job_id, name, args, run_at.astimezone(timezone.utc).replace(tzinfo=None))
+    _schedule_durable_job(job_id, name, args, run_at)
+
+
+def _schedule_durable_job(job_id: str, name: str, args: list, run_at: datetime):
+    get_scheduler().add_job(
+        _run_durable_job,
+        trigger=DateTrigger(run_date=run_at),
+        args=[job_id, name, args],
+        id=job_id,
         replace_existing=True
     )
 
+
+async def _run_durable_job(job_id: str, name: str, args: list):
+    # Задача выполняется не больше одного раза: запись удаляется до запуска
+    await delete_scheduled_job(job_id)
+    await DURABLE_JOBS[name](*args)
+
+
+async def load_durable_jobs():
+    """
+    Вернуть в планировщик разовые задачи из БД.
+
+    Просроченные за время простоя выполняются один раз сразу, если опоздание
+    не больше SCHEDULER_MISFIRE_GRACE; более старые удаляются.
+    """
+    import logging
+
+    logger = logging.getLogger(__name__)
+    now = datetime.now(timezone.utc)
+    expired = await delete_scheduled_jobs_before(
+        (now - timedelta(seconds=config.SCHEDULER_MISFIRE_GRACE)).replace(tzinfo=None)
+    )
+    if expired:
+        logger.warning(f"[SCHEDULER] Удалено просроченных отложенных задач: {expired}")
+
+    loaded = 0
+    async with _bulk_load():
+        async for batch in iter_scheduled_jobs():
+            for job_id, name, args, run_at in batch:
+                if name not in DURABLE_JOBS:
+                    logger.error(f"[SCHEDULER] Неизвестная отложенная задача {job_id}: {name}")
+                    continue
+                _schedule_durable_job(job_id, name, args, run_at.replace(tzinfo=timezone.utc))
+                loaded += 1
+                if loaded % LOAD_YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+    if loaded:
+        logger.info(f"[SCHEDULER] Загружено отложенных задач: {loaded}")
+    return loaded
+
+
+async def schedule_video_funnel(user_id: int):
+    """Запуск воронки после оплаты онлайн-тренировки"""
+    import logging
+
+    logger = logging.getLogger(__name__)
+    scheduler = get_scheduler()
+    if not scheduler:
+        logger.error(f"[FUNNEL] Планировщик не найден, воронка для {user_id} не запущена")
+        return
+
+    now = datetime.now(timezone.utc)
+    # Шаг 1: Через 24 часа — напоминание + cross-sell
+    await add_durable_job(f'video_funnel_step1_{user_id}', 'video_funnel_step1', now + timedelta(hours=24), [user_id])
+    # Шаг 2: Через 3 дня — предложение регулярных тренировок
+    await add_durable_job(f'video_funnel_step2_{user_id}', 'video_funnel_step2', now + timedelta(days=3), [user_id])
+
     logger.info(f"[FUNNEL] Воронка онлайн-тренировки запущена для user_id={user_id}")
 
 
-async def _video_funnel_step1(bot, user_id: int):
+async def _video_funnel_step1(user_id: int):
     """Шаг 1 воронки: через 24 часа после оплаты"""
     import logging
     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -109,7 +301,7 @@ async def _video_funnel_step1(bot, user_id: int):
                 [InlineKeyboardButton(text="📋 Меню питания", callback_data="online_menu")],
             ]
         )
-        await bot.send_message(
+        await get_bot().send_message(
             user_id,
             "Привет! Как прошла тренировка? 😊\n\n"
             "Для лучшего результата важно сочетать тренировки "
@@ -123,7 +315,7 @@ async def _video_funnel_step1(bot, user_id: int):
         logger.error(f"[FUNNEL] Ошибка шага 1 для user_id={user_id}: {e}")
 
 
-async def _video_funnel_step2(bot, user_id: int):
+async def _video_funnel_step2(user_id: int):
     """Шаг 2 воронки: через 3 дня после оплаты"""
     import logging
     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -137,7 +329,7 @@ async def _video_funnel_step2(bot, user_id: int):
                 [InlineKeyboardButton(text="📹 Ещё онлайн-тренировка", callback_data="online_video")],
             ]
         )
-        await bot.send_message(
+        await get_bot().send_message(
             user_id,
             "Хочешь тренироваться регулярно? 💪\n\n"
             "С абонементом в студию — групповые тренировки каждый день, "
@@ -151,20 +343,18 @@ async def _video_funnel_step2(bot, user_id: int):
         logger.error(f"[FUNNEL] Ошибка шага 2 для user_id={user_id}: {e}")
 
 
-async def schedule_menu_retry(bot, user_id: int, file_path: str, caption: str, attempt: int = 1, max_attempts: int = 3):
+async def schedule_menu_retry(user_id: int, file_path: str, caption: str, attempt: int = 1, max_attempts: int = 3):
     """Запланировать повторную отправку PDF меню через 5 минут"""
     import os
     import logging
-    from datetime import datetime, timedelta
-    from aiogram.types import FSInputFile
-    import config
+    from utils.media import send_document
 
     logger = logging.getLogger(__name__)
+    bot = get_bot()
 
     try:
         if os.path.exists(file_path):
-            menu_file = FSInputFile(file_path)
-            await bot.send_document(user_id, document=menu_file, caption=caption)
+            await send_document(bot, user_id, file_path, caption=caption)
             logger.info(f"Меню отправлено пользователю {user_id} (попытка {attempt})")
             return
         else:
@@ -175,13 +365,10 @@ async def schedule_menu_retry(bot, user_id: int, file_path: str, caption: str, a
         if attempt < max_attempts:
             scheduler = get_scheduler()
             if scheduler:
-                run_time = datetime.now() + timedelta(minutes=5)
-                scheduler.add_job(
-                    schedule_menu_retry,
-                    trigger=DateTrigger(run_date=run_time),
-                    args=[bot, user_id, file_path, caption, attempt + 1, max_attempts],
-                    id=f'menu_retry_{user_id}_{attempt + 1}',
-                    replace_existing=True
+                run_time = datetime.now(timezone.utc) + timedelta(minutes=5)
+                await add_durable_job(
+                    f'menu_retry_{user_id}_{attempt + 1}', 'menu_retry', run_time,
+                    [user_id, file_path, caption, attempt + 1, max_attempts]
                 )
                 logger.info(f"Повторная отправка меню для {user_id} запланирована (попытка {attempt + 1})")
         else:
@@ -195,3 +382,11 @@ async def schedule_menu_retry(bot, user_id: int, file_path: str, caption: str, a
                     )
                 except Exception:
                     pass
+
+
+# Разовые задачи, которые переживают перезапуск: имя в scheduled_jobs → корутина(*args)
+DURABLE_JOBS = {
+    'video_funnel_step1': _video_funnel_step1,
+    'video_funnel_step2': _video_funnel_step2,
+    'menu_retry': schedule_menu_retry,
+}